@@ -0,0 +1,5 @@
+from .suite import main
+
+import sys
+
+sys.exit(main())
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+    benchmarks.engine_reuse
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compare per-call latency of database lookups with a fresh engine per call (the old behaviour)
+    against lookups through the shared engine registry.
+
+    Run from the project root with `python -m benchmarks.engine_reuse [iterations]`.
+
+"""
+
+from pwm import PWM
+from pwm.core import Domain
+
+import os
+import sqlalchemy as sa
+import sys
+import tempfile
+import timeit
+from sqlalchemy.orm import sessionmaker
+
+
+def _setup_db(path):
+    pwm = PWM()
+    pwm.bootstrap(path)
+    for i in range(100):
+        pwm.create_domain('domain%d.com' % i)
+    pwm.dispose()
+
+
+def fresh_engine_lookup(database_uri):
+    engine = sa.create_engine(database_uri)
+    session = sessionmaker(bind=engine, expire_on_commit=False)()
+    try:
+        session.query(Domain).filter(Domain.name == 'domain50.com').first()
+        session.commit()
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def shared_engine_lookup(database_uri):
+    pwm = PWM(database_uri)
+    pwm.get_domain('domain50.com')
+    pwm.close()
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    tmp_db = tempfile.NamedTemporaryFile(delete=False)
+    tmp_db.close()
+    try:
+        _setup_db(tmp_db.name)
+        database_uri = 'sqlite:///%s' % tmp_db.name
+        for name, func in (('fresh engine', fresh_engine_lookup),
+                ('shared engine', shared_engine_lookup)):
+            total = timeit.timeit(lambda: func(database_uri), number=iterations)
+            print('%-14s %8.3fms per call' % (name + ':', total / iterations * 1000))
+    finally:
+        os.remove(tmp_db.name)
+
+
+if __name__ == '__main__':
+    main()
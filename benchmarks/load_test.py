@@ -0,0 +1,160 @@
+"""
+    benchmarks.load_test
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Load test for `pwm serve`. Starts a server on a temporary database, or uses an already running
+    one, and hammers it with concurrent clients:
+
+        $ python -m benchmarks.load_test --workers 4 --clients 32 --duration 10
+        $ python -m benchmarks.load_test --url https://pwm.example.com --names names.txt
+
+"""
+
+from pwm import PWM
+from pwm.rest import RestClient
+
+import argparse
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError('Server did not start listening on port %d' % port)
+
+
+def start_server(database, workers, threads):
+    """ Start `pwm serve` in a subprocess, returning the process and the URL it serves on. """
+    port = _free_port()
+    process = subprocess.Popen([sys.executable, '-c', 'from pwm.cli import main; main()',
+        'serve', '-d', database, '-b', '127.0.0.1:%d' % port, '-w', str(workers),
+        '-t', str(threads)])
+    _wait_for_port(port)
+    return process, 'http://127.0.0.1:%d' % port
+
+
+def load(url, names, clients, duration, batch_size=1, config=None):
+    """ Look up random names from `clients` threads for `duration` seconds.
+
+    :returns: A list of the latencies of all requests, in seconds, and the number of errors.
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def client():
+        rest_client = RestClient(url, dict(config or {}, cache_path=None))
+        own_latencies = []
+        own_errors = 0
+        while time.time() < deadline:
+            start_time = timeit.default_timer()
+            try:
+                if batch_size == 1:
+                    rest_client.get_domain(random.choice(names))
+                else:
+                    rest_client.get_domains(random.sample(names, batch_size))
+            except Exception: # pylint: disable=broad-except
+                own_errors += 1
+                continue
+            own_latencies.append(timeit.default_timer() - start_time)
+        rest_client.close()
+        with lock:
+            latencies.extend(own_latencies)
+            errors[0] += own_errors
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0]
+
+
+def _percentile(sorted_values, percentile):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values)*percentile/100.0))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.load_test')
+    parser.add_argument('-u', '--url',
+        help='Test a running server instead of starting one')
+    parser.add_argument('-n', '--names',
+        help='File with domain names to look up, one per line. Required with --url')
+    parser.add_argument('--domains', type=int, default=10000,
+        help='Number of domains in the database of a started server. Default: %(default)d')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+        help='Processes for a started server. Default: %(default)d')
+    parser.add_argument('-t', '--threads', type=int, default=32,
+        help='Threads per process for a started server. Default: %(default)d')
+    parser.add_argument('-c', '--clients', type=int, default=16,
+        help='Concurrent clients. Default: %(default)d')
+    parser.add_argument('-d', '--duration', type=float, default=10,
+        help='Seconds to run for. Default: %(default)s')
+    parser.add_argument('-b', '--batch-size', type=int, default=1,
+        help='Names per request. 1 uses GET, more uses the batch endpoint. Default: %(default)d')
+    args = parser.parse_args(argv)
+
+    tmp_dir = None
+    process = None
+    try:
+        if args.url:
+            if not args.names:
+                parser.error('--names is required with --url')
+            with open(args.names) as names_file:
+                names = [line.strip() for line in names_file if line.strip()]
+            url = args.url
+        else:
+            tmp_dir = tempfile.mkdtemp()
+            database = os.path.join(tmp_dir, 'load_test.sqlite')
+            names = ['domain%d.example.com' % i for i in range(args.domains)]
+            pwm = PWM()
+            pwm.bootstrap(database)
+            pwm.import_domains({'name': name} for name in names)
+            pwm.dispose()
+            process, url = start_server(database, args.workers, args.threads)
+
+        latencies, errors = load(url, names, args.clients, args.duration, args.batch_size)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    if not latencies:
+        print('No successful requests, %d errors' % errors)
+        return 1
+    latencies.sort()
+    print('%d requests in %.1fs, %.0f requests/s, %d errors' % (len(latencies), args.duration,
+        len(latencies)/args.duration, errors))
+    print('Latency: p50 %.2fms, p95 %.2fms, p99 %.2fms, max %.2fms' % tuple(value*1000 for value in (
+        _percentile(latencies, 50), _percentile(latencies, 95), _percentile(latencies, 99),
+        latencies[-1])))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
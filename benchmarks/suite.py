@@ -0,0 +1,287 @@
+"""
+    benchmarks.suite
+    ~~~~~~~~~~~~~~~~
+
+    Performance measurements for key derivation, encoding, database operations and REST lookups.
+
+    Results are written as JSON, and can be compared against a stored baseline to catch
+    regressions:
+
+        $ python -m benchmarks run -o baseline.json
+        $ python -m benchmarks run -o current.json
+        $ python -m benchmarks compare baseline.json current.json
+
+"""
+
+from pwm import PWM, __version__
+from pwm.core import Domain
+from pwm.encoding import PRESETS, get_encoder
+
+import argparse
+import base64
+import json
+import os
+import platform
+import shutil
+import string
+import tempfile
+import threading
+import time
+import timeit
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError: # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+DEFAULT_THRESHOLD = 0.2
+
+CUSTOM_CHARSETS = {
+    'binary': '01',
+    'hex': string.hexdigits[:16],
+    'unicode': u'æøå' + string.ascii_lowercase,
+}
+
+
+def measure(func, number=1, repeat=5):
+    """ Time `func`, returning per-call statistics in seconds over `repeat` runs of `number` calls.
+    """
+    timings = sorted(t / number for t in timeit.repeat(func, number=number, repeat=repeat))
+    return {
+        'min': timings[0],
+        'median': timings[len(timings) // 2],
+        'mean': sum(timings) / len(timings),
+        'calls': number * repeat,
+    }
+
+
+def _per_item(stats, items):
+    """ Scale timings of calls that each process `items` items to per-item timings. """
+    for key in ('min', 'median', 'mean'):
+        stats[key] /= items
+    return stats
+
+
+def bench_derive_key(results, quick=False):
+    domain = Domain(name='example.com', salt=b'NaCl')
+    results['derive_key'] = measure(lambda: domain.derive_key('secret'),
+        repeat=3 if quick else 10)
+
+
+def bench_encoding(results, quick=False):
+    digests = [os.urandom(64) for _ in range(100)]
+    charsets = dict(('preset:%s' % name, alphabet) for name, alphabet in PRESETS.items())
+    charsets.update(('custom:%s' % name, alphabet) for name, alphabet in CUSTOM_CHARSETS.items())
+    number = 10 if quick else 100
+    for name, alphabet in sorted(charsets.items()):
+        encoder = get_encoder(alphabet)
+        def encode_all():
+            for digest in digests:
+                encoder.encode(digest, 16)
+        results['encode:%s' % name] = _per_item(measure(encode_all, number=number),
+            len(digests))
+        results['encode_many:%s' % name] = _per_item(
+            measure(lambda: encoder.encode_many(digests, 16), number=number), len(digests))
+
+
+def bench_database(results, sizes, tmp_dir, quick=False):
+    for size in sizes:
+        path = os.path.join(tmp_dir, 'bench-%d.sqlite' % size)
+        pwm = PWM()
+        pwm.bootstrap(path)
+        pwm.import_domains({'name': 'domain%d.example.com' % i} for i in range(size))
+        middle = 'domain%d.example.com' % (size // 2)
+        number = 10 if quick else 100
+
+        results['db:%d:get_domain' % size] = measure(lambda: pwm.get_domain(middle),
+            number=number)
+        results['db:%d:search' % size] = measure(lambda: pwm.search('%d.ex' % (size // 2)),
+            number=number)
+        results['db:%d:search_ranked_limit' % size] = measure(
+            lambda: pwm.search('domain1', limit=10, rank=True), number=number)
+        results['db:%d:modify_domain' % size] = measure(
+            lambda: pwm.modify_domain(middle, new_salt=True), number=number)
+
+        counter = [0]
+        def create():
+            counter[0] += 1
+            pwm.create_domain('new%d.example.com' % counter[0])
+        results['db:%d:create_domain' % size] = measure(create, number=number)
+
+        def create_many():
+            counter[0] += 1
+            pwm.create_domains({'name': 'bulk%d-%d.example.com' % (counter[0], i)}
+                for i in range(1000))
+        results['db:%d:create_domains_1000' % size] = _per_item(
+            measure(create_many, repeat=3 if quick else 5), 1000)
+        pwm.dispose()
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    """ Serves the REST protocol from a local database, see :mod:`pwm.rest`. """
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, avoid stalling on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        name = parse_qs(urlparse(self.path).query)['domain'][0]
+        domain = self.server.domains.get(name)
+        if domain is None:
+            self._respond(404, {})
+        else:
+            self._respond(200, domain)
+
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        names = json.loads(body.decode('utf8'))['domains']
+        self._respond(200, {'domains': dict((name, self.server.domains[name]) for name in names
+            if name in self.server.domains)})
+
+
+    def _respond(self, status, data):
+        body = json.dumps(data).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+
+class _StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, domains):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _StandInHandler)
+        self.domains = domains
+
+
+def bench_rest(results, tmp_dir, quick=False):
+    domains = {}
+    for i in range(1000):
+        domains['domain%d.example.com' % i] = {
+            'salt': base64.b64encode(os.urandom(32)).decode('ascii'),
+        }
+    server = _StandInServer(domains)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+    uri = 'http://127.0.0.1:%d' % server.server_port
+    number = 10 if quick else 100
+    names = sorted(domains)[:500]
+    try:
+        pwm = PWM(uri, config={'cache_path': None})
+        results['rest:get_domain'] = measure(lambda: pwm.get_domain('domain1.example.com'),
+            number=number)
+        results['rest:get_domains_500'] = measure(lambda: pwm.get_domains(names),
+            repeat=3 if quick else 5)
+        pwm.close()
+
+        cache_path = os.path.join(tmp_dir, 'rest_cache.sqlite')
+        pwm = PWM(uri, config={'cache_path': cache_path})
+        pwm.get_domain('domain1.example.com')
+        results['rest:get_domain_cached'] = measure(
+            lambda: pwm.get_domain('domain1.example.com'), number=number)
+        pwm.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        server_thread.join()
+
+
+def run(sizes=DEFAULT_SIZES, quick=False):
+    """ Run all benchmarks and return the results, including some metadata about the run. """
+    results = {}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        bench_derive_key(results, quick)
+        bench_encoding(results, quick)
+        bench_database(results, sizes, tmp_dir, quick)
+        bench_rest(results, tmp_dir, quick)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return {
+        'meta': {
+            'pwm_version': __version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.time(),
+        },
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """ Compare the median timings of two runs.
+
+    :returns: A list of `(name, baseline_median, current_median, ratio, regressed)` tuples for
+        every benchmark present in both runs.
+    """
+    comparison = []
+    for name in sorted(set(baseline['results']) & set(current['results'])):
+        old = baseline['results'][name]['median']
+        new = current['results'][name]['median']
+        ratio = new / old if old else float('inf')
+        comparison.append((name, old, new, ratio, ratio > 1 + threshold))
+    return comparison
+
+
+def _format_time(seconds):
+    if seconds < 1e-3:
+        return '%.2fus' % (seconds * 1e6)
+    if seconds < 1:
+        return '%.2fms' % (seconds * 1e3)
+    return '%.2fs' % seconds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks')
+    run_parser.add_argument('-o', '--output', help='Write results as JSON to this file')
+    run_parser.add_argument('-s', '--sizes',
+        default=','.join(str(size) for size in DEFAULT_SIZES),
+        help='Comma-separated database sizes to benchmark. Default: %(default)s')
+    run_parser.add_argument('-q', '--quick', action='store_true',
+        help='Run fewer iterations, for a rough picture')
+
+    compare_parser = subparsers.add_parser('compare',
+        help='Compare results against a baseline, exiting with 1 on regressions')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('-t', '--threshold', type=float, default=DEFAULT_THRESHOLD,
+        help='Flag benchmarks that got slower by more than this fraction. Default: %(default)s')
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        sizes = [int(size) for size in args.sizes.split(',') if size]
+        output = run(sizes, quick=args.quick)
+        for name, stats in sorted(output['results'].items()):
+            print('%-40s %10s' % (name, _format_time(stats['median'])))
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                json.dump(output, output_file, indent=2, sort_keys=True)
+        return 0
+    elif args.command == 'compare':
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        with open(args.current) as current_file:
+            current = json.load(current_file)
+        regressions = 0
+        for name, old, new, ratio, regressed in compare(baseline, current, args.threshold):
+            regressions += regressed
+            print('%-40s %10s -> %10s %7.2fx%s' % (name, _format_time(old), _format_time(new),
+                ratio, '  REGRESSION' if regressed else ''))
+        return 1 if regressions else 0
+    parser.print_help()
+    return 2
@@ -4,26 +4,55 @@
 
     Expose public APIs.
 
+    The database-backed APIs in :mod:`pwm.core` pull in SQLAlchemy and friends, which is slow, so
+    they are only imported when first accessed.
+
 """
 # pylint: disable=unused-import
 
 __version__ = '0.1.6' # When bumping, also bump version in setup.py
 
-from .core import (
-    Domain,
-    PWM,
-)
+import sys
 
 from .exceptions import (
+    AgentDatabaseException,
+    AgentLockedException,
     DuplicateDomainException,
     NotReadyException,
     NoSuchDomainException,
+    OutdatedDatabaseException,
 )
 
 from .encoding import (
     ceildiv,
     calc_chunklen,
     Encoder,
+    get_encoder,
     lookup_alphabet,
     PRESETS,
 )
+
+from .policy import Policy
+
+_LAZY_ATTRIBUTES = {
+    'AsyncPWM': 'aio',
+    'Domain': 'core',
+    'DomainSnapshot': 'core',
+    'FederatedPWM': 'federation',
+    'PWM': 'core',
+}
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        module_name = _LAZY_ATTRIBUTES.get(name)
+        if module_name is None:
+            raise AttributeError("module 'pwm' has no attribute '%s'" % name)
+        module = __import__('%s.%s' % (__name__, module_name), fromlist=[name])
+        return getattr(module, name)
+else: # pragma: no cover
+    # Module-level __getattr__ isn't supported, import eagerly
+    from .core import (
+        Domain,
+        DomainSnapshot,
+        PWM,
+    )
@@ -7,21 +7,33 @@
 """
 # pylint: disable=unused-import
 
+import binascii
 import sys
 
 PY2 = sys.version_info[0] == 2
 
 if PY2: # pragma: no cover
-    from ConfigParser import RawConfigParser
-    from httplib import HTTPConnection
     input = raw_input
     def ord_byte(char):
         ''' convert a single character into integer representation '''
         return ord(char)
+    def bytes_to_int(data):
+        ''' parse a byte string as a big-endian unsigned integer '''
+        return int(binascii.hexlify(data) or '0', 16)
 else: # pragma: no cover
-    from configparser import RawConfigParser
-    from http.client import HTTPConnection
     input = input
     def ord_byte(byte):
         ''' convert a single byte into integer representation '''
         return byte
+    def bytes_to_int(data):
+        ''' parse a byte string as a big-endian unsigned integer '''
+        return int.from_bytes(data, 'big')
+
+
+def get_http_connection_class():
+    ''' import HTTPConnection on demand, since the http client modules are slow to import '''
+    if PY2: # pragma: no cover
+        from httplib import HTTPConnection
+    else: # pragma: no cover
+        from http.client import HTTPConnection
+    return HTTPConnection
@@ -0,0 +1,332 @@
+"""
+    pwm.agent
+    ~~~~~~~~~
+
+    A long-lived process that keeps the master password and derived keys in memory, and serves
+    them to clients over a unix domain socket, similar to ssh-agent.
+
+    The protocol is a single line of JSON per request and response. Requests have an `action`,
+    responses either contain the result or an `error` string. Requests for keys name the database
+    they are meant for, and the agent only answers them from the database it serves.
+
+"""
+
+from .exceptions import AgentDatabaseException, AgentLockedException, NoSuchDomainException
+
+import json
+import os
+import socket
+import threading
+import time
+from logging import getLogger
+
+# Not in _compat, since it's only needed by the agent and comparatively slow to import
+try:
+    import socketserver
+except ImportError: # pragma: no cover
+    import SocketServer as socketserver
+
+_logger = getLogger('pwm.agent')
+
+DEFAULT_TTL = 3600
+
+
+def default_socket_path():
+    """ Get the socket path from the PWM_AGENT_SOCK env var, falling back to ~/.pwm/agent.sock. """
+    return os.environ.get('PWM_AGENT_SOCK') or \
+        os.path.join(os.path.expanduser('~'), '.pwm', 'agent.sock')
+
+
+def database_id(path_or_uri):
+    """ Identify a database given as a path or URI, so that the same SQLite database compares equal
+    however it's given, like by a relative path from another directory.
+    """
+    if '://' not in path_or_uri:
+        path_or_uri = 'sqlite:///' + path_or_uri
+    if path_or_uri.startswith('sqlite:///') and path_or_uri != 'sqlite:///:memory:':
+        return 'sqlite:///' + os.path.abspath(path_or_uri[len('sqlite:///'):])
+    return path_or_uri
+
+
+class _AgentHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf8'))
+                response = self.server.agent.handle_request(request)
+            except Exception as ex: # pylint: disable=broad-except
+                _logger.debug('Agent request failed: %s', ex)
+                response = {'error': 'bad_request'}
+            self.wfile.write(json.dumps(response).encode('utf8') + b'\n')
+            self.wfile.flush()
+
+
+class _AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Agent(object):
+    """ Serves keys for a :class:`PWM <pwm.core.PWM>` instance over a unix socket.
+
+    :param pwm: The :class:`PWM <pwm.core.PWM>` instance to look up domains with.
+    :param socket_path: Where to create the socket. Defaults to :func:`default_socket_path`.
+    :param ttl: Number of seconds to hold on to the master password after it's given. Default: one
+        hour.
+    """
+
+    def __init__(self, pwm, socket_path=None, ttl=None):
+        self.pwm = pwm
+        self.socket_path = socket_path or default_socket_path()
+        self.ttl = DEFAULT_TTL if ttl is None else ttl
+        self._master_password = None
+        self._expires_at = 0
+        self._domains = {}
+        self._keys = {}
+        # Stretched master passwords for domains using SCHEME_MASTER_KEY, by master salt and
+        # scrypt parameters
+        self._master_keys = {}
+        self._lock = threading.Lock()
+        # PWM instances hold a single session, so lookups from handler threads must take turns
+        self._db_lock = threading.Lock()
+        self._server = None
+
+
+    @property
+    def database(self):
+        """ The database the agent serves, as identified by :func:`database_id`. """
+        return database_id(self.pwm.database_uri)
+
+
+    def unlock(self, master_password):
+        """ Hold on to the master password for the next `ttl` seconds. """
+        with self._lock:
+            if master_password != self._master_password:
+                self._keys.clear()
+                self._master_keys.clear()
+            self._master_password = master_password
+            self._expires_at = time.time() + self.ttl
+
+
+    def lock(self):
+        """ Forget the master password and everything derived from it. """
+        with self._lock:
+            self._master_password = None
+            self._expires_at = 0
+            self._keys.clear()
+            self._master_keys.clear()
+            self._domains.clear()
+
+
+    def forget(self, domain_name):
+        """ Drop cached values for a domain, for when it has been modified. """
+        with self._lock:
+            self._domains.pop(domain_name, None)
+            self._keys.pop(domain_name, None)
+
+
+    def get(self, domain_name):
+        """ Get the key and username for a domain.
+
+        :raises AgentLockedException: If the agent doesn't hold a master password.
+        :raises NoSuchDomainException: If the domain doesn't exist.
+        """
+        with self._lock:
+            if self._master_password is not None and time.time() >= self._expires_at:
+                _logger.info('Master password expired, locking agent')
+                self._master_password = None
+                self._keys.clear()
+                self._master_keys.clear()
+                self._domains.clear()
+            master_password = self._master_password
+            if master_password is None:
+                raise AgentLockedException()
+            domain = self._domains.get(domain_name)
+            key = self._keys.get(domain_name)
+
+        if domain is None:
+            with self._db_lock:
+                domain = self.pwm.get_domain(domain_name)
+        if key is None:
+            key = self._derive_key(domain, master_password)
+
+        with self._lock:
+            # Don't cache anything if the agent was locked or unlocked with another password
+            # while we were deriving
+            if self._master_password == master_password:
+                self._domains[domain_name] = domain
+                self._keys[domain_name] = key
+        return key, domain.username
+
+
+    def _derive_key(self, domain, master_password):
+        """ Derive the key for a domain, only stretching the master password once for all domains
+        that share a master key.
+        """
+        from .core import SCHEME_MASTER_KEY, stretch_master_password
+
+        if domain.derivation_scheme != SCHEME_MASTER_KEY:
+            return domain.derive_key(master_password)
+        stretch_args = (domain.master_salt, domain.scrypt_params)
+        with self._lock:
+            master_key = None
+            if self._master_password == master_password:
+                master_key = self._master_keys.get(stretch_args)
+        if master_key is None:
+            master_key = stretch_master_password(master_password, *stretch_args)
+            with self._lock:
+                if self._master_password == master_password:
+                    self._master_keys[stretch_args] = master_key
+        return domain.derive_key(master_password, master_key=master_key)
+
+
+    def handle_request(self, request):
+        action = request.get('action')
+        if action == 'get':
+            database = request.get('database')
+            if database is not None and database != self.database:
+                return {'error': 'other_database', 'database': self.database}
+            if request.get('master_password') is not None:
+                self.unlock(request['master_password'])
+            try:
+                key, username = self.get(request['domain'])
+            except AgentLockedException:
+                return {'error': 'locked'}
+            except NoSuchDomainException:
+                return {'error': 'no_such_domain'}
+            return {'key': key, 'username': username}
+        elif action == 'forget':
+            self.forget(request['domain'])
+            return {}
+        elif action == 'lock':
+            self.lock()
+            return {}
+        return {'error': 'unknown_action'}
+
+
+    def serve_forever(self):
+        """ Bind the socket and serve requests until :func:`shutdown <Agent.shutdown>` is called. """
+        self.bind()
+        try:
+            self._server.serve_forever()
+        finally:
+            self.close()
+
+
+    def bind(self):
+        """ Create the socket, readable and writable only by the current user. """
+        socket_dir = os.path.dirname(self.socket_path)
+        if socket_dir and not os.path.exists(socket_dir):
+            os.makedirs(socket_dir, 0o700)
+        if os.path.exists(self.socket_path):
+            if AgentClient(self.socket_path).is_running():
+                raise IOError('An agent is already listening on %s' % self.socket_path)
+            os.remove(self.socket_path)
+        old_umask = os.umask(0o177)
+        try:
+            self._server = _AgentServer(self.socket_path, _AgentHandler)
+        finally:
+            os.umask(old_umask)
+        self._server.agent = self
+        _logger.debug('Agent listening on %s', self.socket_path)
+
+
+    def shutdown(self):
+        """ Stop serving requests. Safe to call from another thread. """
+        if self._server:
+            self._server.shutdown()
+
+
+    def close(self):
+        self.lock()
+        if self._server:
+            self._server.server_close()
+            self._server = None
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class AgentClient(object):
+    """ Thin client for talking to a running :class:`Agent`. Only uses the standard library, so that
+    fetching keys from the agent doesn't have to load the database stack.
+
+    :param socket_path: The socket of the agent. Defaults to :func:`default_socket_path`.
+    :param timeout: Seconds to wait for a response. Key derivations on a cold cache run scrypt, so
+        leave some headroom.
+    """
+
+    def __init__(self, socket_path=None, timeout=30):
+        self.socket_path = socket_path or default_socket_path()
+        self.timeout = timeout
+
+
+    def is_running(self):
+        """ Check whether an agent is listening on the socket. """
+        try:
+            self._connect().close()
+            return True
+        except socket.error:
+            return False
+
+
+    def get(self, domain_name, master_password=None, database=None):
+        """ Get the key and username for a domain from the agent.
+
+        :param master_password: If given, unlocks the agent with this password first.
+        :param database: If given, the path or URI of the database the domain is looked up in. The
+            agent only answers if it serves this database.
+        :returns: A `(key, username)` tuple.
+        :raises AgentLockedException: If the agent doesn't hold a master password.
+        :raises AgentDatabaseException: If the agent serves another database.
+        :raises NoSuchDomainException: If the domain doesn't exist.
+        :raises socket.error: If no agent is listening.
+        """
+        request = {'action': 'get', 'domain': domain_name}
+        if database is not None:
+            request['database'] = database_id(database)
+        if master_password is not None:
+            request['master_password'] = master_password
+        response = self._request(request)
+        error = response.get('error')
+        if error == 'locked':
+            raise AgentLockedException()
+        elif error == 'other_database':
+            raise AgentDatabaseException('The agent serves %s' % response['database'])
+        elif error == 'no_such_domain':
+            raise NoSuchDomainException(domain_name)
+        elif error:
+            raise ValueError('Agent request failed: %s' % error)
+        return response['key'], response['username']
+
+
+    def forget(self, domain_name):
+        """ Make the agent drop anything it has cached for the domain. """
+        self._request({'action': 'forget', 'domain': domain_name})
+
+
+    def lock(self):
+        """ Make the agent forget the master password. """
+        self._request({'action': 'lock'})
+
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except socket.error:
+            sock.close()
+            raise
+        return sock
+
+
+    def _request(self, request):
+        sock = self._connect()
+        try:
+            sock.sendall(json.dumps(request).encode('utf8') + b'\n')
+            response = sock.makefile('rb').readline()
+        finally:
+            sock.close()
+        if not response:
+            raise socket.error('Agent closed the connection')
+        return json.loads(response.decode('utf8'))
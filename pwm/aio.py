@@ -0,0 +1,421 @@
+"""
+    pwm.aio
+    ~~~~~~~
+
+    An asyncio-native counterpart to :class:`PWM <pwm.core.PWM>`, for use from event loops.
+
+    Database access goes through SQLAlchemy's asyncio extension (aiosqlite for SQLite, asyncpg for
+    PostgreSQL), REST databases are queried with aiohttp, and key derivations run on a bounded
+    thread pool, since scrypt releases the GIL while hashing.
+
+"""
+
+from .core import (
+    Domain,
+    SCHEME_MASTER_KEY,
+    _FTS_INDEX_EXISTS,
+    _chunks,
+    _derive_key,
+    _get_master_salt,
+    _get_scrypt_params,
+    _pool_args,
+    _resolve_policy,
+    _search_statement,
+    _stamp_changes,
+    _is_outdated,
+    _urify_db,
+)
+from .derive import _resolve_scrypt_params, _validate_scheme
+from .exceptions import (DuplicateDomainException, NotReadyException, NoSuchDomainException,
+    OutdatedDatabaseException)
+from .metrics import instrument_engine, registry as metrics
+from .rest import (BATCH_SIZE, DEFAULT_POOL_SIZE, DEFAULT_TIMEOUT, RestClient, _search_params,
+    decode_domain)
+
+import asyncio
+import concurrent.futures
+import contextlib
+import multiprocessing
+import sqlalchemy as sa
+import ssl
+import timeit
+from logging import getLogger
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+_logger = getLogger('pwm.aio')
+
+# Async drivers to use for database URIs that don't name one
+_ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'postgres': 'postgresql+asyncpg',
+    'mysql': 'mysql+aiomysql',
+}
+
+
+def _async_db_uri(database_uri):
+    """ Get a database URI with an async driver, if it doesn't specify a driver already. """
+    scheme, rest = database_uri.split('://', 1)
+    return '%s://%s' % (_ASYNC_DRIVERS.get(scheme, scheme), rest)
+
+
+class AsyncPWM(object):
+    """ Like :class:`PWM <pwm.core.PWM>`, but all database and network operations are coroutines.
+
+    Databases must already be initialized, with :func:`PWM.bootstrap <pwm.core.PWM.bootstrap>`
+    or `pwm init`.
+
+    :param database_uri: The path to the database to use, or a database URI. URIs without an
+        explicit driver get an async one, like `sqlite+aiosqlite`.
+    :param pool_size: The number of pooled connections to keep open to the database.
+    :param max_overflow: The number of connections to allow in excess of `pool_size`.
+    :param config: Settings for databases served over HTTP(S), see
+        :class:`RestClient <pwm.rest.RestClient>` for the supported keys.
+    :param max_workers: The number of key derivations to run concurrently. Defaults to the number
+        of CPUs. Ignored if `executor` is given.
+    :param executor: A :class:`concurrent.futures.Executor` to run key derivations on.
+    """
+
+    def __init__(self, database_uri=None, pool_size=None, max_overflow=None, config=None,
+            max_workers=None, executor=None):
+        self.database_uri = _urify_db(database_uri) if database_uri else None
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.config = config or {}
+        self._own_executor = executor is None
+        self._executor = executor or concurrent.futures.ThreadPoolExecutor(
+            max_workers or multiprocessing.cpu_count())
+        self._engine = None
+        self._sessionmaker = None
+        self._setup_lock = None
+        self._has_fts_index = None
+        self._rest_client = None
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+    async def get_domain(self, domain_name):
+        """ Get the :class:`Domain <pwm.Domain>` object from a name.
+
+        :raises NoSuchDomainException: If the domain doesn't exist.
+        """
+        if self._uses_rest_api():
+            return Domain(**await self._get_rest_client().get_domain(domain_name))
+        async with self._session() as session:
+            result = await session.execute(sa.select(Domain).where(Domain.name == domain_name))
+            domain = result.scalars().first()
+        if domain is None:
+            raise NoSuchDomainException
+        return domain
+
+
+    async def get_domains(self, domain_names):
+        """ Get the :class:`Domain <pwm.Domain>` objects for several names at once, in the same
+        order as the names were given.
+
+        :raises NoSuchDomainException: If any of the domains doesn't exist.
+        """
+        domain_names = list(domain_names)
+        if self._uses_rest_api():
+            found = await self._get_rest_client().get_domains(domain_names)
+            found = dict((name, Domain(**values)) for name, values in found.items())
+        else:
+            found = {}
+            async with self._session() as session:
+                for chunk in _chunks(domain_names):
+                    result = await session.execute(sa.select(Domain).where(Domain.name.in_(chunk)))
+                    for domain in result.scalars():
+                        found[domain.name] = domain
+        missing = [name for name in domain_names if name not in found]
+        if missing:
+            raise NoSuchDomainException(', '.join(missing))
+        return [found[name] for name in domain_names]
+
+
+    async def search(self, query, limit=None, rank=False):
+        """ Search the database for the given query. Takes the same arguments as
+        :func:`PWM.search <pwm.core.PWM.search>`.
+        """
+        if self._uses_rest_api():
+            return [Domain(**values) for values in await self._get_rest_client().search(query,
+                limit, rank)]
+        async with self._session() as session:
+            statement = _search_statement(query, limit, rank, await self._uses_fts_index(session))
+            result = await session.execute(statement)
+            return result.scalars().all()
+
+
+    async def create_domain(self, domain_name, username=None, alphabet=Domain.DEFAULT_ALPHABET,
+            length=Domain.DEFAULT_KEY_LENGTH, scrypt_n=None, scrypt_r=None, scrypt_p=None,
+            scheme=Domain.DEFAULT_SCHEME, policy=None):
+        """ Create a new domain entry in the database. Takes the same arguments as
+        :func:`PWM.create_domain <pwm.core.PWM.create_domain>`.
+        """
+        _validate_scheme(scheme)
+        policy = _resolve_policy(policy, alphabet, length)
+        scrypt_params = (scrypt_n, scrypt_r, scrypt_p)
+        defaults = await self.get_scrypt_params() if None in scrypt_params else scrypt_params
+        scrypt_n, scrypt_r, scrypt_p = _resolve_scrypt_params(scrypt_params, defaults)
+        domain = Domain(name=domain_name, username=username, key_length=length,
+            alphabet=alphabet, scrypt_n=scrypt_n, scrypt_r=scrypt_r, scrypt_p=scrypt_p,
+            scheme=scheme, policy=policy, key_stream=True)
+        try:
+            async with self._session() as session:
+                async with session.begin():
+                    if scheme == SCHEME_MASTER_KEY:
+                        domain.master_salt = await session.run_sync(_get_master_salt)
+                    await session.run_sync(_stamp_changes, [domain])
+                    session.add(domain)
+        except sa.exc.IntegrityError as ex:
+            _logger.warning("Inserting new domain failed: %s", ex)
+            raise DuplicateDomainException
+        return domain
+
+
+    async def get_scrypt_params(self):
+        """ Get the scrypt parameters new domains are created with, see
+        :func:`PWM.get_scrypt_params <pwm.core.PWM.get_scrypt_params>`.
+        """
+        async with self._session() as session:
+            return await session.run_sync(_get_scrypt_params)
+
+
+    async def modify_domain(self, domain_name, new_salt=False, username=None):
+        """ Modify an existing domain. Takes the same arguments as
+        :func:`PWM.modify_domain <pwm.core.PWM.modify_domain>`.
+        """
+        async with self._session() as session:
+            async with session.begin():
+                result = await session.execute(sa.select(Domain)
+                    .where(Domain.name == domain_name))
+                domain = result.scalars().first()
+                if domain is None:
+                    raise NoSuchDomainException
+                if new_salt:
+                    _logger.info("Generating new salt..")
+                    domain.new_salt()
+                if username is not None:
+                    domain.username = username
+                await session.run_sync(_stamp_changes, [domain])
+        return domain
+
+
+    async def derive_key(self, domain, master_password):
+        """ Compute the key for a domain on the executor, without blocking the event loop.
+
+        :param domain: A :class:`Domain <pwm.core.Domain>`, or the name of one.
+        """
+        if not isinstance(domain, Domain):
+            domain = await self.get_domain(domain)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, _derive_key, master_password,
+            *domain._key_args())
+
+
+    async def close(self):
+        """ Close all pooled connections, and the executor if it was created by this instance. """
+        if self._engine is not None:
+            await self._engine.dispose()
+            self._engine = None
+            self._sessionmaker = None
+        if self._rest_client is not None:
+            await self._rest_client.close()
+            self._rest_client = None
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+
+
+    def _uses_rest_api(self):
+        if not self.database_uri:
+            return False
+        return self.database_uri.split(':', 1)[0] in ('https', 'http')
+
+
+    @contextlib.asynccontextmanager
+    async def _session(self):
+        if not self.database_uri:
+            raise NotReadyException()
+        if self._sessionmaker is None:
+            if self._setup_lock is None:
+                # Created here to bind to the running loop on older pythons
+                self._setup_lock = asyncio.Lock()
+            async with self._setup_lock:
+                if self._sessionmaker is None:
+                    await self._create_engine()
+        async with self._sessionmaker() as session:
+            yield session
+
+
+    async def _create_engine(self):
+        database_uri = _async_db_uri(self.database_uri)
+        engine = create_async_engine(database_uri, **_pool_args(database_uri, self.pool_size,
+            self.max_overflow))
+        instrument_engine(engine.sync_engine)
+        async with engine.connect() as connection:
+            outdated = await connection.run_sync(_is_outdated)
+        if outdated:
+            await engine.dispose()
+            raise OutdatedDatabaseException('%s was created by an older version of pwm, run '
+                '`pwm upgrade` first' % self.database_uri)
+        self._engine = engine
+        self._sessionmaker = async_sessionmaker(engine, expire_on_commit=False)
+
+
+    async def _uses_fts_index(self, session):
+        if self._has_fts_index is None:
+            self._has_fts_index = False
+            if self._engine.dialect.name == 'sqlite':
+                result = await session.execute(sa.text(_FTS_INDEX_EXISTS))
+                self._has_fts_index = result.first() is not None
+        return self._has_fts_index
+
+
+    def _get_rest_client(self):
+        if self._rest_client is None:
+            self._rest_client = AsyncRestClient(self.database_uri, self.config)
+        return self._rest_client
+
+
+class AsyncRestClient(object):
+    """ aiohttp-based counterpart to :class:`RestClient <pwm.rest.RestClient>`, sharing its
+    configuration, on-disk salt cache, and the steps of lookups that don't touch the network. The
+    cache is used on the default executor of the loop, since it blocks on sqlite3.
+    """
+
+    def __init__(self, base_url, config=None):
+        # The sync client never touches the network here
+        self._sync_client = RestClient(base_url, config)
+        self.base_url = self._sync_client.base_url
+        self.config = self._sync_client.config
+        self.cache = self._sync_client.cache
+        self.cache_ttl = self._sync_client.cache_ttl
+        self._session = None
+
+
+    def _get_session(self):
+        import aiohttp
+
+        if self._session is None:
+            # Only trust the pinned certificate if there is one, like the sync client
+            ssl_context = ssl.create_default_context(
+                cafile=self.config.get('server_certificate'))
+            auth = self.config.get('auth')
+            if auth:
+                if isinstance(auth, (tuple, list)):
+                    ssl_context.load_cert_chain(*auth)
+                else:
+                    ssl_context.load_cert_chain(auth)
+            timeout = self.config.get('timeout', DEFAULT_TIMEOUT)
+            if isinstance(timeout, (tuple, list)):
+                timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+            else:
+                timeout = aiohttp.ClientTimeout(total=timeout)
+            connector = aiohttp.TCPConnector(ssl=ssl_context,
+                limit=self.config.get('pool_size', DEFAULT_POOL_SIZE))
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+
+    async def _run(self, step, *args):
+        """ Run a step of the sync client, off the loop if it uses the cache. """
+        if self.cache is None:
+            return step(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, step, *args)
+
+
+    @contextlib.asynccontextmanager
+    async def _request(self, method, path='/get', **kwargs):
+        """ Send a request to the server, recording its duration as `pwm_rest_request_seconds`. """
+        start_time = timeit.default_timer()
+        status = 'error'
+        try:
+            async with self._get_session().request(method, self.base_url + path,
+                    **kwargs) as response:
+                status = response.status
+                yield response
+        finally:
+            metrics.observe('pwm_rest_request_seconds', timeit.default_timer() - start_time,
+                method=method, status=status)
+
+
+    async def get_domain(self, domain_name):
+        """ Look up a single domain, through the cache.
+
+        :returns: Keyword arguments for :class:`Domain <pwm.core.Domain>`.
+        :raises NoSuchDomainException: If the server doesn't know the domain.
+        """
+        import aiohttp
+
+        client = self._sync_client
+        data, cached, headers = await self._run(client._check_cache, domain_name)
+        if data is not None:
+            return decode_domain(domain_name, data)
+        try:
+            async with self._request('GET', params={'domain': domain_name},
+                    headers=headers) as response:
+                data = await self._run(client._check_status, domain_name, cached,
+                    response.status)
+                if data is None:
+                    response.raise_for_status()
+                    data = await response.json()
+                    await self._run(client._store, domain_name, data,
+                        response.headers.get('ETag'))
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as ex:
+            data = await self._run(client._use_stale, domain_name, cached, ex)
+            if data is None:
+                raise
+        return decode_domain(domain_name, data)
+
+
+    async def get_domains(self, domain_names):
+        """ Look up several domains, in one request per :data:`BATCH_SIZE <pwm.rest.BATCH_SIZE>`
+        names that aren't freshly cached.
+
+        :returns: A dict from domain name to keyword arguments for
+            :class:`Domain <pwm.core.Domain>`, for the domains that exist.
+        """
+        import aiohttp
+
+        client = self._sync_client
+        domains, stale, to_fetch = await self._run(client._check_cache_many, list(domain_names))
+        for i in range(0, len(to_fetch), BATCH_SIZE):
+            batch = to_fetch[i:i+BATCH_SIZE]
+            try:
+                async with self._request('POST', json={'domains': batch}) as response:
+                    response.raise_for_status()
+                    fetched = (await response.json())['domains']
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as ex:
+                remaining = await self._run(client._use_stale_many, to_fetch[i:], stale, ex)
+                if remaining is None:
+                    raise
+                domains.update(remaining)
+                break
+            domains.update(await self._run(client._store_many, batch, stale, fetched))
+
+        return dict((name, decode_domain(name, data)) for name, data in domains.items())
+
+
+    async def search(self, query, limit=None, rank=False):
+        """ Search the server for domains matching `query`, like
+        :func:`RestClient.search <pwm.rest.RestClient.search>`.
+
+        :returns: A list of keyword arguments for :class:`Domain <pwm.core.Domain>`.
+        """
+        async with self._request('GET', path='/search',
+                params=_search_params(query, limit, rank)) as response:
+            response.raise_for_status()
+            results = (await response.json())['domains']
+        return await self._run(self._sync_client._store_search, results)
+
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        self._sync_client.close()
@@ -0,0 +1,86 @@
+"""
+    pwm.cache
+    ~~~~~~~~~
+
+    In-memory caching of domains, shared by :class:`PWM <pwm.core.PWM>` and `pwm serve`.
+
+"""
+
+import collections
+import threading
+import time
+
+
+class DomainCache(object):
+    """ A thread-safe, bounded LRU cache of domains, expiring entries after `ttl` seconds.
+
+    To not cache a domain fetched before an invalidation, fetch :attr:`generation` before looking
+    up the domain, and pass it to :func:`put <DomainCache.put>`.
+
+    :param ttl: Seconds to keep entries for, or None to keep them until evicted or invalidated.
+    :param max_size: The maximum number of entries, the least recently used are evicted first.
+    """
+
+    def __init__(self, ttl=None, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, name):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                self.misses += 1
+                return None
+            data, expires_at = entry
+            if expires_at is not None and time.time() >= expires_at:
+                del self._entries[name]
+                self.misses += 1
+                return None
+            # Move to the end, to be evicted last
+            del self._entries[name]
+            self._entries[name] = entry
+            self.hits += 1
+            return data
+
+
+    def put(self, name, data, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries.pop(name, None)
+            expires_at = time.time() + self.ttl if self.ttl is not None else None
+            self._entries[name] = (data, expires_at)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+    def invalidate(self, name):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(name, None)
+
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+
+    def stats(self):
+        """ Get the number of lookups served from the cache, the number that weren't, and the
+        current number of entries.
+
+        :returns: A dict with the keys `hits`, `misses` and `size`.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+            }
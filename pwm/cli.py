@@ -1,11 +1,16 @@
-from . import PWM, encoding, Domain, NoSuchDomainException, __version__
-from ._compat import HTTPConnection, RawConfigParser, input
+from . import encoding, __version__
+from ._compat import get_http_connection_class
+from .exceptions import AgentDatabaseException, AgentLockedException, NoSuchDomainException
+from .policy import CLASSES, Policy
 
 import argparse
+import getpass
+import json
+import logging
 import os
+import signal
+import socket
 import sys
-import logging.config
-import textwrap
 from logging import getLogger
 
 _logger = getLogger('pwm.cli')
@@ -19,6 +24,12 @@ _VERBOSE_PARSER.add_argument('-v', '--verbose',
     help='Increase verbosity',
 )
 
+# Names for the derivation schemes in pwm.core, which isn't imported until needed
+_SCHEMES = {
+    'scrypt': 1,
+    'master-key': 2,
+}
+
 _DB_PARSER = argparse.ArgumentParser(add_help=False)
 _DB_PARSER.add_argument('-d', '--database',
     metavar='<database>',
@@ -31,6 +42,8 @@ def main():
     """ Main entry point for the CLI. """
     args = get_args()
     ret_code = args.target(args)
+    if args.verbose:
+        _log_timings()
     _logger.debug('Exiting with code %d', ret_code)
     sys.exit(ret_code)
 
@@ -56,6 +69,14 @@ def get_args():
     add_create_parser(subparsers)
     add_init_parser(subparsers)
     add_modify_parser(subparsers)
+    add_agent_parser(subparsers)
+    add_export_parser(subparsers)
+    add_import_parser(subparsers)
+    add_calibrate_parser(subparsers)
+    add_serve_parser(subparsers)
+    add_rotate_parser(subparsers)
+    add_sync_parser(subparsers)
+    add_upgrade_parser(subparsers)
 
     args = argparser.parse_args()
     _init_logging(verbose=args.verbose)
@@ -79,26 +100,95 @@ def add_create_parser(subparsers):
         metavar='<length>',
         help='Set length of generated key. Default: %(default)d',
         type=int,
-        default=Domain.DEFAULT_KEY_LENGTH,
+        default=encoding.DEFAULT_KEY_LENGTH,
     )
     parser.add_argument('-c', '--charset',
         metavar='<charset>',
         help='Use this (named or custom) charset. Named presets include:\n\n%s' %
             '\n'.join("'%s': '%s'" % (name, alphabet.replace('%', '%%')) for name, alphabet
                 in encoding.PRESETS.items()),
-        default='full',
+        default=encoding.DEFAULT_ALPHABET,
+    )
+    _add_scrypt_arguments(parser, 'Default: the database default, see `pwm calibrate`')
+    parser.add_argument('--scheme',
+        choices=sorted(_SCHEMES),
+        default='scrypt',
+        help="How to derive keys. 'scrypt' hashes the master password for every domain, " +
+            "'master-key' hashes it once for all domains using this scheme and derives each " +
+            'key from that cheaply. Default: %(default)s',
+    )
+    parser.add_argument('-r', '--require',
+        metavar='<class>[:<count>]',
+        action='append',
+        default=[],
+        help='Require at least <count> characters of a class in the key, one of %s. ' %
+            ', '.join(CLASSES) + 'Can be given several times. Default count: 1',
+    )
+    parser.add_argument('-x', '--exclude',
+        metavar='<characters>',
+        default='',
+        help='Never use these characters in the key, like ones that are easy to confuse',
     )
     parser.set_defaults(target=create)
 
 
+def _parse_policy(requirements, exclude):
+    """ Build a policy from `--require` and `--exclude`, or None if neither was given. """
+    if not requirements and not exclude:
+        return None
+    minimums = {}
+    for requirement in requirements:
+        name, _, count = requirement.partition(':')
+        try:
+            minimums[name] = int(count) if count else 1
+        except ValueError:
+            raise ValueError('Invalid count in --require %s' % requirement)
+    return Policy(minimums, exclude)
+
+
+def _add_scrypt_arguments(parser, default_help):
+    parser.add_argument('--scrypt-n',
+        metavar='<N>',
+        type=int,
+        help='scrypt CPU/memory cost, a power of two. %s' % default_help,
+    )
+    parser.add_argument('--scrypt-r',
+        metavar='<r>',
+        type=int,
+        help='scrypt block size. %s' % default_help,
+    )
+    parser.add_argument('--scrypt-p',
+        metavar='<p>',
+        type=int,
+        help='scrypt parallelization. %s' % default_help,
+    )
+
+
 def add_get_parser(subparsers):
     parser = subparsers.add_parser('get',
         help='Get the key for a domain',
         parents=[_VERBOSE_PARSER, _DB_PARSER],
     )
     parser.add_argument('domain',
+        nargs='?',
         help='The domain to retrieve the password for',
     )
+    parser.add_argument('-b', '--batch',
+        action='store_true',
+        default=False,
+        help='Read domain names from stdin, one per line, and print a tab-separated ' +
+            'name and key for each',
+    )
+    parser.add_argument('-w', '--workers',
+        metavar='<workers>',
+        type=int,
+        help='Number of processes to derive keys with in batch mode. Default: number of CPUs',
+    )
+    parser.add_argument('--unordered',
+        action='store_true',
+        default=False,
+        help='In batch mode, print keys as soon as they are ready instead of in input order',
+    )
     parser.set_defaults(target=get)
 
 
@@ -130,9 +220,193 @@ def add_search_parser(subparsers):
     parser.add_argument('query',
         help='The query string to search for',
     )
+    parser.add_argument('-l', '--limit',
+        metavar='<limit>',
+        type=int,
+        help='Show at most this many results, best matches first',
+    )
     parser.set_defaults(target=search)
 
 
+def add_agent_parser(subparsers):
+    parser = subparsers.add_parser('agent',
+        help='Run an agent that keeps the master password in memory for fast lookups',
+        parents=[_VERBOSE_PARSER, _DB_PARSER],
+    )
+    parser.add_argument('-t', '--ttl',
+        metavar='<seconds>',
+        type=int,
+        help='Forget the master password after this many seconds. Default: one hour',
+    )
+    parser.add_argument('-s', '--socket',
+        metavar='<socket>',
+        help='Path to the socket to listen on. Can also be set with the PWM_AGENT_SOCK env ' +
+            'var. If neither is set, will fall back to ~/.pwm/agent.sock',
+    )
+    parser.set_defaults(target=agent)
+
+
+def add_export_parser(subparsers):
+    parser = subparsers.add_parser('export',
+        help='Export all domains as newline-delimited JSON',
+        parents=[_VERBOSE_PARSER, _DB_PARSER],
+    )
+    parser.add_argument('-o', '--output',
+        metavar='<file>',
+        help='Write to this file instead of stdout',
+    )
+    parser.set_defaults(target=export)
+
+
+def add_import_parser(subparsers):
+    parser = subparsers.add_parser('import',
+        help='Import domains from newline-delimited JSON, as written by export',
+        parents=[_VERBOSE_PARSER, _DB_PARSER],
+    )
+    parser.add_argument('input',
+        metavar='<file>',
+        nargs='?',
+        help='Read from this file instead of stdin',
+    )
+    parser.add_argument('-b', '--batch-size',
+        metavar='<size>',
+        type=int,
+        default=5000,
+        help='Number of domains to insert per transaction. Default: %(default)d',
+    )
+    parser.set_defaults(target=import_)
+
+
+def add_calibrate_parser(subparsers):
+    parser = subparsers.add_parser('calibrate',
+        help='Find scrypt parameters that take a given time on this machine',
+        parents=[_VERBOSE_PARSER, _DB_PARSER],
+    )
+    parser.add_argument('-t', '--target-ms',
+        metavar='<ms>',
+        type=int,
+        default=100,
+        help='How long a key derivation should take, in milliseconds. Default: %(default)d',
+    )
+    parser.add_argument('-r',
+        metavar='<r>',
+        type=int,
+        default=8,
+        help='scrypt block size to calibrate N for. Default: %(default)d',
+    )
+    parser.add_argument('-p',
+        metavar='<p>',
+        type=int,
+        default=1,
+        help='scrypt parallelization to calibrate N for. Default: %(default)d',
+    )
+    parser.add_argument('-a', '--apply',
+        action='store_true',
+        default=False,
+        help='Use the parameters for new domains in the database. Existing domains are unchanged',
+    )
+    parser.set_defaults(target=calibrate)
+
+
+def add_serve_parser(subparsers):
+    parser = subparsers.add_parser('serve',
+        help='Serve the database over HTTP(S), for clients using an https:// database',
+        parents=[_VERBOSE_PARSER, _DB_PARSER],
+    )
+    parser.add_argument('-b', '--bind',
+        metavar='<host:port>',
+        default='127.0.0.1:8080',
+        help='Address to listen on. Default: %(default)s',
+    )
+    parser.add_argument('-w', '--workers',
+        metavar='<workers>',
+        type=int,
+        default=1,
+        help='Number of processes to serve with. Default: %(default)d',
+    )
+    parser.add_argument('-t', '--threads',
+        metavar='<threads>',
+        type=int,
+        default=32,
+        help='Number of connections to serve concurrently per process. Default: %(default)d',
+    )
+    parser.add_argument('--cache-ttl',
+        metavar='<seconds>',
+        type=int,
+        default=60,
+        help='Seconds to cache domains in memory. Changes made by other processes show up ' +
+            'within this time, or right away after sending SIGHUP to the server. ' +
+            'Default: %(default)d',
+    )
+    parser.add_argument('--cert',
+        metavar='<file>',
+        help='Serve HTTPS with this certificate, optionally including the key',
+    )
+    parser.add_argument('--key',
+        metavar='<file>',
+        help='The key for the certificate, if not in the same file',
+    )
+    parser.add_argument('--client-ca',
+        metavar='<file>',
+        help='Only accept clients with a certificate signed by one of these certificates',
+    )
+    parser.set_defaults(target=serve)
+
+
+def add_rotate_parser(subparsers):
+    parser = subparsers.add_parser('rotate',
+        help='Give new salts to all domains, or the ones matching a query, changing their keys',
+        parents=[_VERBOSE_PARSER, _DB_PARSER],
+    )
+    parser.add_argument('query',
+        nargs='?',
+        help='Only rotate domains matching this, like for search',
+    )
+    parser.add_argument('-c', '--chunk-size',
+        metavar='<domains>',
+        type=int,
+        default=1000,
+        help='Number of domains to rotate per transaction. Default: %(default)d',
+    )
+    parser.add_argument('-y', '--yes',
+        action='store_true',
+        help='Rotate the salts. Without this, only show how many domains would get new keys',
+    )
+    parser.set_defaults(target=rotate)
+
+
+def add_sync_parser(subparsers):
+    parser = subparsers.add_parser('sync',
+        help='Copy the domains created or changed in another database since the last sync',
+        parents=[_VERBOSE_PARSER, _DB_PARSER],
+    )
+    parser.add_argument('source',
+        metavar='<source>',
+        help='The database to copy changes from',
+    )
+    parser.add_argument('dest',
+        metavar='<dest>',
+        nargs='?',
+        help='The database to copy changes to. Default: The database given with --database or ' +
+            'PWM_DATABASE, or ~/.pwm/db.sqlite',
+    )
+    parser.add_argument('-b', '--batch-size',
+        metavar='<size>',
+        type=int,
+        default=1000,
+        help='Number of changed domains to apply per transaction. Default: %(default)d',
+    )
+    parser.set_defaults(target=sync)
+
+
+def add_upgrade_parser(subparsers):
+    parser = subparsers.add_parser('upgrade',
+        help='Bring a database created by an older version of pwm up to date',
+        parents=[_VERBOSE_PARSER, _DB_PARSER],
+    )
+    parser.set_defaults(target=upgrade)
+
+
 def add_init_parser(subparsers):
     parser = subparsers.add_parser('init',
         help='Initialize a new database',
@@ -145,6 +419,8 @@ def add_init_parser(subparsers):
 
 
 def init(args):
+    from .core import PWM
+
     pwm = PWM()
     _logger.debug('Initializing database at %s', args.database)
     pwm.bootstrap(args.database)
@@ -153,13 +429,27 @@ def init(args):
 
 def search(args):
     pwm = _get_pwm(args.database)
-    results = pwm.search(args.query)
+    results = pwm.search(args.query, limit=args.limit, rank=True)
     for result in results:
         print(result.name)
     return 0
 
 
 def get(args):
+    if args.batch:
+        return _get_batch(_get_pwm(args.database), args)
+    if not args.domain:
+        print('You need to specify a domain, or use --batch to read domains from stdin.')
+        return 1
+    database = _get_database(args.database)
+    # Asking the agent doesn't need the database stack, so check it before loading that
+    agent_ret = _get_from_agent(database, args.domain)
+    if agent_ret is not None:
+        return agent_ret
+    # Looking up the domain in the index doesn't need the database stack either
+    index_ret = _get_from_index(database, args.domain)
+    if index_ret is not None:
+        return index_ret
     pwm = _get_pwm(args.database)
     try:
         domain = pwm.get_domain(args.domain)
@@ -173,11 +463,85 @@ def get(args):
     return 0
 
 
+def _get_from_agent(database, domain_name):
+    """ Fetch a key through a running agent. Returns None if there is no agent serving `database` to
+    ask.
+    """
+    from .agent import AgentClient
+
+    client = AgentClient()
+    try:
+        try:
+            key, username = client.get(domain_name, database=database)
+        except AgentLockedException:
+            master_password = getpass.getpass('Enter your master password: ')
+            key, username = client.get(domain_name, master_password=master_password,
+                database=database)
+    except NoSuchDomainException:
+        print("Couldn't find any entries for '%s', are you sure you have created any?" % domain_name)
+        return 1
+    except AgentDatabaseException as ex:
+        _logger.debug('Not asking the agent: %s', ex)
+        return None
+    except socket.error:
+        return None
+    if username:
+        print('Username: %s' % username)
+    print(key)
+    return 0
+
+
+def _get_from_index(database, domain_name):
+    """ Derive a key from the index of a local database. Returns None if there is no up-to-date
+    index to use.
+    """
+    if '://' in database:
+        return None
+    from .derive import _derive_key, key_args
+    from .index import open_index
+
+    index = open_index(database)
+    if index is None:
+        return None
+    with index:
+        domain = index.get(domain_name)
+    if domain is None:
+        print("Couldn't find any entries for '%s', are you sure you have created any?" % domain_name)
+        return 1
+    master_password = getpass.getpass('Enter your master password: ')
+    key = _derive_key(master_password, *key_args(domain))
+    if domain['username']:
+        print('Username: %s' % domain['username'])
+    print(key)
+    return 0
+
+
+def _get_batch(pwm, args):
+    domain_names = [line.strip() for line in sys.stdin if line.strip()]
+    master_password = getpass.getpass('Enter your master password: ')
+    try:
+        results = pwm.derive_keys(domain_names, master_password, workers=args.workers,
+            ordered=not args.unordered)
+        for domain_name, key in results:
+            print('%s\t%s' % (domain_name, key))
+            sys.stdout.flush()
+    except NoSuchDomainException as ex:
+        sys.stderr.write("Couldn't find any entries for '%s'\n" % ex)
+        return 1
+    return 0
+
+
 def create(args):
     pwm = _get_pwm(args.database)
     length = args.length
-    domain = pwm.create_domain(args.domain, username=args.username, alphabet=args.charset,
-        length=length)
+    try:
+        domain = pwm.create_domain(args.domain, username=args.username, alphabet=args.charset,
+            length=length, scrypt_n=args.scrypt_n, scrypt_r=args.scrypt_r,
+            scrypt_p=args.scrypt_p, scheme=_SCHEMES[args.scheme],
+            policy=_parse_policy(args.require, args.exclude))
+    except ValueError as ex:
+        print(ex)
+        return 1
     if domain:
         print('New domain successfully created, key has %d bits of entropy' % domain.entropy)
         print(domain.get_key())
@@ -186,10 +550,122 @@ def create(args):
         return 1
 
 
+def calibrate(args):
+    from .core import calibrate_scrypt
+
+    scrypt_params, timings = calibrate_scrypt(args.target_ms, r=args.r, p=args.p)
+    for n, time_in_ms in timings:
+        print('N=%d: %.1fms' % (n, time_in_ms))
+    print('Recommended for %dms: --scrypt-n %d --scrypt-r %d --scrypt-p %d' % ((args.target_ms,) +
+        scrypt_params))
+    if args.apply:
+        pwm = _get_pwm(args.database)
+        pwm.set_scrypt_params(scrypt_params)
+        print('New domains will be created with these parameters.')
+    return 0
+
+
+def serve(args):
+    from .core import PWM
+    from .server import Server, create_ssl_context, run
+
+    host, _, port = args.bind.rpartition(':')
+    ssl_context = None
+    if args.cert:
+        ssl_context = create_ssl_context(args.cert, args.key, args.client_ca)
+    elif args.client_ca:
+        print('Client certificates require serving HTTPS, use --cert.')
+        return 1
+    # Connections are pooled per process, one for every thread
+    pwm = PWM(_get_database(args.database), pool_size=args.threads, max_overflow=0)
+    server = Server(pwm, (host or '127.0.0.1', int(port)), threads=args.threads,
+        cache_ttl=args.cache_ttl, ssl_context=ssl_context)
+    run(server, workers=args.workers)
+    return 0
+
+
+def rotate(args):
+    pwm = _get_pwm(args.database)
+    if not args.yes:
+        try:
+            count = pwm.count(args.query)
+        except ValueError as ex:
+            print(ex)
+            return 1
+        print('This gives %d domain(s) new keys. Run again with --yes to rotate their salts, and ' \
+            'run the same command again to continue if interrupted.' % count)
+        return 0
+
+    def progress(rotated, total):
+        sys.stderr.write('\rRotated %d/%d domains' % (rotated, total))
+        sys.stderr.flush()
+
+    try:
+        rotated = pwm.rotate_salts(args.query, chunk_size=args.chunk_size, progress=progress)
+    except ValueError as ex:
+        print(ex)
+        return 1
+    if rotated:
+        sys.stderr.write('\n')
+    try:
+        from .agent import AgentClient
+        AgentClient().lock()
+    except socket.error:
+        pass
+    print('Rotated the salts of %d domain(s).' % rotated)
+    return 0
+
+
+def upgrade(args):
+    from .core import PWM
+
+    database = _get_database(args.database)
+    if PWM(database).upgrade():
+        print('Upgraded %s.' % database)
+    else:
+        print('%s is up to date.' % database)
+    return 0
+
+
+def sync(args):
+    from .core import PWM
+
+    pwm = _get_pwm(args.dest or args.database)
+    source = PWM(args.source)
+    shown_progress = []
+
+    def progress(synced, total):
+        shown_progress.append(synced)
+        sys.stderr.write('\rSynced %d/%d changed domains' % (synced, total))
+        sys.stderr.flush()
+
+    try:
+        created, updated, kept = pwm.sync_from(source, batch_size=args.batch_size,
+            progress=progress)
+    except ValueError as ex:
+        print(ex)
+        return 1
+    finally:
+        source.close()
+    if shown_progress:
+        sys.stderr.write('\n')
+    if updated:
+        # Updated domains might have new salts
+        try:
+            from .agent import AgentClient
+            AgentClient().lock()
+        except socket.error:
+            pass
+    print('Created %d and updated %d domain(s), kept %d changed more recently here.' % (created,
+        updated, kept))
+    return 0
+
+
 def modify(args):
     pwm = _get_pwm(args.database)
     try:
         pwm.modify_domain(args.domain, new_salt=args.new_salt, username=args.username)
+        _forget_in_agent(args.domain)
         print('Domain updated successfully.')
         return 0
     except NoSuchDomainException:
@@ -197,42 +673,104 @@ def modify(args):
         return 1
 
 
+def export(args):
+    pwm = _get_pwm(args.database)
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for domain in pwm.export_domains():
+            output.write(json.dumps(domain, sort_keys=True) + '\n')
+    finally:
+        if args.output:
+            output.close()
+    return 0
+
+
+def import_(args):
+    pwm = _get_pwm(args.database)
+    input_file = open(args.input) if args.input else sys.stdin
+    try:
+        domains = (json.loads(line) for line in input_file if line.strip())
+        created, duplicates = pwm.import_domains(domains, batch_size=args.batch_size)
+    except ValueError as ex:
+        print(ex)
+        return 1
+    finally:
+        if args.input:
+            input_file.close()
+    print('Imported %d domains, skipped %d that already existed.' % (created, duplicates))
+    return 0
+
+
+def _forget_in_agent(domain_name):
+    """ Make a running agent drop its cached values for a domain. """
+    from .agent import AgentClient
+
+    try:
+        AgentClient().forget(domain_name)
+    except socket.error:
+        pass
+
+
+def agent(args):
+    from .agent import Agent
+
+    pwm = _get_pwm(args.database)
+    pwm_agent = Agent(pwm, socket_path=args.socket, ttl=args.ttl)
+    pwm_agent.unlock(getpass.getpass('Enter your master password: '))
+    print('PWM_AGENT_SOCK=%s; export PWM_AGENT_SOCK;' % pwm_agent.socket_path)
+    sys.stdout.flush()
+    # Exit through serve_forever on SIGTERM too, so the socket gets cleaned up
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        pwm_agent.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
 def _get_pwm(cli_database):
-    default_database = os.path.join(os.path.expanduser('~'), '.pwm', 'db.sqlite')
-    database = cli_database or os.environ.get('PWM_DATABASE') or default_database
-    pwm = PWM(database_path=database)
+    from .core import PWM
+
+    pwm = PWM(_get_database(cli_database), index=True)
     return pwm
 
 
+def _get_database(cli_database):
+    default_database = os.path.join(os.path.expanduser('~'), '.pwm', 'db.sqlite')
+    return cli_database or os.environ.get('PWM_DATABASE') or default_database
+
+
+def _log_timings():
+    """ Log the time spent in each phase, as recorded by :mod:`pwm.metrics`. """
+    from .metrics import registry
+
+    summary = registry.summary()
+    if not summary:
+        return
+    _logger.debug('Time spent per phase:')
+    for name, labels, count, total in summary:
+        phase = name.replace('pwm_', '', 1).replace('_seconds', '')
+        if labels:
+            phase += ' (%s)' % ', '.join('%s=%s' % item for item in sorted(labels.items()))
+        _logger.debug('  %s: %.2fms in %d call%s', phase, total*1000, count,
+            '' if count == 1 else 's')
+
+
 def _init_logging(verbose=False):
-    """ Initialize loggers. """
-    config = {
-        'version': 1,
-        'formatters': {
-            'console': {
-                'format': '* %(message)s',
-            }
-        },
-        'handlers': {
-            'console': {
-                'class': 'logging.StreamHandler',
-                'level': 'DEBUG',
-                'formatter': 'console',
-                'stream': 'ext://sys.stdout',
-            }
-        },
-        'loggers': {
-            'pwm': {
-                'level': 'DEBUG' if verbose else 'INFO',
-                'handlers': ['console'],
-                'propagate': True,
-            },
-            'requests.packages.urllib3': {
-                'level': 'INFO' if verbose else 'WARNING',
-                'handlers': ['console'],
-                'propagate': True,
-            }
-        }
-    }
-    logging.config.dictConfig(config)
-    HTTPConnection.debuglevel = 1 if verbose else 0
+    """ Initialize loggers. Configured directly instead of through logging.config, which is slow to
+    import.
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setLevel(logging.DEBUG)
+    handler.setFormatter(logging.Formatter('* %(message)s'))
+
+    for logger_name, level in (
+            ('pwm', logging.DEBUG if verbose else logging.INFO),
+            ('requests.packages.urllib3', logging.INFO if verbose else logging.WARNING),
+            ):
+        logger = getLogger(logger_name)
+        logger.setLevel(level)
+        logger.addHandler(handler)
+        logger.propagate = True
+    if verbose:
+        get_http_connection_class().debuglevel = 1
@@ -1,16 +1,29 @@
 from . import encoding
-from .exceptions import DuplicateDomainException, NotReadyException, NoSuchDomainException
+from .cache import DomainCache
+# Key derivation lives in its own module, these are imported here for compatibility
+from .derive import (DEFAULT_MEMORY_BUDGET, DEFAULT_SCRYPT_PARAMS, DIGEST_SIZE,
+    DerivationScheduler, SCHEME_MASTER_KEY, SCHEME_SCRYPT, _derive_key, _derive_key_job,
+    _resolve_policy, _resolve_scrypt_params, _stream_key, _validate_scheme, calibrate_scrypt,
+    scheduler,
+    scrypt_memory_cost, stretch_master_password, validate_scrypt_params)
+from .metrics import instrument_engine, registry as metrics
+from .exceptions import (DuplicateDomainException, NotReadyException, NoSuchDomainException,
+    OutdatedDatabaseException)
+from .policy import Policy, get_policy
 
+import base64
+import collections
+import contextlib
 import decorator
 import getpass
+import json
 import math
 import os
-import requests
-import scrypt
 import sqlalchemy as sa
-import sys
+import threading
 import time
 import traceback
+import uuid
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from logging import getLogger
@@ -19,8 +32,90 @@ from logging import getLogger
 Base = declarative_base()
 _logger = getLogger('pwm.core')
 
+# Process-wide registry of engines, keyed by database URI, so that every PWM instance pointed at
+# the same database shares one connection pool
+_engines = {}
+_engines_lock = threading.Lock()
 
-class Domain(Base):
+
+class _DomainKeys(object):
+    """ The properties and key derivation of :class:`Domain`, shared with
+    :class:`DomainSnapshot`. Only reads the column values.
+    """
+    __slots__ = ()
+
+    DEFAULT_KEY_LENGTH = encoding.DEFAULT_KEY_LENGTH
+    DEFAULT_ALPHABET = encoding.DEFAULT_ALPHABET
+    DEFAULT_SCRYPT_PARAMS = DEFAULT_SCRYPT_PARAMS
+    DEFAULT_SCHEME = SCHEME_SCRYPT
+
+    @property
+    def entropy(self):
+        """ The entropy of keys for this domain, in bits. """
+        if self.policy:
+            entropy = self.key_policy.entropy(self.charset, self.key_length)
+        else:
+            # Characters appearing several times in the alphabet are proportionally more likely
+            counts = collections.Counter(self.charset)
+            entropy = -self.key_length*sum(count/float(len(self.charset))*
+                math.log(count/float(len(self.charset)), 2) for count in counts.values())
+        # Keys are encoded from a digest of this size, and can't be more random than it
+        return min(entropy, 8*DIGEST_SIZE)
+
+
+    @property
+    def key_policy(self):
+        """ The :class:`Policy <pwm.policy.Policy>` keys for this domain satisfy, or None. """
+        return get_policy(self.policy) if self.policy else None
+
+
+    @property
+    def scrypt_params(self):
+        """ The `(N, r, p)` parameters for scrypt used by this domain. """
+        default_n, default_r, default_p = self.DEFAULT_SCRYPT_PARAMS
+        return (self.scrypt_n or default_n, self.scrypt_r or default_r, self.scrypt_p or default_p)
+
+
+    @property
+    def derivation_scheme(self):
+        return self.scheme or SCHEME_SCRYPT
+
+
+    def derive_key(self, master_password, master_key=None):
+        """ Computes the key from the salt and the master password.
+
+        :param master_key: For domains using :data:`SCHEME_MASTER_KEY`, the result of
+            :func:`stretch_master_password <pwm.core.stretch_master_password>` for this domain, to
+            avoid stretching the master password again.
+        """
+        return _derive_key(master_password, *self._key_args(), master_key=master_key)
+
+
+    def stream_key(self, master_password, master_key=None):
+        """ Like :func:`Domain.derive_key <pwm.core.Domain.derive_key>`, but returns an iterator
+        over the key a few characters at a time, for keys too long to keep in memory at once, like
+        keyfiles. The master password is only stretched once, on the first iteration.
+        """
+        return _stream_key(master_password, *self._key_args(), master_key=master_key)
+
+
+    def _key_args(self):
+        """ The values :func:`_derive_key` needs besides the master password, as a picklable tuple.
+        """
+        return (self.name, self.salt, self.charset, self.key_length, self.scrypt_params,
+            self.derivation_scheme, self.master_salt, self.policy, self.key_stream)
+
+
+    def get_key(self):
+        """ Fetches the key for the domain. Prompts the user for password.
+
+        Thin wrapper around :func:`Domain.derive_key <pwm.core.Domain.derive_key>`.
+        """
+        master_password = getpass.getpass('Enter your master password: ')
+        return self.derive_key(master_password)
+
+
+class Domain(_DomainKeys, Base):
     """ Domain objects hold all the data for a given domain name.
 
     Domain names can in theory be anything, from user selected aliases to actual domain names like
@@ -32,10 +127,19 @@ class Domain(Base):
     :param alpabet: The alpabet to restrict key contents to. Default: 'full'
     :param key_length: The length of the computed key. Can be useful if the site imposes restrictions
         on password length. Default: 16
+    :param scrypt_n: The scrypt CPU/memory cost, a power of two. Default: 16384
+    :param scrypt_r: The scrypt block size. Default: 8
+    :param scrypt_p: The scrypt parallelization. Default: 1
+    :param scheme: How to derive keys, :data:`SCHEME_SCRYPT` or :data:`SCHEME_MASTER_KEY`.
+        Default: :data:`SCHEME_SCRYPT`
+    :param master_salt: The salt to stretch the master password with, required for
+        :data:`SCHEME_MASTER_KEY`.
+    :param policy: A :class:`Policy <pwm.policy.Policy>` keys must satisfy, or one saved with
+        :func:`Policy.dump <pwm.policy.Policy.dump>`. Default: None
+    :param key_stream: Whether keys longer than the digest can encode are continued with
+        SHAKE-256 output over the digest, instead of being cut short. Set for all new domains, the
+        keys the digest is long enough for are the same either way. Default: None
     """
-    DEFAULT_KEY_LENGTH = 16
-    DEFAULT_ALPHABET = 'full'
-
     __tablename__ = 'domain'
     id = sa.Column(sa.Integer, primary_key=True)
     name = sa.Column(sa.String(30), unique=True)
@@ -43,56 +147,167 @@ class Domain(Base):
     charset = sa.Column(sa.String(128))
     key_length = sa.Column(sa.Integer())
     username = sa.Column(sa.String(40))
+    # Null for domains created before the parameters were configurable, which use the defaults
+    scrypt_n = sa.Column(sa.Integer())
+    scrypt_r = sa.Column(sa.Integer())
+    scrypt_p = sa.Column(sa.Integer())
+    # Null for domains created before schemes were introduced, which use SCHEME_SCRYPT
+    scheme = sa.Column(sa.Integer())
+    master_salt = sa.Column(sa.LargeBinary(128))
+    # Null for domains without a policy, which encode the digest directly
+    policy = sa.Column(sa.String(255))
+    # Null for domains created before keys could be longer than the digest allows, which cut keys
+    # off where the digest runs out
+    key_stream = sa.Column(sa.Boolean())
+    # The value of the change counter of the database when the domain was last changed, so syncs
+    # can find what changed. Zero for domains last changed before changes were tracked
+    version = sa.Column(sa.Integer(), default=0, index=True)
+    # When the domain was last changed, in microseconds since the epoch. Copied by syncs, to keep
+    # the most recent of two conflicting changes. Null if unknown
+    updated_at = sa.Column(sa.BigInteger())
 
 
-    def __init__(self, alphabet=DEFAULT_ALPHABET, key_length=DEFAULT_KEY_LENGTH, **kwargs):
+    def __init__(self, alphabet=encoding.DEFAULT_ALPHABET, key_length=encoding.DEFAULT_KEY_LENGTH,
+            policy=None, **kwargs):
         if alphabet:
             self.charset = encoding.lookup_alphabet(alphabet)
-        super(Domain, self).__init__(key_length=key_length, **kwargs)
+        if isinstance(policy, Policy):
+            policy = policy.dump()
+        super(Domain, self).__init__(key_length=key_length, policy=policy, **kwargs)
         if not 'salt' in kwargs:
             self.new_salt()
 
 
-    @property
-    def entropy(self):
-        unique_chars = len(set(self.charset))
-        entropy = -math.log(1.0/(unique_chars**self.key_length), 2)
-        return entropy
-
-
     def new_salt(self):
         self.salt = os.urandom(32)
 
 
-    def derive_key(self, master_password):
-        """ Computes the key from the salt and the master password. """
-        encoder = encoding.Encoder(self.charset)
+    def __repr__(self): # pragma: no cover
+        return 'Domain(name=%s, salt=%s, charset=%s, key_length=%s)' \
+                % (self.name, self.salt, self.charset, self.key_length)
 
-        bytes = ('%s:%s' % (master_password, self.name)).encode('utf8')
 
-        start_time = time.clock()
-        # we fix the scrypt parameters in case the defaults change
-        digest = scrypt.hash(bytes, self.salt, N=1<<14, r=8, p=1)
+class Setting(Base):
+    """ Database-wide settings, like the defaults for new domains. """
+    __tablename__ = 'setting'
+    name = sa.Column(sa.String(64), primary_key=True)
+    value = sa.Column(sa.String(256))
 
-        key = encoder.encode(digest, self.key_length)
-        derivation_time_in_s = time.clock() - start_time
 
-        _logger.debug('Key derivation took %.2fms', derivation_time_in_s*1000)
-        return key
 
+def _get_master_salt(session):
+    """ Get the master salt of the database, creating it if it doesn't exist yet. Shared with
+    :class:`AsyncPWM <pwm.aio.AsyncPWM>`, like the other helpers taking a session.
+    """
+    setting = session.get(Setting, 'master_salt')
+    if setting is None:
+        setting = Setting(name='master_salt',
+            value=base64.b64encode(os.urandom(32)).decode('ascii'))
+        session.add(setting)
+    return base64.b64decode(setting.value)
 
-    def get_key(self):
-        """ Fetches the key for the domain. Prompts the user for password.
 
-        Thin wrapper around :func:`Domain.derive_key <pwm.core.Domain.derive_key>`.
-        """
-        master_password = getpass.getpass('Enter your master password: ')
-        return self.derive_key(master_password)
+def _get_scrypt_params(session):
+    """ Get the scrypt parameters new domains are created with. """
+    setting = session.get(Setting, 'scrypt_params')
+    if setting is None:
+        return Domain.DEFAULT_SCRYPT_PARAMS
+    return tuple(int(value) for value in setting.value.split(','))
 
 
-    def __repr__(self): # pragma: no cover
-        return 'Domain(name=%s, salt=%s, charset=%s, key_length=%s)' \
-                % (self.name, self.salt, self.charset, self.key_length)
+def _domain_row(domain):
+    """ Convert an exported domain dict to column values for the domain table, filling in defaults
+    for missing values. The values are checked like for
+    :func:`PWM.create_domain <pwm.core.PWM.create_domain>`.
+
+    :raises ValueError: If the record is invalid, naming it.
+    """
+    name = domain.get('name')
+    if not name:
+        raise ValueError('Domain record without a name: %r' % (domain,))
+    try:
+        salt = domain.get('salt')
+        master_salt = domain.get('master_salt')
+        row = {
+            'name': name,
+            'salt': base64.b64decode(salt) if salt else os.urandom(32),
+            'charset': domain.get('charset') or encoding.lookup_alphabet(Domain.DEFAULT_ALPHABET),
+            'key_length': domain.get('key_length') or Domain.DEFAULT_KEY_LENGTH,
+            'username': domain.get('username'),
+            'scrypt_n': domain.get('scrypt_n'),
+            'scrypt_r': domain.get('scrypt_r'),
+            'scrypt_p': domain.get('scrypt_p'),
+            'scheme': domain.get('scheme'),
+            'master_salt': base64.b64decode(master_salt) if master_salt else None,
+            'policy': domain.get('policy'),
+            'key_stream': domain.get('key_stream'),
+        }
+        # Missing parameters and schemes are stored as null, and mean the defaults
+        _resolve_scrypt_params((row['scrypt_n'], row['scrypt_r'], row['scrypt_p']),
+            Domain.DEFAULT_SCRYPT_PARAMS)
+        if row['scheme'] is not None:
+            _validate_scheme(row['scheme'])
+        if row['scheme'] == SCHEME_MASTER_KEY and not row['master_salt']:
+            raise ValueError('Missing master_salt')
+        row['policy'] = _resolve_policy(row['policy'], row['charset'], row['key_length'])
+    except (ValueError, TypeError) as ex:
+        raise ValueError('Invalid domain record %s: %s' % (name, ex))
+    return row
+
+
+class DomainSnapshot(_DomainKeys, collections.namedtuple('DomainSnapshot',
+        Domain.__table__.columns.keys())):
+    """ An immutable copy of a :class:`Domain`, like the ones :class:`PWM` returns from its cache.
+    Has the same attributes and derives the same keys, but can't be changed or saved.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_domain(cls, domain):
+        return cls._make(getattr(domain, field) for field in cls._fields)
+
+
+# The domain columns included in exports and REST responses
+_EXPORTED_COLUMNS = ('name', 'salt', 'charset', 'key_length', 'username', 'scrypt_n', 'scrypt_r',
+    'scrypt_p', 'scheme', 'master_salt', 'policy', 'key_stream')
+
+
+# The domain columns copied by syncs
+_SYNCED_COLUMNS = _EXPORTED_COLUMNS + ('updated_at',)
+
+
+def _chunks(names, size=500):
+    """ Split a list of names into chunks for querying with `IN (...)`, keeping the number of bound
+    parameters per query well below what sqlite allows.
+    """
+    for i in range(0, len(names), size):
+        yield names[i:i+size]
+
+
+def _existing_names(connection, names):
+    """ Get the set of `names` that domains already exist for, through a connection or session. """
+    table = Domain.__table__
+    existing = set()
+    for chunk in _chunks(names):
+        existing.update(connection.execute(sa.select(table.c.name).where(
+            table.c.name.in_(chunk))).scalars())
+    return existing
+
+
+def _exported_domains_query():
+    table = Domain.__table__
+    return sa.select(*[table.c[column] for column in _EXPORTED_COLUMNS])
+
+
+def _exported_domain(row):
+    """ Convert a row from :func:`_exported_domains_query` to a dict that can be serialized as
+    JSON, with the salts base64-encoded.
+    """
+    domain = dict(zip(_EXPORTED_COLUMNS, row))
+    for column in ('salt', 'master_salt'):
+        if domain[column] is not None:
+            domain[column] = base64.b64encode(domain[column]).decode('ascii')
+    return domain
 
 
 def _urify_db(path_or_uri):
@@ -107,19 +322,277 @@ def _urify_db(path_or_uri):
         return 'sqlite:///%s' % path_or_uri
 
 
+def _pool_args(database_uri, pool_size, max_overflow):
+    """ The arguments for creating an engine with the given pool limits. Empty unless the dialect
+    uses a queue pool, since other pools, like the one for in-memory SQLite databases, don't accept
+    them.
+    """
+    url = sa.engine.make_url(database_uri)
+    if not issubclass(url.get_dialect().get_pool_class(url), sa.pool.QueuePool):
+        return {}
+    engine_args = {}
+    if pool_size is not None:
+        engine_args['pool_size'] = pool_size
+    if max_overflow is not None:
+        engine_args['max_overflow'] = max_overflow
+    return engine_args
+
+
+def get_engine(database_uri, pool_size=None, max_overflow=None, check_schema=True):
+    """ Get the shared engine for the given database URI, creating it on first use.
+
+    :param database_uri: A SQLAlchemy-compatible connection URI.
+    :param pool_size: The number of connections to keep open in the pool. Only used when the
+        engine is created, and only for dialects that use a queue pool.
+    :param max_overflow: The number of connections to allow in excess of `pool_size`.
+    :param check_schema: Whether to check that the database doesn't need an upgrade when the engine
+        is created. Only reads the schema, so read-only databases can be used.
+    :raises OutdatedDatabaseException: If the database needs :func:`PWM.upgrade`.
+    """
+    with _engines_lock:
+        engine = _engines.get(database_uri)
+        if engine is None:
+            _logger.debug('Creating new engine for %s', database_uri)
+            engine = sa.create_engine(database_uri, **_pool_args(database_uri, pool_size,
+                max_overflow))
+            instrument_engine(engine)
+            if check_schema:
+                with engine.connect() as connection:
+                    outdated = _is_outdated(connection)
+                if outdated:
+                    engine.dispose()
+                    raise OutdatedDatabaseException('%s was created by an older version of pwm, '
+                        'run `pwm upgrade` first' % database_uri)
+            _engines[database_uri] = engine
+        return engine
+
+
+def _is_outdated(connection):
+    """ Whether a bootstrapped database lacks columns or tables that :func:`_upgrade_schema` adds.
+    Only reads the schema.
+    """
+    inspector = sa.inspect(connection)
+    if not inspector.has_table(Domain.__tablename__):
+        return False
+    existing_columns = set(column['name'] for column in inspector.get_columns('domain'))
+    if any(column.name not in existing_columns for column in Domain.__table__.columns):
+        return True
+    if not inspector.has_table(Setting.__tablename__):
+        return True
+    settings = Setting.__table__
+    return connection.execute(sa.select(settings.c.name)
+        .where(settings.c.name == 'change_counter')).first() is None
+
+
+def _upgrade_schema(connection):
+    """ Bring a database created by an older version of pwm up to date, by adding missing columns
+    and tables. Does nothing for databases that haven't been bootstrapped, and only writes what is
+    missing.
+    """
+    inspector = sa.inspect(connection)
+    if not inspector.has_table(Domain.__tablename__):
+        return
+    existing_columns = set(column['name'] for column in inspector.get_columns('domain'))
+    for column in Domain.__table__.columns:
+        if column.name not in existing_columns:
+            _logger.info('Adding column %s to the domain table', column.name)
+            connection.execute(sa.text('ALTER TABLE domain ADD COLUMN %s %s' % (column.name,
+                column.type.compile(connection.dialect))))
+            if column.name == 'version':
+                connection.execute(sa.text('UPDATE domain SET version = 0'))
+    for index in Domain.__table__.indexes:
+        index.create(connection, checkfirst=True)
+    Setting.__table__.create(connection, checkfirst=True)
+    _seed_change_counter(connection)
+
+
+def _seed_change_counter(connection):
+    """ Create the change counter of a bootstrapped database if it doesn't have one yet, starting at
+    the highest version of its domains.
+    """
+    settings = Setting.__table__
+    if connection.execute(sa.select(settings.c.name)
+            .where(settings.c.name == 'change_counter')).first() is None:
+        version = connection.execute(sa.select(sa.func.max(Domain.__table__.c.version))).scalar()
+        connection.execute(settings.insert().values(name='change_counter',
+            value=str(version or 0)))
+
+
+def _next_version(connection):
+    """ Increment the change counter of the database, for versioning the domains changed in the
+    transaction of `connection`, which can also be a session. The counter stays locked until the
+    transaction ends on databases that support it, so versions are committed in increasing order and
+    a sync never skips past one that is still uncommitted.
+
+    The counter is created with the database, so this only ever updates it, and concurrent writers
+    wait for each other instead of racing to create it.
+    """
+    settings = Setting.__table__
+    counter = settings.c.name == 'change_counter'
+    connection.execute(settings.update().where(counter)
+        .values(value=sa.cast(sa.cast(settings.c.value, sa.Integer) + 1, sa.String)))
+    return int(connection.execute(sa.select(settings.c.value).where(counter)).scalar())
+
+
+def _stamp_changes(connection, rows, synced=False):
+    """ Mark `rows`, domains or dicts of their columns, as changed in the transaction of
+    `connection`, with the next version and the current time. Rows `synced` from another database
+    keep the time they were changed there.
+    """
+    stamp = {'version': _next_version(connection)}
+    if not synced:
+        stamp['updated_at'] = _now()
+    for row in rows:
+        if isinstance(row, dict):
+            row.update(stamp)
+        else:
+            for column, value in stamp.items():
+                setattr(row, column, value)
+
+
+def _after_watermark(watermark):
+    """ Filter domains changed after those a sync has come to, by version and then id. """
+    table = Domain.__table__
+    return sa.or_(table.c.version > watermark['version'], sa.and_(
+        table.c.version == watermark['version'], table.c.id > watermark['id']))
+
+
+def _now():
+    """ The current time in microseconds since the epoch, for :attr:`Domain.updated_at`. """
+    return int(time.time()*1e6)
+
+
+def _sync_order(values):
+    """ Order two versions of a domain, with the most recently changed one last. Versions changed
+    at the same time are ordered by their values, so that either database picks the same one.
+    """
+    return (values['updated_at'] or 0, repr(sorted(values.items())))
+
+
+def dispose_engine(database_uri):
+    """ Close all pooled connections for the given URI and drop it from the registry. """
+    with _engines_lock:
+        engine = _engines.pop(database_uri, None)
+    if engine is not None:
+        _logger.debug('Disposing engine for %s', database_uri)
+        engine.dispose()
+
+
+# Trigram indexes can't serve queries shorter than this
+_TRIGRAM_LENGTH = 3
+
+_FTS_INDEX_EXISTS = "SELECT 1 FROM sqlite_master WHERE name = 'domain_search'"
+
+_SQLITE_SEARCH_INDEX = [
+    "CREATE VIRTUAL TABLE domain_search USING fts5(name, tokenize='trigram', content='domain', "
+        "content_rowid='id')",
+    "CREATE TRIGGER domain_search_insert AFTER INSERT ON domain BEGIN "
+        "INSERT INTO domain_search(rowid, name) VALUES (new.id, new.name); END",
+    "CREATE TRIGGER domain_search_delete AFTER DELETE ON domain BEGIN "
+        "INSERT INTO domain_search(domain_search, rowid, name) VALUES ('delete', old.id, old.name); "
+        "END",
+    "CREATE TRIGGER domain_search_update AFTER UPDATE OF name ON domain BEGIN "
+        "INSERT INTO domain_search(domain_search, rowid, name) VALUES ('delete', old.id, old.name); "
+        "INSERT INTO domain_search(rowid, name) VALUES (new.id, new.name); END",
+    # Index any domains that existed before the index was created
+    "INSERT INTO domain_search(domain_search) VALUES ('rebuild')",
+]
+
+_POSTGRESQL_SEARCH_INDEX = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS ix_domain_name_trgm ON domain USING gin (name gin_trgm_ops)',
+]
+
+
+def _create_search_index(engine):
+    """ Create an index that can serve substring searches on domain names, for the databases that
+    support it. On SQLite this is a FTS5 trigram table kept in sync with triggers, on PostgreSQL a
+    pg_trgm GIN index. Other databases get no index, and searches scan the domain table.
+    """
+    dialect = engine.dialect.name
+    if dialect == 'sqlite':
+        with engine.begin() as connection:
+            exists = connection.execute(sa.text(_FTS_INDEX_EXISTS)).first()
+        if exists:
+            return
+        statements = _SQLITE_SEARCH_INDEX
+    elif dialect == 'postgresql':
+        statements = _POSTGRESQL_SEARCH_INDEX
+    else:
+        _logger.debug('No search index available for %s, searches will scan all domains', dialect)
+        return
+
+    try:
+        with engine.begin() as connection:
+            for statement in statements:
+                connection.execute(sa.text(statement))
+    except sa.exc.DBAPIError as ex:
+        # Happens if sqlite is built without FTS5 or the trigram tokenizer, or if we're not
+        # allowed to create the postgres extension
+        _logger.warning('Could not create search index, searches will scan all domains: %s', ex)
+
+
+def _search_filter(query, use_fts_index=False):
+    """ Build the condition for domains matching a search query. """
+    if len(query) >= _TRIGRAM_LENGTH and use_fts_index:
+        phrase = '"%s"' % query.replace('"', '""')
+        matches = sa.select(sa.literal_column('rowid')) \
+            .select_from(sa.table('domain_search')) \
+            .where(sa.text('domain_search MATCH :phrase').bindparams(phrase=phrase))
+        return Domain.id.in_(matches)
+    return Domain.name.ilike('%%%s%%' % query)
+
+
+def _search_statement(query, limit=None, rank=False, use_fts_index=False):
+    """ Build the select for :func:`PWM.search <pwm.core.PWM.search>`. """
+    statement = sa.select(Domain).where(_search_filter(query, use_fts_index))
+
+    if rank:
+        relevance = sa.case(
+            (sa.func.lower(Domain.name) == query.lower(), 0),
+            (Domain.name.ilike('%s%%' % query), 1),
+            else_=2)
+        statement = statement.order_by(relevance, sa.func.length(Domain.name), Domain.name)
+    else:
+        statement = statement.order_by(Domain.name)
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement
+
 
 @decorator.decorator
 def _uses_db(func, self, *args, **kwargs):
     """ Use as a decorator for operations on the database, to ensure connection setup and
-    teardown. Can only be used on methods on objects with a `self.session` attribute.
+    teardown. Can only be used on methods on :class:`PWM` objects.
+
+    The time spent setting up the session, executing the operation and committing is recorded as
+    `pwm_db_seconds`, see :mod:`pwm.metrics`.
+
+    Inside :func:`PWM.transaction <pwm.core.PWM.transaction>` the operation joins the session of
+    the transaction and is only flushed, leaving the commit to the transaction.
     """
+    operation = func.__name__.lstrip('_')
+    if self._transaction_depth:
+        try:
+            with metrics.timer('pwm_db_seconds', operation=operation, phase='execute'):
+                ret = func(self, *args, **kwargs)
+                # Surface errors like duplicate names here, not when committing
+                self.session.flush()
+        except:
+            metrics.increment('pwm_db_errors_total', operation=operation)
+            raise
+        return ret
     if not self.session:
         _logger.debug('Creating new db session')
-        self._init_db_session()
+        with metrics.timer('pwm_db_seconds', operation=operation, phase='setup'):
+            self._init_db_session()
     try:
-        ret = func(self, *args, **kwargs)
-        self.session.commit()
+        with metrics.timer('pwm_db_seconds', operation=operation, phase='execute'):
+            ret = func(self, *args, **kwargs)
+        with metrics.timer('pwm_db_seconds', operation=operation, phase='commit'):
+            self.session.commit()
     except:
+        metrics.increment('pwm_db_errors_total', operation=operation)
         self.session.rollback()
         tb = traceback.format_exc()
         _logger.debug(tb)
@@ -137,11 +610,44 @@ class PWM(object):
         URI, like `postgresql://user:pw@host/db`. If not given or None,
         :func:`PWM.bootstrap <pwm.core.PWM.bootstrap` must be called before doing any operations
         that operate on the database.
+    :param pool_size: The number of pooled connections to keep open to the database. Engines are
+        shared between all PWM instances using the same URI, so this only has effect for the first
+        instance connecting to a given database.
+    :param max_overflow: The number of connections to allow in excess of `pool_size`.
+    :param config: Settings for databases served over HTTP(S), see
+        :class:`RestClient <pwm.rest.RestClient>` for the supported keys.
+    :param cache_size: If given, keep up to this many domains looked up with
+        :func:`PWM.get_domain <pwm.core.PWM.get_domain>` and
+        :func:`PWM.get_domains <pwm.core.PWM.get_domains>` in memory, in :attr:`cache`. Domains
+        created or modified through this instance are invalidated right away, changes made by
+        other processes are only seen once the entry expires. Lookups through the cache return
+        shared, immutable :class:`DomainSnapshot` objects instead of :class:`Domain` objects.
+    :param cache_ttl: Seconds to keep domains in the cache for. Default: Until evicted.
+    :param index: Whether to keep an :mod:`index <pwm.index>` of a SQLite database beside it,
+        rewriting it on the first lookup through this instance after the database changed, so
+        writes don't pay for it. Lets `pwm get` look up domains without loading the database stack.
     """
 
-    def __init__(self, database_uri=None):
+    def __init__(self, database_uri=None, pool_size=None, max_overflow=None, config=None,
+            cache_size=None, cache_ttl=None, index=False):
         self.session = None
         self.database_uri = _urify_db(database_uri) if database_uri else None
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.config = config or {}
+        self._rest_client = None
+        self._has_fts_index = None
+        self._change_listeners = []
+        self._transaction_depth = 0
+        self._pending_changes = []
+        self.index = index
+        # The fingerprint of the database when the index was last found up to date
+        self._index_fingerprint = None
+        #: The :class:`DomainCache <pwm.cache.DomainCache>` of looked up domains, or None if
+        #: caching is disabled.
+        self.cache = None
+        if cache_size:
+            self.cache = DomainCache(cache_ttl, cache_size)
 
 
     def bootstrap(self, path_or_uri):
@@ -150,62 +656,135 @@ class PWM(object):
         :param database_path: The absolute path to the database to initialize.
         """
         _logger.debug("Bootstrapping new database: %s", path_or_uri)
+        self.close()
         self.database_uri = _urify_db(path_or_uri)
-        db = sa.create_engine(self.database_uri)
-        Base.metadata.create_all(db)
+        self._has_fts_index = None
+        if self.cache is not None:
+            self.cache.clear()
+        engine = self._get_engine(check_schema=False)
+        Base.metadata.create_all(engine)
+        with engine.begin() as connection:
+            _upgrade_schema(connection)
+        _create_search_index(engine)
+
+
+    def upgrade(self):
+        """ Bring a database created by an older version of pwm up to date, by adding the columns
+        and tables it lacks. Outdated databases can't be used until they are upgraded, and raise
+        :class:`OutdatedDatabaseException <pwm.exceptions.OutdatedDatabaseException>`.
+
+        :returns: Whether the database had to be changed.
+        """
+        if self._uses_rest_api():
+            raise ValueError("Can't upgrade databases served over HTTP(S)")
+        self.close()
+        with self._get_engine(check_schema=False).begin() as connection:
+            if not _is_outdated(connection):
+                return False
+            _logger.info('Upgrading %s', self.database_uri)
+            _upgrade_schema(connection)
+        _create_search_index(self._get_engine())
+        return True
+
+
+    def search(self, query, limit=None, rank=False):
+        """ Search the database for the given query. Will find partial matches.
+
+        Uses the substring index created by :func:`PWM.bootstrap <pwm.core.PWM.bootstrap>` where
+        the database supports it, and falls back to scanning all names otherwise. Databases served
+        over HTTP(S) are searched by the server.
+
+        :param query: The string to search for, case insensitive.
+        :param limit: If given, return at most this many results.
+        :param rank: If True, order results by relevance, with exact matches first, then names
+            starting with the query, then the shortest names. Otherwise results are ordered by name.
+        :returns: A list of matching :class:`Domain <pwm.core.Domain>` objects.
+        """
+        if self._uses_rest_api():
+            return [Domain(**values) for values in self._get_rest_client().search(query, limit,
+                rank)]
+        return self._search_db(query, limit, rank)
 
 
     @_uses_db
-    def search(self, query):
-        """ Search the database for the given query. Will find partial matches. """
-        results = self.session.query(Domain).filter(Domain.name.ilike('%%%s%%' % query)).all()
-        return results
+    def _search_db(self, query, limit, rank):
+        statement = _search_statement(query, limit, rank, self._uses_fts_index())
+        return self.session.execute(statement).scalars().all()
+
+
+    def count(self, query=None):
+        """ Count the domains, or the domains matching `query`, without loading them.
+
+        :param query: Only count the domains that :func:`PWM.search <pwm.core.PWM.search>` would
+            find for this query.
+        :raises ValueError: For databases served over HTTP(S).
+        """
+        if self._uses_rest_api():
+            raise ValueError("Can't count the domains of databases served over HTTP(S)")
+        return self._count(query)
 
 
     @_uses_db
+    def _count(self, query):
+        matches = _search_filter(query, self._uses_fts_index()) if query else sa.true()
+        return self.session.execute(sa.select(sa.func.count()).select_from(Domain.__table__)
+            .where(matches)).scalar()
+
+
+    def _uses_fts_index(self):
+        if self._has_fts_index is None:
+            engine = self._get_engine()
+            self._has_fts_index = False
+            if engine.dialect.name == 'sqlite':
+                with engine.connect() as connection:
+                    self._has_fts_index = connection.execute(sa.text(_FTS_INDEX_EXISTS)
+                        ).first() is not None
+        return self._has_fts_index
+
+
     def get_domain(self, domain_name):
         """ Get the :class:`Domain <pwm.Domain>` object from a name.
 
         :param domain_name: The domain name to fetch the object for.
-        :returns: The :class:`Domain <pwm.core.Domain>` class with this domain_name if found, else
-            None.
+        :returns: The :class:`Domain <pwm.core.Domain>` class with this domain_name.
+        :raises NoSuchDomainException: If the domain doesn't exist.
         """
-        protocol = self.database_uri.split(':', 1)[0]
-        if protocol in ('https', 'http'):
+        if self._uses_rest_api():
             return self._get_domain_from_rest_api(domain_name)
+        self._refresh_index()
+        if self.cache is None:
+            return self._get_existing_domain_from_db(domain_name)
+        domain = self._get_domains_through_cache([domain_name]).get(domain_name)
+        if domain is None:
+            raise NoSuchDomainException
+        return domain
+
+
+    @_uses_db
+    def _get_existing_domain_from_db(self, domain_name):
+        domain = self._get_domain_from_db(domain_name)
+        if domain:
+            return domain
         else:
-            domain = self._get_domain_from_db(domain_name)
-            if domain:
-                return domain
-            else:
-                raise NoSuchDomainException
+            raise NoSuchDomainException
+
+
+    def _uses_rest_api(self):
+        if not self.database_uri:
+            return False
+        protocol = self.database_uri.split(':', 1)[0]
+        return protocol in ('https', 'http')
+
+
+    def _get_rest_client(self):
+        if self._rest_client is None:
+            from .rest import RestClient
+            self._rest_client = RestClient(self.database_uri, self.config)
+        return self._rest_client
 
 
     def _get_domain_from_rest_api(self, domain):
-        request_args = {
-            'params': {'domain': domain}
-        }
-        verify = True
-        server_certificate = self.config.get('server_certificate')
-        if server_certificate:
-            verify = os.path.join(os.path.dirname(server_certificate), server_certificate)
-            _logger.debug('Pinning server with certificate at %s', verify)
-
-        # Test for SNI support on python 2
-        if sys.version_info < (3, 0, 0):
-            try:
-                import urllib3.contrib.pyopenssl
-                urllib3.contrib.pyopenssl.inject_into_urllib3()
-            except ImportError:
-                _logger.warning("Running on python 2 without SNI support, can't verify server certificates.")
-                verify = False
-        request_args['verify'] = verify
-
-        if self.config.get('auth'):
-            request_args['cert'] = self.config['auth']
-        response = requests.get(self.config['database'] + '/get', **request_args)
-        domain = Domain(name=domain, salt=response.json()['salt'])
-        return domain
+        return Domain(**self._get_rest_client().get_domain(domain))
 
 
     def _get_domain_from_db(self, domain_name):
@@ -213,7 +792,129 @@ class PWM(object):
         return domain
 
 
+    def get_domains(self, domain_names):
+        """ Get the :class:`Domain <pwm.Domain>` objects for several names at once.
+
+        :param domain_names: An iterable of domain names to fetch.
+        :returns: A list of :class:`Domain <pwm.core.Domain>` objects, in the same order as the
+            names were given.
+        :raises NoSuchDomainException: If any of the domains doesn't exist.
+        """
+        domain_names = list(domain_names)
+        found = self._find_domains(domain_names)
+        missing = [name for name in domain_names if name not in found]
+        if missing:
+            raise NoSuchDomainException(', '.join(missing))
+        return [found[name] for name in domain_names]
+
+
+    def _find_domains(self, domain_names):
+        """ Look up the domains that exist of `domain_names`.
+
+        :returns: A dict from name to :class:`Domain <pwm.core.Domain>`.
+        """
+        if self._uses_rest_api():
+            found = self._get_rest_client().get_domains(domain_names)
+            return dict((name, Domain(**values)) for name, values in found.items())
+        self._refresh_index()
+        if self.cache is None:
+            return self._get_domains_from_db(domain_names)
+        return self._get_domains_through_cache(domain_names)
+
+
+    def _get_domains_through_cache(self, domain_names):
+        domains = {}
+        missing = []
+        for name in domain_names:
+            snapshot = self.cache.get(name)
+            if snapshot is None:
+                missing.append(name)
+            else:
+                domains[name] = snapshot
+        if len(missing) < len(domain_names):
+            metrics.increment('pwm_domain_cache_total', len(domain_names) - len(missing),
+                result='hit')
+        if missing:
+            metrics.increment('pwm_domain_cache_total', len(missing), result='miss')
+            # Fetched before querying, so domains changed meanwhile aren't cached
+            generation = self.cache.generation
+            for domain in self._get_domains_from_db(missing).values():
+                snapshot = DomainSnapshot.from_domain(domain)
+                self.cache.put(domain.name, snapshot, generation)
+                domains[domain.name] = snapshot
+        return domains
+
+
     @_uses_db
+    def _get_domains_from_db(self, domain_names):
+        domains = {}
+        for chunk in _chunks(domain_names):
+            for domain in self.session.query(Domain).filter(Domain.name.in_(chunk)):
+                domains[domain.name] = domain
+        return domains
+
+
+    def derive_keys(self, domain_names, master_password, workers=None, ordered=True):
+        """ Derive keys for several domains, spreading the work over a pool of processes.
+
+        Keys are identical to what :func:`Domain.derive_key <pwm.core.Domain.derive_key>` would
+        return for each domain. Domains using :data:`SCHEME_MASTER_KEY` share a single stretch of
+        the master password, and only the domains using :data:`SCHEME_SCRYPT` are worth spreading
+        over processes.
+
+        :param domain_names: An iterable of domain names to derive keys for.
+        :param master_password: The master password to derive keys from.
+        :param workers: The number of worker processes to use. Defaults to the number of CPUs.
+            Capped by what the memory budget of the :data:`scheduler` allows for the most
+            expensive domain, since every worker process has a scheduler of its own.
+        :param ordered: Whether to yield results in the order the names were given. If False,
+            results are yielded as soon as they are ready.
+        :returns: A generator of `(domain_name, key)` tuples.
+        """
+        import multiprocessing
+
+        domains = self.get_domains(domain_names)
+        master_keys = {}
+        jobs = []
+        expensive_domains = []
+        for domain in domains:
+            master_key = None
+            if domain.derivation_scheme == SCHEME_MASTER_KEY:
+                stretch_args = (domain.master_salt, domain.scrypt_params)
+                if stretch_args not in master_keys:
+                    master_keys[stretch_args] = stretch_master_password(master_password,
+                        *stretch_args)
+                master_key = master_keys[stretch_args]
+            else:
+                expensive_domains.append(domain)
+            jobs.append((master_password, domain._key_args(), master_key))
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if expensive_domains:
+            max_cost = max(scrypt_memory_cost(domain.scrypt_params)
+                for domain in expensive_domains)
+            workers = min(workers, scheduler.max_parallel(max_cost))
+        workers = min(workers, len(expensive_domains))
+        if workers <= 1:
+            for job in jobs:
+                yield _derive_key_job(job)
+            return
+
+        _logger.debug('Deriving %d keys with %d workers', len(jobs), workers)
+        pool = multiprocessing.Pool(workers)
+        try:
+            imap = pool.imap if ordered else pool.imap_unordered
+            for result in imap(_derive_key_job, jobs):
+                yield result
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+
     def modify_domain(self, domain_name, new_salt=False, username=None):
         """ Modify an existing domain.
 
@@ -222,6 +923,13 @@ class PWM(object):
         :param username: If given, change domain username to this value.
         :returns: The modified :class:`Domain <pwm.core.Domain>` object.
         """
+        domain = self._modify_domain(domain_name, new_salt, username)
+        self._notify_changes([domain_name])
+        return domain
+
+
+    @_uses_db
+    def _modify_domain(self, domain_name, new_salt, username):
         domain = self._get_domain_from_db(domain_name)
         if domain is None:
             raise NoSuchDomainException
@@ -230,36 +938,598 @@ class PWM(object):
             domain.new_salt()
         if username is not None:
             domain.username = username
+        _stamp_changes(self.session, [domain])
         return domain
 
 
     def create_domain(self, domain_name, username=None, alphabet=Domain.DEFAULT_ALPHABET,
-            length=Domain.DEFAULT_KEY_LENGTH):
+            length=Domain.DEFAULT_KEY_LENGTH, scrypt_n=None, scrypt_r=None, scrypt_p=None,
+            scheme=Domain.DEFAULT_SCHEME, policy=None):
         """ Create a new domain entry in the database.
 
         :param username: The username to associate with this domain.
         :param alphabet: A character set restriction to impose on keys generated for this domain.
         :param length: The length of the generated key, in case of restrictions on the site.
+        :param scrypt_n: The scrypt CPU/memory cost for deriving keys for this domain. Defaults to
+            the value set with :func:`PWM.set_scrypt_params <pwm.core.PWM.set_scrypt_params>`.
+        :param scrypt_r: The scrypt block size, with the same default.
+        :param scrypt_p: The scrypt parallelization, with the same default.
+        :param scheme: How to derive keys for this domain, :data:`SCHEME_SCRYPT` or
+            :data:`SCHEME_MASTER_KEY`. Domains using the latter share a master salt, created
+            when the first such domain is.
+        :param policy: A :class:`Policy <pwm.policy.Policy>` keys for this domain must satisfy,
+            like requiring a digit and a symbol.
+        :raises ValueError: If the scrypt parameters or the scheme are invalid, or the policy can't
+            be satisfied.
         """
+        _validate_scheme(scheme)
+        policy = _resolve_policy(policy, alphabet, length)
+        scrypt_params = (scrypt_n, scrypt_r, scrypt_p)
+        defaults = self.get_scrypt_params() if None in scrypt_params else scrypt_params
+        scrypt_params = _resolve_scrypt_params(scrypt_params, defaults)
         # Wrap the actual implementation to do some error handling
         try:
-            return self._create_domain(domain_name, username, alphabet, length)
+            domain = self._create_domain(domain_name, username, alphabet, length, scrypt_params,
+                scheme, policy)
         except Exception as ex:
-            _logger.warn("Inserting new domain failed: %s", ex)
+            _logger.warning("Inserting new domain failed: %s", ex)
             raise DuplicateDomainException
+        self._notify_changes([domain_name])
+        return domain
 
 
     @_uses_db
-    def _create_domain(self, domain_name, username, alphabet, length):
+    def _create_domain(self, domain_name, username, alphabet, length, scrypt_params, scheme,
+            policy):
+        scrypt_n, scrypt_r, scrypt_p = scrypt_params
+        master_salt = _get_master_salt(self.session) if scheme == SCHEME_MASTER_KEY else None
         domain = Domain(name=domain_name, username=username, key_length=length,
-            alphabet=alphabet)
+            alphabet=alphabet, scrypt_n=scrypt_n, scrypt_r=scrypt_r, scrypt_p=scrypt_p,
+            scheme=scheme, master_salt=master_salt, policy=policy, key_stream=True)
+        _stamp_changes(self.session, [domain])
         self.session.add(domain)
         return domain
 
 
+    def create_domains(self, specs):
+        """ Create many domains at once, in a single transaction.
+
+        Names that already exist are found with one query per 500 names, and the new domains are
+        inserted with a single executemany, which is much faster than calling
+        :func:`PWM.create_domain <pwm.core.PWM.create_domain>` for each.
+
+        :param specs: An iterable of dicts with the `name` of each domain, and optionally any of
+            `username`, `alphabet`, `length`, `scrypt_n`, `scrypt_r`, `scrypt_p`, `scheme` and
+            `policy`, with the same defaults as for
+            :func:`PWM.create_domain <pwm.core.PWM.create_domain>`.
+        :returns: A list of `(name, result, error)` tuples in the order the specs were given,
+            where `result` is `'created'`, `'duplicate'` if the name already exists or appeared
+            earlier in the specs, or `'error'` if the spec is invalid, explained by `error`.
+        :raises DuplicateDomainException: If another process created one of the domains at the
+            same time. Nothing is created then.
+        """
+        try:
+            results = self._create_domains(list(specs))
+        except sa.exc.IntegrityError as ex:
+            _logger.warning('Inserting new domains failed: %s', ex)
+            raise DuplicateDomainException()
+        self._notify_changes([name for name, result, _ in results if result == 'created'])
+        return results
+
+
+    @_uses_db
+    def _create_domains(self, specs):
+        table = Domain.__table__
+        existing = _existing_names(self.session,
+            [spec.get('name') for spec in specs if spec.get('name')])
+
+        default_scrypt_params = _get_scrypt_params(self.session)
+        master_salt = None
+        salts = os.urandom(32*len(specs))
+        results = []
+        rows = []
+        for i, spec in enumerate(specs):
+            name = spec.get('name')
+            if not name:
+                results.append((name, 'error', 'Missing name'))
+                continue
+            if name in existing:
+                results.append((name, 'duplicate', None))
+                continue
+            scheme = spec.get('scheme', Domain.DEFAULT_SCHEME)
+            alphabet = spec.get('alphabet', Domain.DEFAULT_ALPHABET)
+            length = spec.get('length', Domain.DEFAULT_KEY_LENGTH)
+            try:
+                _validate_scheme(scheme)
+                scrypt_n, scrypt_r, scrypt_p = _resolve_scrypt_params((spec.get('scrypt_n'),
+                    spec.get('scrypt_r'), spec.get('scrypt_p')), default_scrypt_params)
+                policy = _resolve_policy(spec.get('policy'), alphabet, length)
+            except ValueError as ex:
+                results.append((name, 'error', str(ex)))
+                continue
+            if scheme == SCHEME_MASTER_KEY and master_salt is None:
+                master_salt = _get_master_salt(self.session)
+            existing.add(name)
+            rows.append({
+                'name': name,
+                'salt': salts[32*i:32*(i + 1)],
+                'charset': encoding.lookup_alphabet(alphabet),
+                'key_length': length,
+                'username': spec.get('username'),
+                'scrypt_n': scrypt_n,
+                'scrypt_r': scrypt_r,
+                'scrypt_p': scrypt_p,
+                'scheme': scheme,
+                'master_salt': master_salt if scheme == SCHEME_MASTER_KEY else None,
+                'policy': policy,
+                'key_stream': True,
+            })
+            results.append((name, 'created', None))
+        if rows:
+            _stamp_changes(self.session, rows)
+            self.session.execute(table.insert(), rows)
+        return results
+
+
+    @_uses_db
+    def get_scrypt_params(self):
+        """ Get the scrypt parameters new domains are created with.
+
+        :returns: A tuple `(N, r, p)`.
+        """
+        return _get_scrypt_params(self.session)
+
+
+    @_uses_db
+    def set_scrypt_params(self, scrypt_params):
+        """ Set the scrypt parameters new domains are created with. Existing domains keep theirs.
+        See :func:`calibrate_scrypt <pwm.core.calibrate_scrypt>` for finding suitable values.
+
+        :param scrypt_params: A tuple `(N, r, p)`.
+        :raises ValueError: If the parameters are invalid.
+        """
+        validate_scrypt_params(scrypt_params)
+        self.session.merge(Setting(name='scrypt_params',
+            value=','.join(str(value) for value in scrypt_params)))
+
+
+    def export_domains(self):
+        """ Stream all domains out of the database, without loading them all into memory at once.
+
+        :returns: A generator of dicts with the keys `name`, `salt` (base64-encoded), `charset`,
+            `key_length`, `username`, `scrypt_n`, `scrypt_r`, `scrypt_p`, `scheme`, `master_salt`
+            (base64-encoded), `policy` and `key_stream`, suitable for serializing as JSON and
+            passing to :func:`PWM.import_domains <pwm.core.PWM.import_domains>`.
+        """
+        if not self.database_uri:
+            raise NotReadyException()
+        query = _exported_domains_query().order_by(Domain.__table__.c.id)
+        with self._get_engine().connect() as connection:
+            rows = connection.execution_options(stream_results=True).execute(query)
+            for row in rows:
+                yield _exported_domain(row)
+
+
+    def import_domains(self, domains, batch_size=5000):
+        """ Insert domains in batches, skipping domains that already exist.
+
+        Each batch is checked for existing names with a single query and inserted with one
+        executemany in its own transaction, so memory use is bounded by the batch size.
+
+        :param domains: An iterable of dicts like the ones from
+            :func:`PWM.export_domains <pwm.core.PWM.export_domains>`. Only `name` is required, a new
+            salt is generated if none is given.
+        :param batch_size: The number of domains to insert per transaction.
+        :returns: A tuple `(created, duplicates)` with the number of domains inserted and skipped.
+        :raises ValueError: If a record is invalid, like without a name or with invalid scrypt
+            parameters. The batches before it stay imported.
+        """
+        if not self.database_uri:
+            raise NotReadyException()
+        created = duplicates = 0
+        batch = []
+        for domain in domains:
+            batch.append(domain)
+            if len(batch) >= batch_size:
+                batch_created, batch_duplicates = self._import_batch(batch)
+                created += batch_created
+                duplicates += batch_duplicates
+                batch = []
+        if batch:
+            batch_created, batch_duplicates = self._import_batch(batch)
+            created += batch_created
+            duplicates += batch_duplicates
+        _logger.debug('Imported %d domains, skipped %d duplicates', created, duplicates)
+        return created, duplicates
+
+
+    def _import_batch(self, batch):
+        table = Domain.__table__
+        # Checked before writing anything, so a bad record doesn't leave half a batch behind
+        batch = [_domain_row(domain) for domain in batch]
+        with self._get_engine().begin() as connection:
+            existing = _existing_names(connection, [row['name'] for row in batch])
+
+            rows = []
+            for row in batch:
+                if row['name'] in existing:
+                    _logger.debug('Skipping existing domain %s', row['name'])
+                    continue
+                # Also catches duplicates within the batch
+                existing.add(row['name'])
+                rows.append(row)
+            if rows:
+                _stamp_changes(connection, rows)
+                connection.execute(table.insert(), rows)
+        return len(rows), len(batch) - len(rows)
+
+
+    def rotate_salts(self, query=None, chunk_size=1000, progress=None):
+        """ Give new salts to all domains, or the domains matching `query`, changing all their keys.
+
+        Domains are rotated in order of creation, `chunk_size` at a time, with each chunk committed
+        in a transaction of its own together with how far the rotation has come. If interrupted,
+        calling this again with the same `query` continues where the rotation stopped, without
+        rotating any domain twice. Starting a rotation with another query abandons the unfinished
+        one. Domains created while rotating are rotated too.
+
+        :param query: Only rotate the domains that :func:`PWM.search <pwm.core.PWM.search>` would
+            find for this query.
+        :param chunk_size: The number of domains to rotate per transaction.
+        :param progress: Called as `progress(rotated, total)` after every chunk, with the number of
+            domains rotated by this rotation so far, including before an interruption, and the
+            total number to rotate.
+        :returns: The number of domains rotated by this call.
+        :raises ValueError: For databases served over HTTP(S).
+        """
+        if not self.database_uri:
+            raise NotReadyException()
+        if self._uses_rest_api():
+            raise ValueError("Can't rotate the salts of databases served over HTTP(S)")
+        table = Domain.__table__
+        settings = Setting.__table__
+        matches = _search_filter(query, self._uses_fts_index()) if query else sa.true()
+        engine = self._get_engine()
+
+        with engine.connect() as connection:
+            stored = connection.execute(sa.select(settings.c.value).where(
+                settings.c.name == 'salt_rotation')).scalar()
+            checkpoint = json.loads(stored) if stored else None
+            if checkpoint and checkpoint['query'] == query:
+                _logger.info('Resuming salt rotation after %d domains', checkpoint['rotated'])
+            else:
+                if checkpoint:
+                    _logger.warning('Abandoning unfinished salt rotation of %r',
+                        checkpoint['query'])
+                checkpoint = {'query': query, 'last_id': 0, 'rotated': 0}
+            remaining = connection.execute(sa.select(sa.func.count()).select_from(table)
+                .where(matches, table.c.id > checkpoint['last_id'])).scalar()
+        total = checkpoint['rotated'] + remaining
+
+        # The columns to set are the ones in the parameters
+        update = table.update().where(table.c.id == sa.bindparam('domain_id'))
+        rotated = 0
+        while True:
+            with engine.begin() as connection:
+                rows = connection.execute(sa.select(table.c.id, table.c.name)
+                    .where(matches, table.c.id > checkpoint['last_id'])
+                    .order_by(table.c.id).limit(chunk_size)).all()
+                connection.execute(settings.delete().where(settings.c.name == 'salt_rotation'))
+                if not rows:
+                    break
+                salts = os.urandom(32*len(rows))
+                params = [{'domain_id': row.id, 'salt': salts[32*i:32*(i+1)]}
+                    for i, row in enumerate(rows)]
+                _stamp_changes(connection, params)
+                connection.execute(update, params)
+                checkpoint['last_id'] = rows[-1].id
+                checkpoint['rotated'] += len(rows)
+                connection.execute(settings.insert().values(name='salt_rotation',
+                    value=json.dumps(checkpoint)))
+            rotated += len(rows)
+            self._notify_changes([row.name for row in rows])
+            _logger.debug('Rotated salts of %d domains', checkpoint['rotated'])
+            if progress is not None:
+                progress(checkpoint['rotated'], max(total, checkpoint['rotated']))
+        return rotated
+
+
+    def sync_from(self, source, batch_size=1000, progress=None):
+        """ Bring this database up to date with another one, like a copy on a laptop with a central
+        database, copying only the domains created or changed there since the last sync from it.
+
+        The changed domains are read in order of their version, `batch_size` at a time, and each
+        batch is applied in a transaction of its own together with how far the sync has come. An
+        interrupted sync continues where it stopped the next time. Domains are matched by name.
+
+        A domain changed in both databases since the last sync keeps the most recent of the two
+        changes, and the domain in this database is left as is if it's the more recent one. Syncing
+        back and forth thus ends with the same domains in both databases.
+
+        :param source: The :class:`PWM` of the database to copy changes from, which can't be served
+            over HTTP(S).
+        :param batch_size: The number of changed domains to apply per transaction.
+        :param progress: Called as `progress(synced, total)` after every batch, with the number of
+            changed domains handled so far and the total number to handle.
+        :returns: A tuple `(created, updated, kept)` with the number of domains created, updated,
+            and kept because they were changed more recently in this database.
+        :raises ValueError: If either database is served over HTTP(S), or they are the same.
+        """
+        if not self.database_uri or not source.database_uri:
+            raise NotReadyException()
+        if self._uses_rest_api() or source._uses_rest_api():
+            raise ValueError("Can't sync databases served over HTTP(S)")
+        if self._get_engine() is source._get_engine():
+            raise ValueError("Can't sync %s with itself" % self.database_uri)
+        table = Domain.__table__
+        settings = Setting.__table__
+        state_name = 'sync:%s' % source._get_database_id()
+
+        with self._get_engine().connect() as connection:
+            stored = connection.execute(sa.select(settings.c.value).where(
+                settings.c.name == state_name)).scalar()
+        watermark = json.loads(stored) if stored else {'version': 0, 'id': 0}
+        columns = [table.c[column] for column in _SYNCED_COLUMNS]
+        source_engine = source._get_engine()
+        with source_engine.connect() as connection:
+            total = connection.execute(sa.select(sa.func.count()).select_from(table)
+                .where(_after_watermark(watermark))).scalar()
+
+        created = updated = kept = synced = 0
+        while True:
+            # The index on the version makes this cheap however many domains haven't changed
+            with source_engine.connect() as connection:
+                rows = connection.execute(sa.select(table.c.id, table.c.version, *columns)
+                    .where(_after_watermark(watermark))
+                    .order_by(table.c.version, table.c.id).limit(batch_size)).all()
+            if not rows:
+                break
+            watermark = {'version': rows[-1].version, 'id': rows[-1].id}
+            changes = collections.OrderedDict((row.name, dict(zip(_SYNCED_COLUMNS, row[2:])))
+                for row in rows)
+            batch_created, batch_updated, batch_kept = self._apply_sync_batch(changes,
+                state_name, watermark)
+            created += len(batch_created)
+            updated += len(batch_updated)
+            kept += batch_kept
+            synced += len(rows)
+            self._notify_changes(batch_created + batch_updated)
+            if progress is not None:
+                progress(synced, max(total, synced))
+        _logger.debug('Synced %d changed domains from %s', synced, source.database_uri)
+        return created, updated, kept
+
+
+    def _apply_sync_batch(self, changes, state_name, watermark):
+        """ Apply domains changed in another database, and save the watermark after them in the
+        same transaction.
+
+        :returns: A tuple with the names of the domains created and updated, and the number kept.
+        """
+        table = Domain.__table__
+        settings = Setting.__table__
+        names = list(changes)
+        with self._get_engine().begin() as connection:
+            existing = {}
+            for chunk in _chunks(names):
+                query = sa.select(*[table.c[column] for column in _SYNCED_COLUMNS]).where(
+                    table.c.name.in_(chunk))
+                for row in connection.execute(query):
+                    existing[row.name] = dict(zip(_SYNCED_COLUMNS, row))
+
+            inserts = []
+            updates = []
+            kept = 0
+            for name, values in changes.items():
+                current = existing.get(name)
+                if current is None:
+                    inserts.append(values)
+                elif current == values:
+                    # Like a domain synced here and back again
+                    continue
+                elif _sync_order(values) > _sync_order(current):
+                    updates.append(values)
+                else:
+                    _logger.debug('Keeping %s, it was changed more recently here', name)
+                    kept += 1
+
+            if inserts or updates:
+                _stamp_changes(connection, inserts + updates, synced=True)
+            if inserts:
+                connection.execute(table.insert(), inserts)
+            if updates:
+                changed_columns = [column for column in updates[0] if column != 'name']
+                update = table.update().where(table.c.name == sa.bindparam('domain_name')) \
+                    .values(dict((column, sa.bindparam('new_' + column))
+                        for column in changed_columns))
+                connection.execute(update, [dict([('domain_name', values['name'])] +
+                    [('new_' + column, values[column]) for column in changed_columns])
+                    for values in updates])
+            connection.execute(settings.delete().where(settings.c.name == state_name))
+            connection.execute(settings.insert().values(name=state_name,
+                value=json.dumps(watermark)))
+        return ([values['name'] for values in inserts], [values['name'] for values in updates],
+            kept)
+
+
+    def _get_database_id(self):
+        """ Get the random identifier of the database, creating it if it doesn't exist yet. Syncs
+        keep track of how far they have come by it, since the URI of a database can change.
+        """
+        settings = Setting.__table__
+        with self._get_engine().begin() as connection:
+            database_id = connection.execute(sa.select(settings.c.value).where(
+                settings.c.name == 'database_id')).scalar()
+            if database_id is None:
+                database_id = uuid.uuid4().hex
+                connection.execute(settings.insert().values(name='database_id', value=database_id))
+        return database_id
+
+
+    def add_change_listener(self, callback):
+        """ Call `callback(domain_name)` after a domain has been created or modified through this
+        instance, like to invalidate caches. Changes made by other processes are not reported.
+        """
+        self._change_listeners.append(callback)
+
+
+    def remove_change_listener(self, callback):
+        self._change_listeners.remove(callback)
+
+
+    def _notify_changes(self, domain_names):
+        for domain_name in domain_names:
+            if self.cache is not None:
+                self.cache.invalidate(domain_name)
+        if self._transaction_depth:
+            # Listeners are told once the change is committed
+            self._pending_changes.extend(domain_names)
+            return
+        for domain_name in domain_names:
+            for listener in list(self._change_listeners):
+                listener(domain_name)
+
+
+    def _index_database_path(self):
+        """ The path to the database file if this instance maintains an index of it, else None. """
+        if not self.index or not self.database_uri:
+            return None
+        prefix = 'sqlite:///'
+        path = self.database_uri[len(prefix):]
+        if not self.database_uri.startswith(prefix) or not path or path == ':memory:':
+            return None
+        return path
+
+
+    def _refresh_index(self):
+        """ Rewrite the :mod:`index <pwm.index>` of the database if this instance maintains one and
+        it doesn't match the database any more, like after a change. Only compares fingerprints
+        while the database doesn't change.
+        """
+        from . import index
+
+        database_path = self._index_database_path()
+        if database_path is None or self._transaction_depth:
+            return
+        try:
+            fingerprint = index.database_fingerprint(database_path)
+        except (IOError, OSError):
+            return
+        if fingerprint is None or fingerprint == self._index_fingerprint:
+            return
+        current = index.open_index(database_path)
+        if current is not None:
+            # Like when another process rewrote it
+            current.close()
+        elif not self._update_index(database_path):
+            return
+        self._index_fingerprint = fingerprint
+
+
+    def _update_index(self, database_path):
+        """ Rewrite the index of the database from a single streaming query. Failing to write the
+        index doesn't fail the operation, since readers don't use an index that doesn't match the
+        database.
+
+        :returns: Whether the index was written.
+        """
+        from . import index
+
+        path = index.index_path(database_path)
+        try:
+            # Taken before reading, so the index doesn't match if anything changes while reading
+            fingerprint = index.database_fingerprint(database_path)
+            if fingerprint is None:
+                _logger.debug('Not indexing %s, it is not a SQLite database in rollback '
+                    'journal mode', database_path)
+                return False
+            with metrics.timer('pwm_index_seconds'):
+                with self._get_engine().connect() as connection:
+                    rows = connection.execution_options(stream_results=True).execute(
+                        _exported_domains_query())
+                    index.write_index(path, (dict(zip(_EXPORTED_COLUMNS, row)) for row in rows),
+                        fingerprint)
+        except (IOError, OSError, ValueError) as ex:
+            _logger.warning('Could not update the index at %s: %s', path, ex)
+            return False
+        return True
+
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Run several operations in a single session, committing once at the end, or rolling
+        everything back if the block raises:
+
+            >>> with pwm.transaction():
+            ...     for name in names:
+            ...         pwm.modify_domain(name, new_salt=True)
+
+        Database operations like :func:`PWM.create_domain <pwm.core.PWM.create_domain>`,
+        :func:`PWM.modify_domain <pwm.core.PWM.modify_domain>`,
+        :func:`PWM.get_domain <pwm.core.PWM.get_domain>` and
+        :func:`PWM.search <pwm.core.PWM.search>` join the transaction, and see the changes made
+        earlier in it. Exports and imports use connections of their own, and don't.
+
+        Errors are still raised by the operation that caused them, but an error from the database,
+        like a duplicate name, leaves the transaction unusable. Change listeners are called after
+        the commit. Nested transactions join the outermost one.
+        """
+        if self._transaction_depth:
+            self._transaction_depth += 1
+            try:
+                yield
+            finally:
+                self._transaction_depth -= 1
+            return
+
+        if not self.session:
+            with metrics.timer('pwm_db_seconds', operation='transaction', phase='setup'):
+                self._init_db_session()
+        self._transaction_depth = 1
+        try:
+            yield
+            with metrics.timer('pwm_db_seconds', operation='transaction', phase='commit'):
+                self.session.commit()
+        except:
+            metrics.increment('pwm_db_errors_total', operation='transaction')
+            self.session.rollback()
+            if self.cache is not None:
+                # Lookups in the transaction might have cached the changes rolled back
+                for domain_name in self._pending_changes:
+                    self.cache.invalidate(domain_name)
+            raise
+        finally:
+            self._transaction_depth = 0
+            changes, self._pending_changes = self._pending_changes, []
+            self.session.close()
+        self._notify_changes(list(collections.OrderedDict.fromkeys(changes)))
+
+
+    def close(self):
+        """ Release the session held by this instance. The shared engine and its connection pool is
+        left open for other instances using the same database.
+        """
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+        if self._rest_client is not None:
+            self._rest_client.close()
+
+
+    def dispose(self):
+        """ Close this instance and all pooled connections to its database. """
+        self.close()
+        if self.database_uri and not self._uses_rest_api():
+            dispose_engine(self.database_uri)
+
+
+    def _get_engine(self, check_schema=True):
+        return get_engine(self.database_uri, pool_size=self.pool_size,
+            max_overflow=self.max_overflow, check_schema=check_schema)
+
+
     def _init_db_session(self):
         if not self.database_uri:
             raise NotReadyException()
-        db = sa.create_engine(self.database_uri)
-        DBSession = sessionmaker(bind=db, expire_on_commit=False)
+        DBSession = sessionmaker(bind=self._get_engine(), expire_on_commit=False)
         self.session = DBSession()
@@ -0,0 +1,365 @@
+"""
+    pwm.derive
+    ~~~~~~~~~~
+
+    Key derivation from the values of a domain, without the database stack, so that keys can be
+    derived from a :mod:`pwm.index` without importing SQLAlchemy.
+
+"""
+
+from . import encoding
+from .kdf import hkdf_sha256
+from .metrics import registry as metrics
+from .policy import Policy, get_policy
+
+import collections
+import contextlib
+import hashlib
+import itertools
+import threading
+import timeit
+from logging import getLogger
+
+_logger = getLogger('pwm.derive')
+
+#: Derive each key with scrypt over the master password and the domain name. The default.
+SCHEME_SCRYPT = 1
+
+#: Stretch the master password once with scrypt, using a salt shared by all domains in a database,
+#: and derive each key from that with HKDF-SHA256 over the domain salt and name. Keys for many
+#: domains cost a single scrypt.
+SCHEME_MASTER_KEY = 2
+
+#: The number of bytes of the digest keys are encoded from, which bounds their entropy.
+DIGEST_SIZE = 64
+
+#: The largest block of SHAKE-256 output computed at once when encoding keys longer than the
+#: digest.
+STREAM_BLOCK_SIZE = 64*1024
+
+# scrypt parameters `(N, r, p)` for domains that don't have their own
+DEFAULT_SCRYPT_PARAMS = (1<<14, 8, 1)
+
+# The default memory budget fits 32 derivations with the default parameters
+DEFAULT_MEMORY_BUDGET = 512*1024*1024
+
+
+def scrypt_memory_cost(scrypt_params):
+    """ The number of bytes scrypt allocates for its working memory with the given `(N, r, p)`. """
+    n, r, _ = scrypt_params
+    return 128*r*n
+
+
+class DerivationScheduler(object):
+    """ Admits key derivations against a memory budget and a limit on concurrent derivations,
+    queueing the rest. Every derivation in the process goes through :data:`scheduler`.
+
+    Jobs are admitted in the order they arrive, so a large job isn't starved by a stream of small
+    ones. A job that needs more than the whole budget is run when nothing else is.
+
+    :param memory_budget: The number of bytes all running derivations may use together.
+    :param max_concurrency: The maximum number of derivations to run at once. Defaults to the
+        number of CPUs.
+    """
+
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, max_concurrency=None):
+        if max_concurrency is None:
+            import multiprocessing
+            max_concurrency = multiprocessing.cpu_count()
+        self.memory_budget = memory_budget
+        self.max_concurrency = max_concurrency
+        self._condition = threading.Condition()
+        self._queue = collections.deque()
+        self._running = 0
+        self._memory_in_use = 0
+        self._jobs = 0
+        self._peak_queued = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+
+    def configure(self, memory_budget=None, max_concurrency=None):
+        """ Change the limits. Queued jobs are admitted right away if the new limits allow it. """
+        with self._condition:
+            if memory_budget is not None:
+                self.memory_budget = memory_budget
+            if max_concurrency is not None:
+                self.max_concurrency = max_concurrency
+            self._condition.notify_all()
+
+
+    def max_parallel(self, memory_cost):
+        """ How many jobs of the given cost the limits allow to run at once. """
+        return max(1, min(self.max_concurrency, self.memory_budget // memory_cost))
+
+
+    @contextlib.contextmanager
+    def slot(self, memory_cost):
+        """ Wait until a job needing `memory_cost` bytes can run, and hold its reservation for the
+        duration of the `with` block.
+        """
+        ticket = object()
+        start_time = timeit.default_timer()
+        with self._condition:
+            self._queue.append(ticket)
+            try:
+                while self._queue[0] is not ticket or not self._fits(memory_cost):
+                    self._peak_queued = max(self._peak_queued, len(self._queue))
+                    self._report()
+                    self._condition.wait()
+            except:
+                # Interrupted while waiting, like by Ctrl-C. Leave the queue, or the jobs behind
+                # this one would wait forever.
+                self._queue.remove(ticket)
+                self._report()
+                self._condition.notify_all()
+                raise
+            self._queue.popleft()
+            self._running += 1
+            self._memory_in_use += memory_cost
+            wait_time = timeit.default_timer() - start_time
+            self._jobs += 1
+            self._total_wait += wait_time
+            self._max_wait = max(self._max_wait, wait_time)
+            self._report()
+            # The next job in line might fit too
+            self._condition.notify_all()
+        metrics.observe('pwm_scheduler_wait_seconds', wait_time)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._memory_in_use -= memory_cost
+                self._report()
+                self._condition.notify_all()
+
+
+    def _fits(self, memory_cost):
+        if self._running == 0:
+            return True
+        return (self._running < self.max_concurrency and
+            self._memory_in_use + memory_cost <= self.memory_budget)
+
+
+    def _report(self):
+        metrics.set_gauge('pwm_scheduler_queued', len(self._queue))
+        metrics.set_gauge('pwm_scheduler_running', self._running)
+        metrics.set_gauge('pwm_scheduler_memory_bytes', self._memory_in_use)
+
+
+    def stats(self):
+        """ Get the current state of the scheduler, and wait times since it was created.
+
+        :returns: A dict with `queued`, `running`, `memory_in_use`, `jobs` (the number of jobs
+            admitted), `peak_queued`, `total_wait`, `mean_wait` and `max_wait`, in seconds.
+        """
+        with self._condition:
+            return {
+                'queued': len(self._queue),
+                'running': self._running,
+                'memory_in_use': self._memory_in_use,
+                'jobs': self._jobs,
+                'peak_queued': self._peak_queued,
+                'total_wait': self._total_wait,
+                'mean_wait': self._total_wait / self._jobs if self._jobs else 0.0,
+                'max_wait': self._max_wait,
+            }
+
+
+#: The scheduler all key derivations in this process go through.
+scheduler = DerivationScheduler()
+
+
+def _scrypt(password, salt, scrypt_params):
+    """ Run scrypt through the :data:`scheduler`, recording the time it took.
+
+    :returns: A tuple `(digest, seconds)`.
+    """
+    import scrypt
+
+    n, r, p = scrypt_params
+    with scheduler.slot(scrypt_memory_cost(scrypt_params)):
+        start_time = timeit.default_timer()
+        # the scrypt parameters are always passed explicitly, in case the library defaults change
+        digest = scrypt.hash(password, salt, N=n, r=r, p=p)
+        scrypt_time_in_s = timeit.default_timer() - start_time
+    metrics.observe('pwm_scrypt_seconds', scrypt_time_in_s)
+    return digest, scrypt_time_in_s
+
+
+def stretch_master_password(master_password, master_salt,
+        scrypt_params=DEFAULT_SCRYPT_PARAMS):
+    """ The expensive half of :data:`SCHEME_MASTER_KEY`, shared by all domains with the same master
+    salt and scrypt parameters. Can be passed as `master_key` to
+    :func:`Domain.derive_key <pwm.core.Domain.derive_key>` to skip stretching for every domain.
+    """
+    return _scrypt(master_password.encode('utf8'), master_salt, scrypt_params)[0]
+
+
+def _derive_digest(master_password, name, salt, scrypt_params, scheme, master_salt, master_key):
+    """ Computes the digest keys are encoded from.
+
+    :returns: A tuple `(digest, seconds)`, with the time spent stretching the master password.
+    """
+    if scheme == SCHEME_SCRYPT:
+        bytes = ('%s:%s' % (master_password, name)).encode('utf8')
+        return _scrypt(bytes, salt, scrypt_params)
+    elif scheme == SCHEME_MASTER_KEY:
+        stretch_time_in_s = 0
+        if master_key is None:
+            master_key, stretch_time_in_s = _scrypt(master_password.encode('utf8'), master_salt,
+                scrypt_params)
+        expand_start_time = timeit.default_timer()
+        digest = hkdf_sha256(master_key, salt, ('pwm:%s' % name).encode('utf8'), DIGEST_SIZE)
+        metrics.observe('pwm_expand_seconds', timeit.default_timer() - expand_start_time)
+        return digest, stretch_time_in_s
+    raise ValueError('Unknown derivation scheme %s' % scheme)
+
+
+def _digest_stream(digest, encoder):
+    """ The data keys of domains with `key_stream` set are encoded from. Starts with the digest
+    padded like :func:`Encoder.encode <pwm.encoding.Encoder.encode>` pads it, so keys the digest
+    is long enough for are the same either way, and continues with SHAKE-256 output over the
+    digest, in blocks growing up to :data:`STREAM_BLOCK_SIZE` bytes.
+    """
+    binlen = encoder.chunklen[0]
+    yield digest.ljust(encoding.ceildiv(len(digest), binlen)*binlen, b'\0')
+    block_size = 1024
+    for counter in itertools.count():
+        yield hashlib.shake_256(('pwm:stream:%d:' % counter).encode('ascii') +
+            digest).digest(block_size)
+        block_size = min(2*block_size, STREAM_BLOCK_SIZE)
+
+
+def _encode_key(digest, charset, key_length, policy, key_stream):
+    """ Encode a digest to a key, yielding it a few characters at a time. """
+    if policy:
+        yield get_policy(policy).encode(digest, charset, key_length)
+        return
+    encoder = encoding.get_encoder(charset)
+    if not key_stream:
+        # Keys are cut off where the digest runs out
+        yield encoder.encode(digest, key_length)
+        return
+    for chars in encoder.encode_stream(_digest_stream(digest, encoder), key_length):
+        yield chars
+
+
+def _derive_key(master_password, name, salt, charset, key_length,
+        scrypt_params=DEFAULT_SCRYPT_PARAMS, scheme=SCHEME_SCRYPT, master_salt=None, policy=None,
+        key_stream=None, master_key=None):
+    """ Computes a key from the raw domain values. Kept at module level so that it can be shipped to
+    worker processes.
+    """
+    start_time = timeit.default_timer()
+    digest, stretch_time_in_s = _derive_digest(master_password, name, salt, scrypt_params, scheme,
+        master_salt, master_key)
+    derivation_time_in_s = timeit.default_timer() - start_time
+
+    key = ''.join(_encode_key(digest, charset, key_length, policy, key_stream))
+    encode_time_in_s = timeit.default_timer() - start_time - derivation_time_in_s
+
+    metrics.observe('pwm_encode_seconds', encode_time_in_s)
+    _logger.debug('Key derivation took %.2fms (scrypt %.2fms, encoding %.2fms)',
+        (derivation_time_in_s + encode_time_in_s)*1000, stretch_time_in_s*1000,
+        encode_time_in_s*1000)
+    return key
+
+
+def _stream_key(master_password, name, salt, charset, key_length,
+        scrypt_params=DEFAULT_SCRYPT_PARAMS, scheme=SCHEME_SCRYPT, master_salt=None, policy=None,
+        key_stream=None, master_key=None):
+    """ Like :func:`_derive_key`, but yields the key a few characters at a time, so that very long
+    keys don't have to be held in memory at once. Derives the digest on the first iteration.
+    """
+    digest = _derive_digest(master_password, name, salt, scrypt_params, scheme, master_salt,
+        master_key)[0]
+    for chars in _encode_key(digest, charset, key_length, policy, key_stream):
+        yield chars
+
+
+def key_args(domain):
+    """ Get the arguments :func:`_derive_key` needs besides the master password from a dict of
+    domain column values, like the ones from :func:`DomainIndex.get <pwm.index.DomainIndex.get>`,
+    filling in the defaults for missing values.
+    """
+    default_n, default_r, default_p = DEFAULT_SCRYPT_PARAMS
+    scrypt_params = (domain.get('scrypt_n') or default_n, domain.get('scrypt_r') or default_r,
+        domain.get('scrypt_p') or default_p)
+    return (domain['name'], domain['salt'], domain['charset'], domain['key_length'], scrypt_params,
+        domain.get('scheme') or SCHEME_SCRYPT, domain.get('master_salt'), domain.get('policy'),
+        domain.get('key_stream'))
+
+
+def _derive_key_job(job):
+    """ Unpacks a job from :func:`PWM.derive_keys <pwm.core.PWM.derive_keys>`. """
+    master_password, key_args, master_key = job
+    return key_args[0], _derive_key(master_password, *key_args, master_key=master_key)
+
+
+def validate_scrypt_params(scrypt_params):
+    """ Check that `(N, r, p)` are valid scrypt parameters.
+
+    :raises ValueError: If they are not.
+    """
+    n, r, p = scrypt_params
+    if n < 2 or n & (n - 1):
+        raise ValueError('scrypt N must be a power of two larger than 1, got %s' % n)
+    if r < 1 or p < 1:
+        raise ValueError('scrypt r and p must be positive, got r=%s, p=%s' % (r, p))
+
+
+def _resolve_scrypt_params(scrypt_params, defaults):
+    """ Fill in the scrypt parameters that are None from `defaults`, and validate the result. """
+    scrypt_params = tuple(default if value is None else value
+        for value, default in zip(scrypt_params, defaults))
+    validate_scrypt_params(scrypt_params)
+    return scrypt_params
+
+
+def _validate_scheme(scheme):
+    if scheme not in (SCHEME_SCRYPT, SCHEME_MASTER_KEY):
+        raise ValueError('Unknown derivation scheme %s' % scheme)
+
+
+def _resolve_policy(policy, alphabet, length):
+    """ Check that keys of `length` characters from the named or custom `alphabet` can satisfy
+    `policy`, a :class:`Policy` or one saved with :func:`Policy.dump`.
+
+    :returns: The policy as saved with a domain, or None for no policy.
+    """
+    if policy is None:
+        return None
+    if not isinstance(policy, Policy):
+        policy = Policy.parse(policy)
+    if not policy.minimums and not policy.exclude:
+        return None
+    policy.validate(encoding.lookup_alphabet(alphabet), length)
+    return policy.dump()
+
+
+def calibrate_scrypt(target_ms, r=8, p=1, min_n=1<<10, max_n=1<<22):
+    """ Find the largest scrypt N that hashes within `target_ms` milliseconds on this machine.
+
+    N is doubled from `min_n` until a hash takes longer than the target, so the whole calibration
+    takes at most a few times the target. If even `min_n` is too slow, `min_n` is returned.
+
+    :returns: A tuple `(scrypt_params, timings)`, where `timings` is a list of `(N, milliseconds)`
+        for every N that was tried.
+    """
+    import scrypt
+
+    n = min_n
+    best = min_n
+    timings = []
+    while n <= max_n:
+        # Best of three, to not be thrown off by other processes
+        time_in_ms = min(timeit.repeat(lambda: scrypt.hash(b'calibrate', b'salt', N=n, r=r, p=p),
+            number=1, repeat=3))*1000
+        timings.append((n, time_in_ms))
+        if time_in_ms > target_ms:
+            break
+        best = n
+        n <<= 1
+    return (best, r, p), timings
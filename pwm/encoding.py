@@ -1,4 +1,4 @@
-from ._compat import ord_byte
+from ._compat import bytes_to_int
 
 import math
 import string
@@ -15,6 +15,9 @@ PRESETS = {
     'alphanumeric': string.ascii_letters + string.digits,
 }
 
+DEFAULT_ALPHABET = 'full'
+DEFAULT_KEY_LENGTH = 16
+
 def ceildiv(dividend, divisor):
     ''' integer ceiling division '''
     return (dividend + divisor - 1) // divisor
@@ -37,21 +40,88 @@ class Encoder(object):
     '''
     general-purpose encoder. Encodes arbitrary binary data with a given
     specific base ("alphabet").
+
+    Encoders are immutable, prefer :func:`get_encoder` over instantiating them directly to reuse
+    the precomputed tables between calls.
     '''
 
     def __init__(self, alphabet):
         self.alphabet = alphabet
         self.chunklen = calc_chunklen(len(alphabet))
+        self._base = len(alphabet)
+        self._powers = [self._base**i for i in reversed(range(self.chunklen[1]))]
 
 
     def encode(self, digest, total_len):
         nchunks = ceildiv(len(digest), self.chunklen[0])
         binstr = digest.ljust(nchunks * self.chunklen[0], b'\0')
 
+        # Chunks past total_len would be truncated anyway
+        nchunks = min(nchunks, ceildiv(total_len, self.chunklen[1]))
         return ''.join([
                 self._encode_chunk(binstr, i) for i in range(0, nchunks)
             ])[:total_len]
 
+    def encode_stream(self, blocks, total_len):
+        '''
+        encodes binary data read from an iterable of byte strings, yielding the encoded characters
+        one chunk at a time until total_len characters have been yielded. Unlike :func:`encode`
+        the data is never padded, blocks are read until enough characters have been encoded.
+        '''
+        binlen, enclen = self.chunklen
+        remaining = total_len
+        leftover = b''
+        if remaining <= 0:
+            return
+        for block in blocks:
+            data = leftover + block
+            usable = len(data) - len(data) % binlen
+            for start in range(0, usable, binlen):
+                chars = self._encode_long(self._chunk_to_long(data[start:start + binlen]))
+                if remaining <= enclen:
+                    yield chars[:remaining]
+                    return
+                remaining -= enclen
+                yield chars
+            leftover = data[usable:]
+        raise ValueError('Ran out of data with %d characters left to encode' % remaining)
+
+    def encode_many(self, digests, total_len):
+        '''
+        encodes a sequence of digests, returning a list of the encoded values in the same order.
+        Uses numpy to encode all digests at once if it's installed and the digests are of equal
+        length, otherwise falls back to encoding them one by one.
+        '''
+        digests = list(digests)
+        numpy = _get_numpy()
+        if numpy is not None and digests and total_len > 0 and len(set(map(len, digests))) == 1:
+            return self._encode_many_numpy(numpy, digests, total_len)
+        return self._encode_many_python(digests, total_len)
+
+    def _encode_many_python(self, digests, total_len):
+        return [self.encode(digest, total_len) for digest in digests]
+
+    def _encode_many_numpy(self, numpy, digests, total_len):
+        binlen, enclen = self.chunklen
+        nchunks = ceildiv(len(digests[0]), binlen)
+        nchunks = min(nchunks, ceildiv(total_len, enclen))
+        padded_len = nchunks * binlen
+        data = b''.join(d.ljust(padded_len, b'\0')[:padded_len] for d in digests)
+        chunks = numpy.frombuffer(data, dtype=numpy.uint8).reshape(len(digests), nchunks, binlen)
+
+        # binlen is at most 6, so chunk values always fit in 64 bits
+        values = numpy.zeros((len(digests), nchunks), dtype=numpy.uint64)
+        for i in range(binlen):
+            values = (values << numpy.uint64(8)) | chunks[:, :, i]
+
+        powers = numpy.array(self._powers, dtype=numpy.uint64)
+        indices = (values[:, :, numpy.newaxis] // powers) % numpy.uint64(self._base)
+        indices = indices.reshape(len(digests), nchunks*enclen)[:, :total_len]
+
+        # Gather single characters, then view each row as one fixed-width string
+        chars = numpy.array(list(self.alphabet))[indices.astype(numpy.intp)]
+        return chars.view('<U%d' % chars.shape[1]).ravel().tolist()
+
     def _encode_chunk(self, data, index):
         '''
         gets a chunk from the input data, converts it to a number and
@@ -66,18 +136,15 @@ class Encoder(object):
         alphabet
         '''
         return ''.join([
-                self.alphabet[(val//len(self.alphabet)**i) % len(self.alphabet)]
-                for i in reversed(range(self.chunklen[1]))
+                self.alphabet[(val//power) % self._base]
+                for power in self._powers
             ])
 
     def _chunk_to_long(self, chunk):
         '''
         parses a chunk of bytes to integer using big-endian representation
         '''
-        return sum([
-                256**(self.chunklen[0]-1-i) * ord_byte(chunk[i])
-                for i in range(self.chunklen[0])
-            ])
+        return bytes_to_int(chunk)
 
     def _get_chunk(self, data, index):
         '''
@@ -86,6 +153,34 @@ class Encoder(object):
         return data[index*self.chunklen[0]:(index+1)*self.chunklen[0]]
 
 
+_encoders = {}
+
+def get_encoder(alphabet):
+    '''
+    get a cached :class:`Encoder` for the given alphabet, creating it on first use
+    '''
+    encoder = _encoders.get(alphabet)
+    if encoder is None:
+        encoder = _encoders.setdefault(alphabet, Encoder(alphabet))
+    return encoder
+
+
+_numpy = []
+
+def _get_numpy():
+    '''
+    import numpy on first use, since it's optional and slow to import. Returns None if it's not
+    installed.
+    '''
+    if not _numpy:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy.append(numpy)
+    return _numpy[0]
+
+
 def lookup_alphabet(charset):
     '''
     retrieves a named charset or treats the input as a custom alphabet and use that
@@ -8,3 +8,17 @@ class NotReadyException(Exception):
 
 class NoSuchDomainException(Exception):
     """ An operation was attempted on a domain that doesn't exist yet. """
+
+
+class AgentLockedException(Exception):
+    """ The agent doesn't hold a master password, either since it expired or was never given. """
+
+
+class OutdatedDatabaseException(Exception):
+    """ The database was created by an older version of pwm, and has to be upgraded with
+    :func:`PWM.upgrade <pwm.core.PWM.upgrade>` or `pwm upgrade` before it can be used.
+    """
+
+
+class AgentDatabaseException(Exception):
+    """ The agent serves another database than the one a key was asked for. """
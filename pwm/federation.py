@@ -0,0 +1,215 @@
+"""
+    pwm.federation
+    ~~~~~~~~~~~~~~
+
+    Use several databases as one, like a personal vault and a team vault.
+
+    :class:`FederatedPWM` sends every lookup to all its databases at once on a thread pool, so a
+    lookup takes as long as the slowest database, not as long as all of them together. Databases
+    are ordered by priority: a domain found in several of them is taken from the first, and a
+    lookup returns as soon as the databases before the one it was found in have answered. A
+    database that fails, like a server that can't be reached, is skipped, and lookups only fail if
+    all databases do.
+
+"""
+
+from .core import PWM, _urify_db
+from .exceptions import NoSuchDomainException
+
+import concurrent.futures
+import contextlib
+import threading
+from logging import getLogger
+
+_logger = getLogger('pwm.federation')
+
+
+def _search_sort_key(query, rank):
+    """ Order domains like :func:`PWM.search <pwm.core.PWM.search>` does, to merge the results of
+    several databases.
+    """
+    query = query.lower()
+    if not rank:
+        return lambda domain: domain.name
+    def key(domain):
+        name = domain.name.lower()
+        relevance = 0 if name == query else 1 if name.startswith(query) else 2
+        return (relevance, len(domain.name), domain.name)
+    return key
+
+
+class FederatedPWM(object):
+    """ Look up domains in several databases, and create domains in one of them.
+
+    Like :class:`PWM <pwm.core.PWM>`, an instance shouldn't be shared between threads.
+
+    :param database_uris: The databases to use, in priority order. Paths, SQLAlchemy URIs or
+        URLs of databases served over HTTP(S), like for :class:`PWM <pwm.core.PWM>`.
+    :param write_to: The database domains are created in and modified in, either one of
+        `database_uris` or its position in the list. Databases served over HTTP(S) are read-only.
+        Default: The first database.
+    :param workers: The number of threads to query the databases with. Default: Twice the number
+        of databases, so that lookups don't have to wait for threads still busy with databases
+        that weren't needed to answer an earlier lookup.
+    :param kwargs: Passed on to the :class:`PWM <pwm.core.PWM>` of every database, like
+        `config` and `cache_size`.
+    :raises ValueError: If `write_to` isn't one of the databases, or is served over HTTP(S).
+    """
+
+    def __init__(self, database_uris, write_to=0, workers=None, **kwargs):
+        self.backends = [PWM(uri, **kwargs) for uri in database_uris]
+        if not self.backends:
+            raise ValueError('A federation needs at least one database')
+        if not isinstance(write_to, int):
+            uris = [backend.database_uri for backend in self.backends]
+            if _urify_db(write_to) not in uris:
+                raise ValueError('%s is not one of the databases' % write_to)
+            write_to = uris.index(_urify_db(write_to))
+        #: The :class:`PWM <pwm.core.PWM>` of the database domains are created in.
+        self.writer = self.backends[write_to]
+        if self.writer._uses_rest_api():
+            raise ValueError("Can't write to %s, databases served over HTTP(S) are read-only" %
+                self.writer.database_uri)
+        self.workers = workers or 2*len(self.backends)
+        # A lookup can return while databases it didn't need are still working on it, make the
+        # next lookup wait for them, since a PWM can only do one thing at a time
+        self._locks = [threading.Lock() for _ in self.backends]
+        self._executor = None
+        #: The databases that failed in the last lookup, as `(database_uri, exception)` tuples.
+        self.errors = []
+
+
+    def _submit(self, method_name, *args):
+        """ Call a method on every database on the thread pool, returning the futures in priority
+        order.
+        """
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+        return [self._executor.submit(self._call, i, method_name, *args)
+            for i in range(len(self.backends))]
+
+
+    def _call(self, backend_index, method_name, *args):
+        with self._locks[backend_index]:
+            return getattr(self.backends[backend_index], method_name)(*args)
+
+
+    def _results(self, futures):
+        """ Yield the results of the futures from :func:`_submit` in priority order, skipping the
+        databases that failed, which are logged and recorded in :attr:`errors`.
+
+        :raises Exception: The error of the first database, if all of them failed.
+        """
+        self.errors = []
+        for backend, future in zip(self.backends, futures):
+            try:
+                result = future.result()
+            except Exception as ex: # pylint: disable=broad-except
+                _logger.warning('Lookup in %s failed, skipping it: %s', backend.database_uri, ex)
+                self.errors.append((backend.database_uri, ex))
+                continue
+            yield result
+        if len(self.errors) == len(self.backends):
+            raise self.errors[0][1]
+
+
+    def search(self, query, limit=None, rank=False):
+        """ Search all databases at once, merging the results. Takes the same arguments as
+        :func:`PWM.search <pwm.core.PWM.search>`.
+
+        :returns: A list of the matching :class:`Domain <pwm.core.Domain>` objects, ordered like
+            by :func:`PWM.search <pwm.core.PWM.search>`, taking domains in several databases
+            from the first.
+        """
+        merged = {}
+        for domains in self._results(self._submit('search', query, limit, rank)):
+            for domain in domains:
+                merged.setdefault(domain.name, domain)
+        domains = sorted(merged.values(), key=_search_sort_key(query, rank))
+        return domains[:limit] if limit is not None else domains
+
+
+    def get_domain(self, domain_name):
+        """ Get a domain from the first database that has it.
+
+        :raises NoSuchDomainException: If none of the databases have it.
+        """
+        for found in self._results(self._submit('_find_domains', [domain_name])):
+            domain = found.get(domain_name)
+            if domain is not None:
+                return domain
+        raise NoSuchDomainException(domain_name)
+
+
+    def get_domains(self, domain_names):
+        """ Get several domains, each from the first database that has it.
+
+        :returns: A list of :class:`Domain <pwm.core.Domain>` objects, in the same order as the
+            names were given.
+        :raises NoSuchDomainException: If any of the domains isn't in any of the databases.
+        """
+        domain_names = list(domain_names)
+        found = {}
+        for domains in self._results(self._submit('_find_domains', domain_names)):
+            for name, domain in domains.items():
+                found.setdefault(name, domain)
+            if len(found) == len(set(domain_names)):
+                break
+        missing = [name for name in domain_names if name not in found]
+        if missing:
+            raise NoSuchDomainException(', '.join(missing))
+        return [found[name] for name in domain_names]
+
+
+    def create_domain(self, domain_name, **kwargs):
+        """ Create a domain in the :attr:`writer` database. Takes the same arguments as
+        :func:`PWM.create_domain <pwm.core.PWM.create_domain>`.
+
+        Domains already in other databases can be created again, but the one in the database
+        listed first is the one that is looked up.
+        """
+        with self._writing():
+            return self.writer.create_domain(domain_name, **kwargs)
+
+
+    def create_domains(self, specs):
+        """ Create many domains in the :attr:`writer` database, see
+        :func:`PWM.create_domains <pwm.core.PWM.create_domains>`.
+        """
+        with self._writing():
+            return self.writer.create_domains(specs)
+
+
+    def modify_domain(self, domain_name, new_salt=False, username=None):
+        """ Modify a domain in the :attr:`writer` database, see
+        :func:`PWM.modify_domain <pwm.core.PWM.modify_domain>`.
+
+        :raises NoSuchDomainException: If the domain isn't in the :attr:`writer` database, even if
+            it's in another one.
+        """
+        with self._writing():
+            return self.writer.modify_domain(domain_name, new_salt=new_salt, username=username)
+
+
+    @contextlib.contextmanager
+    def _writing(self):
+        with self._locks[self.backends.index(self.writer)]:
+            yield
+
+
+    def close(self):
+        """ Wait for outstanding lookups, and close the connections of all databases. """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        for backend in self.backends:
+            backend.close()
+
+
+    def dispose(self):
+        """ Like :func:`close <FederatedPWM.close>`, also disposing the connection pools, see
+        :func:`PWM.dispose <pwm.core.PWM.dispose>`.
+        """
+        self.close()
+        for backend in self.backends:
+            backend.dispose()
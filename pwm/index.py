@@ -0,0 +1,292 @@
+"""
+    pwm.index
+    ~~~~~~~~~
+
+    A compact, read-only snapshot of the domains in a SQLite database, kept in a file beside it, for
+    looking up domains without SQLAlchemy. :class:`PWM <pwm.core.PWM>` instances created with
+    `index=True` rewrite it on their first lookup after the database changed, and `pwm get` reads
+    it.
+
+    The file holds a header, a table of fixed-width offsets to the records sorted by name, a table
+    of offsets to the distinct charsets, and then the records and charsets themselves. Lookups
+    memory-map the file and binary search the offset table, only reading the few records on the
+    way.
+
+    The header records the modification time, size and change counter of the database file when the
+    snapshot was taken. :func:`open_index` refuses a snapshot that doesn't match the database any
+    more, like after a change made by a process not maintaining the index, and callers fall back to
+    the database. Databases in WAL mode can't be matched this way, and are never indexed.
+
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+
+MAGIC = b'PWMIDX03'
+
+# Magic, number of records, number of charsets, and the modification time in nanoseconds, size and
+# change counter of the database file
+_HEADER = struct.Struct('<8sIIqqI4x')
+_OFFSET = struct.Struct('<I')
+_NAME_LENGTH = struct.Struct('<H')
+# Flags, salt length, master salt length, scheme, charset index, key length, scrypt N, r and p,
+# username length and policy length. Followed by the salt, master salt, username and policy.
+_FIELDS = struct.Struct('<BBBBHIIIIHH')
+
+_USERNAME_IS_NULL = 1
+_MASTER_SALT_IS_NULL = 2
+_KEY_STREAM = 4
+_NO_CHARSET = 0xffff
+
+
+def index_path(database_path):
+    """ Where the index of the database at `database_path` is kept. """
+    return database_path + '.index'
+
+
+def database_fingerprint(database_path):
+    """ Identify the current state of a SQLite database file.
+
+    :returns: A tuple `(mtime_ns, size, change_counter)`, or None if the database is in WAL mode
+        or isn't a SQLite database.
+    """
+    wal_path = database_path + '-wal'
+    if os.path.exists(wal_path) and os.path.getsize(wal_path):
+        return None
+    with open(database_path, 'rb') as database_file:
+        header = database_file.read(100)
+        stat = os.fstat(database_file.fileno())
+    if len(header) < 100 or not header.startswith(b'SQLite format 3\0'):
+        return None
+    mtime_ns = getattr(stat, 'st_mtime_ns', None) or int(stat.st_mtime*1e9)
+    # The file change counter, incremented by every transaction that writes to the database
+    change_counter = struct.unpack_from('>I', header, 24)[0]
+    return (mtime_ns, stat.st_size, change_counter)
+
+
+def _encode(value):
+    return value.encode('utf8') if value is not None else b''
+
+
+def write_index(path, domains, fingerprint):
+    """ Write an index of `domains` to `path`, replacing any existing index atomically.
+
+    :param domains: An iterable of dicts with the column values of the domains, like `name`,
+        `salt`, `charset`, `key_length`, `username`, `scrypt_n`, `scrypt_r`, `scrypt_p`, `scheme`,
+        `master_salt`, `policy` and `key_stream`.
+    :param fingerprint: The :func:`database_fingerprint` of the database, taken before reading
+        `domains` from it.
+    :raises ValueError: If a domain has values too large for the index.
+    """
+    charsets = {}
+    records = []
+    for domain in domains:
+        charset = domain.get('charset')
+        if charset is None:
+            charset_index = _NO_CHARSET
+        else:
+            charset_index = charsets.setdefault(charset, len(charsets))
+        name = _encode(domain['name'])
+        salt = domain.get('salt') or b''
+        master_salt = domain.get('master_salt')
+        username = domain.get('username')
+        flags = ((_USERNAME_IS_NULL if username is None else 0) |
+            (_MASTER_SALT_IS_NULL if master_salt is None else 0) |
+            (_KEY_STREAM if domain.get('key_stream') else 0))
+        username = _encode(username)
+        master_salt = master_salt or b''
+        policy = _encode(domain.get('policy'))
+        if len(salt) > 0xff or len(master_salt) > 0xff or len(charsets) >= _NO_CHARSET:
+            raise ValueError('Domain %s has values too large to index' % domain['name'])
+        try:
+            record = b''.join((
+                _NAME_LENGTH.pack(len(name)),
+                name,
+                _FIELDS.pack(flags, len(salt), len(master_salt), domain.get('scheme') or 0,
+                    charset_index, domain.get('key_length') or 0, domain.get('scrypt_n') or 0,
+                    domain.get('scrypt_r') or 0, domain.get('scrypt_p') or 0, len(username),
+                    len(policy)),
+                salt,
+                master_salt,
+                username,
+                policy,
+            ))
+        except struct.error:
+            raise ValueError('Domain %s has values too large to index' % domain['name'])
+        records.append((name, record))
+    records.sort()
+
+    charset_values = [_encode(charset) for charset, _ in sorted(charsets.items(),
+        key=lambda item: item[1])]
+    position = _HEADER.size + _OFFSET.size*(len(records) + 1 + len(charset_values) + 1)
+    record_offsets = []
+    for _, record in records:
+        record_offsets.append(position)
+        position += len(record)
+    record_offsets.append(position)
+    charset_offsets = []
+    for charset in charset_values:
+        charset_offsets.append(position)
+        position += len(charset)
+    charset_offsets.append(position)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.pwm-index-', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as index_file:
+            index_file.write(_HEADER.pack(MAGIC, len(records), len(charset_values), *fingerprint))
+            index_file.write(b''.join(_OFFSET.pack(offset) for offset in record_offsets))
+            index_file.write(b''.join(_OFFSET.pack(offset) for offset in charset_offsets))
+            index_file.write(b''.join(record for _, record in records))
+            index_file.write(b''.join(charset_values))
+        # Readers either see the old index or the new one, never a partial one
+        getattr(os, 'replace', os.rename)(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+class DomainIndex(object):
+    """ A memory-mapped index written by :func:`write_index`.
+
+    :raises ValueError: If the file isn't an index.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as index_file:
+            try:
+                self._map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError('%s is empty' % path)
+        if len(self._map) < _HEADER.size:
+            self.close()
+            raise ValueError('%s is not an index' % path)
+        magic, self._count, self._charset_count, mtime_ns, size, change_counter = \
+            _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('%s is not an index' % path)
+        #: The :func:`database_fingerprint` of the database the index was written from.
+        self.fingerprint = (mtime_ns, size, change_counter)
+        self._charsets_offset = _HEADER.size + _OFFSET.size*(self._count + 1)
+
+
+    def __len__(self):
+        return self._count
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        self._map.close()
+
+
+    def _record_offset(self, position):
+        return _OFFSET.unpack_from(self._map, _HEADER.size + _OFFSET.size*position)[0]
+
+
+    def _name_at(self, position):
+        offset = self._record_offset(position)
+        name_length = _NAME_LENGTH.unpack_from(self._map, offset)[0]
+        start = offset + _NAME_LENGTH.size
+        return self._map[start:start + name_length], start + name_length
+
+
+    def _lower_bound(self, name):
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._name_at(middle)[0] < name:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+    def get(self, domain_name):
+        """ Look up a domain.
+
+        :returns: A dict with the column values of the domain, or None if it isn't in the index.
+        """
+        name = _encode(domain_name)
+        position = self._lower_bound(name)
+        if position == self._count:
+            return None
+        found_name, fields_offset = self._name_at(position)
+        if found_name != name:
+            return None
+
+        (flags, salt_length, master_salt_length, scheme, charset_index, key_length, scrypt_n,
+            scrypt_r, scrypt_p, username_length, policy_length) = _FIELDS.unpack_from(self._map,
+            fields_offset)
+        offset = fields_offset + _FIELDS.size
+        salt = self._map[offset:offset + salt_length]
+        offset += salt_length
+        master_salt = self._map[offset:offset + master_salt_length]
+        offset += master_salt_length
+        username = self._map[offset:offset + username_length].decode('utf8')
+        offset += username_length
+        policy = self._map[offset:offset + policy_length].decode('utf8')
+        return {
+            'name': domain_name,
+            'salt': salt,
+            'charset': self._charset(charset_index),
+            'key_length': key_length or None,
+            'username': None if flags & _USERNAME_IS_NULL else username,
+            'scrypt_n': scrypt_n or None,
+            'scrypt_r': scrypt_r or None,
+            'scrypt_p': scrypt_p or None,
+            'scheme': scheme or None,
+            'master_salt': None if flags & _MASTER_SALT_IS_NULL else master_salt,
+            'policy': policy or None,
+            'key_stream': bool(flags & _KEY_STREAM) or None,
+        }
+
+
+    def _charset(self, charset_index):
+        if charset_index == _NO_CHARSET:
+            return None
+        position = self._charsets_offset + _OFFSET.size*charset_index
+        start, end = struct.unpack_from('<II', self._map, position)
+        return self._map[start:end].decode('utf8')
+
+
+    def names(self, prefix=''):
+        """ Get the names of the domains starting with `prefix`, in sorted order, like for shell
+        completion.
+        """
+        encoded_prefix = _encode(prefix)
+        position = self._lower_bound(encoded_prefix)
+        while position < self._count:
+            name = self._name_at(position)[0]
+            if not name.startswith(encoded_prefix):
+                break
+            yield name.decode('utf8')
+            position += 1
+
+
+def open_index(database_path):
+    """ Open the index of a database, if it exists and matches the current state of the database.
+
+    :returns: A :class:`DomainIndex`, or None if there is no usable index.
+    """
+    try:
+        index = DomainIndex(index_path(database_path))
+    except (IOError, OSError, ValueError):
+        return None
+    try:
+        fingerprint = database_fingerprint(database_path)
+    except (IOError, OSError):
+        fingerprint = None
+    if fingerprint is None or index.fingerprint != fingerprint:
+        index.close()
+        return None
+    return index
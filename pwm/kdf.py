@@ -0,0 +1,33 @@
+"""
+    pwm.kdf
+    ~~~~~~~
+
+    Key derivation primitives built on the standard library.
+
+"""
+
+import hashlib
+import hmac
+
+
+def hkdf_sha256(input_key, salt, info, length):
+    """ HKDF with SHA-256, as specified in RFC 5869.
+
+    :param input_key: The input keying material, like a stretched master password.
+    :param salt: A non-secret random value. An empty salt is treated as 32 zero bytes.
+    :param info: Context to bind the output to, like a domain name.
+    :param length: The number of bytes to output, at most 8160.
+    """
+    digest_size = hashlib.sha256().digest_size
+    if length > 255*digest_size:
+        raise ValueError('HKDF-SHA256 can output at most %d bytes' % (255*digest_size))
+    pseudorandom_key = hmac.new(salt or b'\0'*digest_size, input_key, hashlib.sha256).digest()
+    output = b''
+    block = b''
+    counter = 1
+    while len(output) < length:
+        block = hmac.new(pseudorandom_key, block + info + bytearray([counter]),
+            hashlib.sha256).digest()
+        output += block
+        counter += 1
+    return output[:length]
@@ -0,0 +1,275 @@
+"""
+    pwm.metrics
+    ~~~~~~~~~~~
+
+    Counters, gauges and latency histograms for key derivation, database and REST operations.
+
+    Everything is recorded to the process-wide :data:`registry`. Read it as Prometheus text with
+    :func:`Metrics.to_prometheus <pwm.metrics.Metrics.to_prometheus>`, or forward every observation
+    to your own metrics system with :func:`Metrics.add_listener <pwm.metrics.Metrics.add_listener>`:
+
+        >>> from pwm.metrics import registry
+        >>> registry.add_listener(lambda name, value, labels: statsd.timing(name, value))
+
+    Recorded metrics:
+
+    - `pwm_scrypt_seconds`: Time spent in scrypt, per key derivation.
+    - `pwm_expand_seconds`: Time spent deriving domain keys from a stretched master password with
+      HKDF, for domains using :data:`SCHEME_MASTER_KEY <pwm.derive.SCHEME_MASTER_KEY>`.
+    - `pwm_encode_seconds`: Time spent encoding digests to keys, per key derivation.
+    - `pwm_db_seconds`: Time spent in database operations, labeled by `operation` and `phase`
+      (`setup` for creating the session, `execute` and `commit`).
+    - `pwm_db_errors_total`: Database operations that failed, labeled by `operation`.
+    - `pwm_sql_seconds`: Time spent executing SQL statements.
+    - `pwm_slow_queries_total`: SQL statements slower than :data:`SLOW_QUERY_THRESHOLD`, which
+      are also logged.
+    - `pwm_rest_request_seconds`: HTTP requests to REST databases, labeled by `method` and
+      `status` (`error` if no response was received).
+    - `pwm_rest_cache_total`: REST salt cache lookups, labeled by `result` (`hit`, `stale`,
+      `revalidated` or `miss`).
+    - `pwm_domain_cache_total`: Domain lookups through the cache of a :class:`PWM <pwm.core.PWM>`
+      created with a `cache_size`, labeled by `result` (`hit` or `miss`).
+    - `pwm_index_seconds`: Time spent rewriting the :mod:`index <pwm.index>` of a database.
+    - `pwm_scheduler_wait_seconds`: Time key derivations waited for memory or a CPU, see
+      :class:`DerivationScheduler <pwm.derive.DerivationScheduler>`.
+    - `pwm_scheduler_queued`, `pwm_scheduler_running` and `pwm_scheduler_memory_bytes`: Gauges
+      with the number of derivations waiting and running, and the memory reserved for them.
+
+    Keys derived in worker processes, like by :func:`PWM.derive_keys <pwm.core.PWM.derive_keys>`
+    with more than one worker, are recorded in the registry of the worker and not reported back.
+
+"""
+
+import threading
+import timeit
+from contextlib import contextmanager
+from logging import getLogger
+
+_logger = getLogger('pwm.metrics')
+
+# Upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0)
+
+# SQL statements slower than this many seconds are logged and counted
+SLOW_QUERY_THRESHOLD = 0.1
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+        .replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0]*len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """ A thread-safe collection of counters, gauges and histograms, each identified by a name and
+    a set of labels.
+
+    :param buckets: Upper bounds of the histogram buckets, in increasing order.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+
+
+    def increment(self, name, value=1, **labels):
+        """ Add `value` to a counter. """
+        with self._lock:
+            key = (name, _label_key(labels))
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._notify(name, value, labels)
+
+
+    def set_gauge(self, name, value, **labels):
+        """ Set a gauge to `value`. """
+        with self._lock:
+            self._gauges[(name, _label_key(labels))] = value
+        self._notify(name, value, labels)
+
+
+    def observe(self, name, value, **labels):
+        """ Record a value, like a duration in seconds, to a histogram. """
+        with self._lock:
+            key = (name, _label_key(labels))
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(self.buckets)
+            histogram.observe(value)
+        self._notify(name, value, labels)
+
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ Record the time spent in a `with` block to a histogram, also when it raises. """
+        start_time = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.observe(name, timeit.default_timer() - start_time, **labels)
+
+
+    def add_listener(self, callback):
+        """ Call `callback(name, value, labels)` for every counter increment, gauge update and
+        observation. Exceptions from listeners are logged and ignored.
+        """
+        with self._lock:
+            self._listeners.append(callback)
+
+
+    def remove_listener(self, callback):
+        with self._lock:
+            self._listeners.remove(callback)
+
+
+    def _notify(self, name, value, labels):
+        for listener in list(self._listeners):
+            try:
+                listener(name, value, labels)
+            except Exception: # pylint: disable=broad-except
+                _logger.exception('Metrics listener %r failed', listener)
+
+
+    def get_counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get((name, _label_key(labels)), 0)
+
+
+    def get_gauge(self, name, **labels):
+        with self._lock:
+            return self._gauges.get((name, _label_key(labels)), 0)
+
+
+    def get_histogram(self, name, **labels):
+        """ Get the number of observations and their sum for a histogram.
+
+        :returns: A tuple `(count, sum)`.
+        """
+        with self._lock:
+            histogram = self._histograms.get((name, _label_key(labels)))
+            if histogram is None:
+                return 0, 0.0
+            return histogram.count, histogram.sum
+
+
+    def summary(self):
+        """ Summarize all histograms.
+
+        :returns: A list of `(name, labels, count, sum)` tuples, sorted by name and labels.
+        """
+        with self._lock:
+            return [(name, dict(label_key), histogram.count, histogram.sum)
+                for (name, label_key), histogram in sorted(self._histograms.items())]
+
+
+    def to_prometheus(self):
+        """ Render all metrics in the Prometheus text exposition format. """
+        lines = []
+        with self._lock:
+            last_name = None
+            for (name, label_key), value in sorted(self._counters.items()):
+                if name != last_name:
+                    lines.append('# TYPE %s counter' % name)
+                    last_name = name
+                lines.append('%s%s %s' % (name, _format_labels(label_key), _format_value(value)))
+
+            last_name = None
+            for (name, label_key), value in sorted(self._gauges.items()):
+                if name != last_name:
+                    lines.append('# TYPE %s gauge' % name)
+                    last_name = name
+                lines.append('%s%s %s' % (name, _format_labels(label_key), _format_value(value)))
+
+            last_name = None
+            for (name, label_key), histogram in sorted(self._histograms.items()):
+                if name != last_name:
+                    lines.append('# TYPE %s histogram' % name)
+                    last_name = name
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name,
+                        _format_labels(label_key, [('le', _format_value(bound))]), cumulative))
+                lines.append('%s_bucket%s %d' % (name,
+                    _format_labels(label_key, [('le', '+Inf')]), histogram.count))
+                lines.append('%s_sum%s %s' % (name, _format_labels(label_key),
+                    _format_value(histogram.sum)))
+                lines.append('%s_count%s %d' % (name, _format_labels(label_key), histogram.count))
+        return '\n'.join(lines) + '\n' if lines else ''
+
+
+    def reset(self):
+        """ Drop all recorded values. Listeners are kept. """
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+
+#: The registry all of pwm records to.
+registry = Metrics()
+
+
+def instrument_engine(engine, metrics=None):
+    """ Time every SQL statement executed through a SQLAlchemy engine, and log the ones slower
+    than :data:`SLOW_QUERY_THRESHOLD`.
+    """
+    from sqlalchemy import event
+
+    metrics = metrics or registry
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # pylint: disable=unused-argument,too-many-arguments
+        conn.info.setdefault('pwm_query_start', []).append(timeit.default_timer())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # pylint: disable=unused-argument,too-many-arguments
+        duration = timeit.default_timer() - conn.info['pwm_query_start'].pop()
+        metrics.observe('pwm_sql_seconds', duration)
+        if duration > SLOW_QUERY_THRESHOLD:
+            metrics.increment('pwm_slow_queries_total')
+            _logger.info('Slow query (%.1fms): %s', duration*1000, statement)
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        # Don't leak start times of statements that never finished
+        if context.connection is not None:
+            starts = context.connection.info.get('pwm_query_start')
+            if starts:
+                starts.pop()
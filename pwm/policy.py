@@ -0,0 +1,236 @@
+"""
+    pwm.policy
+    ~~~~~~~~~~
+
+    Password policies, like requiring a digit and a symbol, or never using characters that are easy
+    to confuse.
+
+    Keys for domains with a policy aren't encoded from the digest directly. Instead every key of the
+    right length over the alphabet that satisfies the policy is numbered, and one of them is picked
+    uniformly with pseudorandom bytes expanded from the digest with HKDF. The policy is thus always
+    satisfied without deriving the digest again, and the number of such keys gives the exact entropy
+    of the key.
+
+"""
+
+from ._compat import bytes_to_int
+from .kdf import hkdf_sha256
+
+import collections
+import itertools
+import json
+import math
+
+# The most bytes HKDF-SHA256 can expand the digest to
+_MAX_EXPANSION = 255*32
+
+#: The character classes a policy can require a minimum number of.
+CLASSES = ('lower', 'upper', 'digit', 'symbol')
+
+
+def character_class(char):
+    """ Get the class in :data:`CLASSES` of a character. Anything that isn't a letter or a digit
+    is a symbol.
+    """
+    if char.isdigit():
+        return 'digit'
+    if char.islower():
+        return 'lower'
+    if char.isupper():
+        return 'upper'
+    return 'symbol'
+
+
+class Policy(object):
+    """ Rules keys for a domain must follow.
+
+    Characters appearing several times in the alphabet, like the digits of the 'full' preset, are
+    used just once for keys with a policy.
+
+    :param minimums: A dict with the minimum number of characters of each class in
+        :data:`CLASSES` in a key, like `{'digit': 1, 'symbol': 1}`.
+    :param exclude: Characters to never use in keys.
+    :raises ValueError: If a class is unknown or a minimum is negative.
+    """
+
+    def __init__(self, minimums=None, exclude=''):
+        self.minimums = {}
+        for name, count in (minimums or {}).items():
+            if name not in CLASSES:
+                raise ValueError('Unknown character class %s, expected one of %s' % (name,
+                    ', '.join(CLASSES)))
+            if not isinstance(count, int) or count < 0:
+                raise ValueError('The minimum number of %s characters must be a non-negative '
+                    'integer, got %r' % (name, count))
+            if count:
+                self.minimums[name] = count
+        self.exclude = ''.join(sorted(set(exclude or '')))
+
+
+    @classmethod
+    def parse(cls, spec):
+        """ Load a policy saved with :func:`Policy.dump <pwm.policy.Policy.dump>`.
+
+        :raises ValueError: If `spec` isn't a valid policy.
+        """
+        try:
+            data = json.loads(spec)
+        except ValueError:
+            raise ValueError('Invalid policy %r' % spec)
+        if not isinstance(data, dict):
+            raise ValueError('Invalid policy %r' % spec)
+        return cls(data.get('min'), data.get('exclude'))
+
+
+    def dump(self):
+        """ Serialize the policy to a string, like for storing it with the domain. Equal policies
+        give the same string.
+        """
+        data = {}
+        if self.minimums:
+            data['min'] = self.minimums
+        if self.exclude:
+            data['exclude'] = self.exclude
+        return json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+
+    def __eq__(self, other):
+        return isinstance(other, Policy) and self.dump() == other.dump()
+
+
+    def __ne__(self, other):
+        return not self == other
+
+
+    def __hash__(self):
+        return hash(self.dump())
+
+
+    def __repr__(self): # pragma: no cover
+        return 'Policy(minimums=%r, exclude=%r)' % (self.minimums, self.exclude)
+
+
+    def validate(self, alphabet, length):
+        """ Check that keys of `length` characters from `alphabet` can satisfy the policy.
+
+        :raises ValueError: If they can't.
+        """
+        _get_key_space(self, alphabet, length)
+
+
+    def entropy(self, alphabet, length):
+        """ The entropy in bits of keys of `length` characters from `alphabet` satisfying the
+        policy, given enough pseudorandom input.
+        """
+        return math.log(_get_key_space(self, alphabet, length).size, 2)
+
+
+    def encode(self, digest, alphabet, length):
+        """ Pick the key of `length` characters from `alphabet` satisfying the policy that `digest`
+        selects.
+        """
+        key_space = _get_key_space(self, alphabet, length)
+        return key_space.unrank(_uniform_index(digest, key_space.size))
+
+
+class _KeySpace(object):
+    """ Counts and numbers the keys of a given length satisfying a policy, by the number of
+    characters of each class that are still required.
+    """
+
+    def __init__(self, policy, alphabet, length):
+        classes = collections.OrderedDict((name, []) for name in CLASSES)
+        seen = set(policy.exclude)
+        for char in alphabet:
+            if char not in seen:
+                seen.add(char)
+                classes[character_class(char)].append(char)
+        for name, count in policy.minimums.items():
+            if not classes[name]:
+                raise ValueError('The policy requires %d %s characters, but the alphabet has none'
+                    % (count, name))
+        if sum(policy.minimums.values()) > length:
+            raise ValueError('The policy requires %d characters, but keys are only %d long' % (
+                sum(policy.minimums.values()), length))
+        self.classes = [''.join(chars) for chars in classes.values() if chars]
+        if not self.classes:
+            raise ValueError('The policy excludes every character of the alphabet')
+        self.length = length
+        self.minimums = tuple(policy.minimums.get(name, 0) for name, chars in classes.items()
+            if chars)
+
+        # _counts[n][needs] is the number of strings of n characters with at least needs[i]
+        # characters of class i
+        all_needs = list(itertools.product(*[range(count + 1) for count in self.minimums]))
+        self._counts = [dict((needs, 0 if any(needs) else 1) for needs in all_needs)]
+        for _ in range(length):
+            previous = self._counts[-1]
+            self._counts.append(dict((needs, sum(len(chars)*previous[self._satisfy(needs, i)]
+                for i, chars in enumerate(self.classes))) for needs in all_needs))
+        self.size = self._counts[length][self.minimums]
+        if (self.size - 1).bit_length() > 8*_MAX_EXPANSION:
+            raise ValueError('Keys with a policy can be at most %d bits, keys of %d characters '
+                'need %d' % (8*_MAX_EXPANSION, length, (self.size - 1).bit_length()))
+
+
+    @staticmethod
+    def _satisfy(needs, class_index):
+        """ What is still required after using a character of the given class. """
+        if not needs[class_index]:
+            return needs
+        return needs[:class_index] + (needs[class_index] - 1,) + needs[class_index + 1:]
+
+
+    def unrank(self, index):
+        """ Get the key numbered `index`, between 0 and :attr:`size`. """
+        needs = self.minimums
+        key = []
+        for remaining in reversed(range(self.length)):
+            for i, chars in enumerate(self.classes):
+                next_needs = self._satisfy(needs, i)
+                completions = self._counts[remaining][next_needs]
+                block = len(chars)*completions
+                if index < block:
+                    key.append(chars[index // completions])
+                    index %= completions
+                    needs = next_needs
+                    break
+                index -= block
+        return ''.join(key)
+
+
+def _uniform_index(digest, size):
+    """ Get an integer uniformly distributed between 0 and `size` from the digest. Rejects values
+    that are too large and tries the next block of the expansion, which is needed less than half
+    the time.
+    """
+    bits = (size - 1).bit_length()
+    if not bits:
+        return 0
+    for attempt in itertools.count():
+        info = ('pwm:policy:%d' % attempt).encode('ascii')
+        value = bytes_to_int(hkdf_sha256(digest, b'', info, (bits + 7) // 8)) & ((1 << bits) - 1)
+        if value < size:
+            return value
+
+
+_key_spaces = {}
+
+def _get_key_space(policy, alphabet, length):
+    key = (policy.dump(), alphabet, length)
+    key_space = _key_spaces.get(key)
+    if key_space is None:
+        key_space = _key_spaces.setdefault(key, _KeySpace(policy, alphabet, length))
+    return key_space
+
+
+_policies = {}
+
+def get_policy(spec):
+    """ Get a cached :class:`Policy` for a string from
+    :func:`Policy.dump <pwm.policy.Policy.dump>`, parsing it on first use.
+    """
+    policy = _policies.get(spec)
+    if policy is None:
+        policy = _policies.setdefault(spec, Policy.parse(spec))
+    return policy
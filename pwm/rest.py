@@ -0,0 +1,448 @@
+"""
+    pwm.rest
+    ~~~~~~~~
+
+    Client for pwm databases served over HTTP(S).
+
+    The server exposes `/get`. `GET /get?domain=<name>` returns a JSON object with the base64-encoded
+    `salt` of the domain, and optionally its `charset`, `key_length`, `username`, scrypt
+    parameters (`scrypt_n`, `scrypt_r` and `scrypt_p`), derivation `scheme`, base64-encoded
+    `master_salt`, key `policy` and `key_stream`. `POST /get` with a JSON body like
+    `{"domains": [<name>, ...]}` returns `{"domains": {<name>: {...}}}` for all the domains that
+    exist. Unknown domains get a 404 from the single lookup, and are left out of the batch
+    response. `GET /search?q=<query>` returns `{"domains": [{"name": <name>, ...}, ...]}` for the
+    domains matching the query like :func:`PWM.search <pwm.core.PWM.search>`, optionally with a
+    `limit` and `rank=1`.
+
+    Responses are cached on disk by :class:`SaltCache`, since salts only change when a domain is
+    given a new salt on the server. Cached entries are served directly for a while, then
+    revalidated with `If-None-Match` if the server sent an `ETag`, and served stale if the server
+    can't be reached.
+
+"""
+
+from .exceptions import NoSuchDomainException
+from .metrics import registry as metrics
+
+import base64
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import timeit
+from logging import getLogger
+
+_logger = getLogger('pwm.rest')
+
+DEFAULT_TIMEOUT = (3.05, 10)
+DEFAULT_RETRIES = 3
+DEFAULT_POOL_SIZE = 10
+
+DEFAULT_CACHE_TTL = 3600
+
+# Names per batch request, to keep request bodies reasonably sized
+BATCH_SIZE = 1000
+
+
+def default_cache_path():
+    return os.path.join(os.path.expanduser('~'), '.pwm', 'rest_cache.sqlite')
+
+
+def decode_domain(name, data):
+    """ Convert a domain from a server response to keyword arguments for
+    :class:`Domain <pwm.core.Domain>`.
+    """
+    values = {
+        'name': name,
+        'salt': base64.b64decode(data['salt']),
+    }
+    for key in ('charset', 'key_length', 'username', 'scrypt_n', 'scrypt_r', 'scrypt_p', 'scheme',
+            'policy', 'key_stream'):
+        if data.get(key) is not None:
+            values[key] = data[key]
+    if data.get('master_salt'):
+        values['master_salt'] = base64.b64decode(data['master_salt'])
+    return values
+
+
+def _search_params(query, limit, rank):
+    params = {'q': query}
+    if limit is not None:
+        params['limit'] = limit
+    if rank:
+        params['rank'] = 1
+    return params
+
+
+class SaltCache(object):
+    """ A small SQLite-backed cache of server responses, keyed by server and domain name.
+
+    :param path: Where to store the cache. Created, readable only by the current user, if it
+        doesn't exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._lock = threading.Lock()
+
+
+    def _connect(self):
+        if self._connection is None:
+            cache_dir = os.path.dirname(self.path)
+            if cache_dir and not os.path.exists(cache_dir):
+                os.makedirs(cache_dir, 0o700)
+            if not os.path.exists(self.path):
+                os.close(os.open(self.path, os.O_CREAT | os.O_WRONLY, 0o600))
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS salt_cache ('
+                'server TEXT, name TEXT, data TEXT, etag TEXT, fetched_at REAL, '
+                'PRIMARY KEY (server, name))')
+        return self._connection
+
+
+    def get(self, server, name):
+        """ Get a cached response.
+
+        :returns: A tuple `(data, etag, fetched_at)`, or None if nothing is cached.
+        """
+        with self._lock:
+            row = self._connect().execute('SELECT data, etag, fetched_at FROM salt_cache '
+                'WHERE server = ? AND name = ?', (server, name)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1], row[2]
+
+
+    def put(self, server, name, data, etag=None):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('INSERT OR REPLACE INTO salt_cache VALUES (?, ?, ?, ?, ?)',
+                    (server, name, json.dumps(data), etag, time.time()))
+
+
+    def put_many(self, server, domains):
+        """ Cache several responses without ETags, from a dict of domain name to data. """
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany('INSERT OR REPLACE INTO salt_cache VALUES (?, ?, ?, ?, ?)',
+                    [(server, name, json.dumps(data), None, now) for name, data in domains.items()])
+
+
+    def touch(self, server, name):
+        """ Mark a cached response as just revalidated. """
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('UPDATE salt_cache SET fetched_at = ? '
+                    'WHERE server = ? AND name = ?', (time.time(), server, name))
+
+
+    def delete(self, server, name):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('DELETE FROM salt_cache WHERE server = ? AND name = ?',
+                    (server, name))
+
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+class RestClient(object):
+    """ Keeps a pooled, keep-alive HTTP session to a pwm server.
+
+    :param base_url: The URL of the server, like `https://pwm.example.com`.
+    :param config: A dict with optional settings: `server_certificate` to pin the server
+        certificate, `auth` with a client certificate (a path, or a tuple of certificate and key
+        paths), `timeout` in seconds (or a tuple of connect and read timeouts), `retries` for
+        failed connections and 502-504 responses, `pool_size` for the maximum number of
+        connections to keep open, `cache_path` for where to cache salts (None to disable caching,
+        defaults to ~/.pwm/rest_cache.sqlite) and `cache_ttl` for the number of seconds to use
+        cached salts before revalidating them with the server.
+    """
+
+    def __init__(self, base_url, config=None):
+        self.base_url = base_url.rstrip('/')
+        self.config = config or {}
+        self._session = None
+        self._session_lock = threading.Lock()
+        cache_path = self.config.get('cache_path', default_cache_path())
+        self.cache = SaltCache(cache_path) if cache_path else None
+        self.cache_ttl = self.config.get('cache_ttl', DEFAULT_CACHE_TTL)
+
+
+    @property
+    def session(self):
+        """ The `requests.Session`, created with all the connection settings on first use. """
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+
+    def _create_session(self):
+        # Only needed for REST databases, and slow to import
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        session = requests.Session()
+        pool_size = self.config.get('pool_size', DEFAULT_POOL_SIZE)
+        retries = Retry(
+            total=self.config.get('retries', DEFAULT_RETRIES),
+            backoff_factor=0.1,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=None, # The batch lookup is a read-only POST, retry it too
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        verify = True
+        server_certificate = self.config.get('server_certificate')
+        if server_certificate:
+            verify = os.path.join(os.path.dirname(server_certificate), server_certificate)
+            _logger.debug('Pinning server with certificate at %s', verify)
+
+        # Test for SNI support on python 2
+        if sys.version_info < (3, 0, 0):
+            try:
+                import urllib3.contrib.pyopenssl
+                urllib3.contrib.pyopenssl.inject_into_urllib3()
+            except ImportError:
+                _logger.warning("Running on python 2 without SNI support, can't verify server certificates.")
+                verify = False
+        session.verify = verify
+
+        if self.config.get('auth'):
+            session.cert = self.config['auth']
+        return session
+
+
+    def get_domain(self, domain_name):
+        """ Look up a single domain, through the cache.
+
+        :returns: Keyword arguments for :class:`Domain <pwm.core.Domain>`.
+        :raises NoSuchDomainException: If the server doesn't know the domain.
+        """
+        return decode_domain(domain_name, self._get_domain_data(domain_name))
+
+
+    def _get_domain_data(self, domain_name):
+        data, cached, headers = self._check_cache(domain_name)
+        if data is not None:
+            return data
+
+        # Not imported until needed, to keep cache hits fast
+        import requests
+
+        try:
+            response = self._request('GET', params={'domain': domain_name}, headers=headers)
+        except (requests.ConnectionError, requests.Timeout) as ex:
+            data = self._use_stale(domain_name, cached, ex)
+            if data is None:
+                raise
+            return data
+        data = self._check_status(domain_name, cached, response.status_code)
+        if data is not None:
+            return data
+        response.raise_for_status()
+        data = response.json()
+        self._store(domain_name, data, response.headers.get('ETag'))
+        return data
+
+
+    def get_domains(self, domain_names):
+        """ Look up several domains. Freshly cached domains are served from the cache, the rest are
+        fetched in one request per :data:`BATCH_SIZE` names.
+
+        :returns: A dict from domain name to keyword arguments for
+            :class:`Domain <pwm.core.Domain>`, for the domains that exist.
+        """
+        domains, stale, to_fetch = self._check_cache_many(domain_names)
+        if not to_fetch:
+            return dict((name, decode_domain(name, data)) for name, data in domains.items())
+
+        import requests
+
+        for i in range(0, len(to_fetch), BATCH_SIZE):
+            batch = to_fetch[i:i+BATCH_SIZE]
+            try:
+                response = self._request('POST', json={'domains': batch})
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                remaining = self._use_stale_many(to_fetch[i:], stale, ex)
+                if remaining is None:
+                    raise
+                domains.update(remaining)
+                break
+            response.raise_for_status()
+            domains.update(self._store_many(batch, stale, response.json()['domains']))
+
+        return dict((name, decode_domain(name, data)) for name, data in domains.items())
+
+
+    def search(self, query, limit=None, rank=False):
+        """ Search the server for domains matching `query`, like
+        :func:`PWM.search <pwm.core.PWM.search>`. The matches are added to the cache.
+
+        :returns: A list of keyword arguments for :class:`Domain <pwm.core.Domain>`.
+        """
+        response = self._request('GET', path='/search', params=_search_params(query, limit, rank))
+        response.raise_for_status()
+        return self._store_search(response.json()['domains'])
+
+
+    # The steps of lookups that don't touch the network, shared with AsyncRestClient so the two
+    # clients cache and revalidate the same way. The steps using the cache block on sqlite3.
+
+    def _check_cache(self, domain_name):
+        """ Look up a domain in the cache before asking the server.
+
+        :returns: A tuple `(data, cached, headers)`, with the cached data if it's fresh enough to
+            use without asking the server, else None, the cache entry, and the headers to
+            revalidate the entry with.
+        """
+        cached = self.cache.get(self.base_url, domain_name) if self.cache else None
+        if cached and time.time() - cached[2] < self.cache_ttl:
+            metrics.increment('pwm_rest_cache_total', result='hit')
+            return cached[0], cached, None
+        headers = {}
+        if cached and cached[1]:
+            headers['If-None-Match'] = cached[1]
+        return None, cached, headers
+
+
+    def _use_stale(self, domain_name, cached, error):
+        """ Get the cached data for a domain when the server can't be reached, or None if it isn't
+        cached.
+        """
+        if not cached:
+            return None
+        _logger.warning('Could not reach %s, using cached salt for %s: %s', self.base_url,
+            domain_name, error)
+        metrics.increment('pwm_rest_cache_total', result='stale')
+        return cached[0]
+
+
+    def _check_status(self, domain_name, cached, status):
+        """ Handle the status of the response to a lookup.
+
+        :returns: The cached data if the server says it's still current, else None, to read the
+            domain from the response.
+        :raises NoSuchDomainException: If the server doesn't know the domain.
+        """
+        if status == 304 and cached:
+            metrics.increment('pwm_rest_cache_total', result='revalidated')
+            self.cache.touch(self.base_url, domain_name)
+            return cached[0]
+        metrics.increment('pwm_rest_cache_total', result='miss')
+        if status == 404:
+            if self.cache:
+                self.cache.delete(self.base_url, domain_name)
+            raise NoSuchDomainException(domain_name)
+        return None
+
+
+    def _store(self, domain_name, data, etag):
+        if self.cache:
+            self.cache.put(self.base_url, domain_name, data, etag)
+
+
+    def _check_cache_many(self, domain_names):
+        """ Look up several domains in the cache before asking the server.
+
+        :returns: A tuple `(domains, stale, to_fetch)`, with dicts from domain name to the data of
+            the freshly cached domains and of the ones needing revalidation, and a list of the
+            names to ask the server for.
+        """
+        domains = {}
+        stale = {}
+        to_fetch = []
+        for name in domain_names:
+            cached = self.cache.get(self.base_url, name) if self.cache else None
+            if cached and time.time() - cached[2] < self.cache_ttl:
+                domains[name] = cached[0]
+            else:
+                if cached:
+                    stale[name] = cached[0]
+                to_fetch.append(name)
+        if domains:
+            metrics.increment('pwm_rest_cache_total', len(domains), result='hit')
+        return domains, stale, to_fetch
+
+
+    def _use_stale_many(self, remaining, stale, error):
+        """ Get the cached data for the `remaining` names when the server can't be reached.
+
+        :returns: A dict from domain name to data, or None if any of them isn't cached.
+        """
+        if any(name not in stale for name in remaining):
+            return None
+        _logger.warning('Could not reach %s, using cached salts: %s', self.base_url, error)
+        metrics.increment('pwm_rest_cache_total', len(remaining), result='stale')
+        return dict((name, stale[name]) for name in remaining)
+
+
+    def _store_many(self, batch, stale, fetched):
+        """ Cache the domains fetched for a batch, forgetting cached domains the server doesn't
+        know any more.
+
+        :returns: `fetched`.
+        """
+        metrics.increment('pwm_rest_cache_total', len(batch), result='miss')
+        if self.cache:
+            self.cache.put_many(self.base_url, fetched)
+            for name in batch:
+                if name not in fetched and name in stale:
+                    self.cache.delete(self.base_url, name)
+        return fetched
+
+
+    def _store_search(self, results):
+        """ Cache the domains found by a search.
+
+        :returns: A list of keyword arguments for :class:`Domain <pwm.core.Domain>`.
+        """
+        domains = [(data.pop('name'), data) for data in results]
+        if self.cache:
+            self.cache.put_many(self.base_url, dict(domains))
+        return [decode_domain(name, data) for name, data in domains]
+
+
+    def _request(self, method, path='/get', **kwargs):
+        """ Send a request to the server, recording its duration as `pwm_rest_request_seconds`. """
+        start_time = timeit.default_timer()
+        status = 'error'
+        try:
+            response = self.session.request(method, self.base_url + path,
+                timeout=self._timeout(), **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            metrics.observe('pwm_rest_request_seconds', timeit.default_timer() - start_time,
+                method=method, status=status)
+
+
+    def close(self):
+        """ Close all pooled connections and the cache. """
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+        if self.cache:
+            self.cache.close()
+
+
+    def _timeout(self):
+        return self.config.get('timeout', DEFAULT_TIMEOUT)
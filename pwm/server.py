@@ -0,0 +1,458 @@
+"""
+    pwm.server
+    ~~~~~~~~~~
+
+    Serves a pwm database over HTTP(S), speaking the protocol described in :mod:`pwm.rest`. Used by
+    `pwm serve`.
+
+    Requests are handled by a fixed pool of threads, optionally in several worker processes forked
+    after the listening socket is bound. Every process looks up domains through its own pooled
+    engine, and keeps the responses in an in-memory cache. The cache is invalidated when domains
+    are modified through the same :class:`PWM <pwm.core.PWM>` instance, and cleared when another
+    process changes a SQLite database, which SQLite tells cheaply through `PRAGMA data_version`.
+    Changes to other databases show up when the cached entries expire. Sending SIGHUP to the server
+    clears the caches of all processes.
+
+    With a certificate the server only speaks HTTPS, and with a client CA it only accepts clients
+    presenting a certificate signed by it, matching the `server_certificate` and `auth` settings of
+    :class:`RestClient <pwm.rest.RestClient>`.
+
+"""
+
+from . import __version__
+from .cache import DomainCache
+from .core import (Domain, _chunks, _exported_domain, _exported_domains_query, _engines,
+    _search_statement)
+from .metrics import registry as metrics
+from .rest import BATCH_SIZE
+
+import hashlib
+import json
+import os
+import signal
+import sqlite3
+import ssl
+import sys
+import threading
+import timeit
+from logging import getLogger
+
+try:
+    import queue
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import parse_qs, urlparse
+except ImportError: # pragma: no cover
+    import Queue as queue
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import parse_qs, urlparse
+
+_logger = getLogger('pwm.server')
+
+DEFAULT_THREADS = 32
+DEFAULT_CACHE_TTL = 60
+DEFAULT_CACHE_SIZE = 100000
+
+# The most names accepted in a single batch request, and the largest accepted request body
+MAX_BATCH_SIZE = 10*BATCH_SIZE
+MAX_BODY_SIZE = 4*1024*1024
+
+# Keep-alive connections occupy a thread while open, so close them after being idle for this long
+IDLE_TIMEOUT = 15
+
+
+def _etag(data):
+    digest = hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf8')).hexdigest()
+    return '"%s"' % digest[:32]
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'pwm/%s' % __version__
+    # Headers and body are written separately, avoid stalling on delayed ACKs
+    disable_nagle_algorithm = True
+    timeout = IDLE_TIMEOUT
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/get':
+            self._timed('get', self._get_domain, url)
+        elif url.path == '/search':
+            self._timed('search', self._search, url)
+        elif url.path == '/metrics':
+            self._timed('metrics', self._get_metrics)
+        else:
+            self._respond(404, {'error': 'not_found'})
+
+
+    def do_POST(self):
+        if urlparse(self.path).path == '/get':
+            self._timed('batch', self._get_domains)
+        else:
+            self._respond(404, {'error': 'not_found'})
+
+
+    def _timed(self, endpoint, handler, *args):
+        start_time = timeit.default_timer()
+        status = handler(*args)
+        metrics.observe('pwm_server_request_seconds', timeit.default_timer() - start_time,
+            endpoint=endpoint, status=status)
+
+
+    def _get_domain(self, url):
+        names = parse_qs(url.query).get('domain')
+        if not names:
+            return self._respond(400, {'error': 'missing_domain'})
+        data = self.server.service.get_domains(names[:1]).get(names[0])
+        if data is None:
+            return self._respond(404, {'error': 'no_such_domain'})
+        etag = _etag(data)
+        if etag in self.headers.get('If-None-Match', ''):
+            return self._respond(304, None, etag)
+        return self._respond(200, data, etag)
+
+
+    def _get_domains(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY_SIZE:
+            self.close_connection = True
+            return self._respond(413, {'error': 'too_large'})
+        try:
+            names = json.loads(self.rfile.read(length).decode('utf8'))['domains']
+            if not isinstance(names, list) or not all(isinstance(name, type(u''))
+                    for name in names):
+                raise ValueError()
+        except (ValueError, KeyError, TypeError):
+            return self._respond(400, {'error': 'bad_request'})
+        if len(names) > MAX_BATCH_SIZE:
+            return self._respond(413, {'error': 'too_many_domains'})
+        return self._respond(200, {'domains': self.server.service.get_domains(names)})
+
+
+    def _search(self, url):
+        params = parse_qs(url.query)
+        query = params.get('q', [''])[0]
+        if not query:
+            return self._respond(400, {'error': 'missing_query'})
+        try:
+            limit = int(params['limit'][0]) if 'limit' in params else None
+            # Negative limits mean no limit to SQLite, which would get past MAX_BATCH_SIZE
+            if limit is not None and limit < 1:
+                raise ValueError()
+        except ValueError:
+            return self._respond(400, {'error': 'bad_request'})
+        rank = params.get('rank', ['0'])[0] == '1'
+        return self._respond(200, {'domains': self.server.service.search(query, limit, rank)})
+
+
+    def _get_metrics(self):
+        body = metrics.to_prometheus().encode('utf8')
+        return self._send(200, body, 'text/plain; version=0.0.4')
+
+
+    def _respond(self, status, data, etag=None):
+        body = json.dumps(data).encode('utf8') if data is not None else b''
+        return self._send(status, body, 'application/json', etag)
+
+
+    def _send(self, status, body, content_type, etag=None):
+        self.send_response(status)
+        if status != 304:
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+        return status
+
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        _logger.debug('%s - %s', self.address_string(), format % args)
+
+
+class _ThreadPoolHTTPServer(HTTPServer):
+    """ Hands connections to a fixed number of threads, instead of a thread per connection. TLS
+    handshakes happen in those threads too, so a slow client can't block accepting connections.
+    """
+
+    def __init__(self, address, service, threads, ssl_context=None):
+        HTTPServer.__init__(self, address, _RequestHandler)
+        self.service = service
+        self.ssl_context = ssl_context
+        self.threads = threads
+        self._connections = None
+        self._threads = []
+
+
+    def serve_forever(self, poll_interval=0.5):
+        # Threads don't survive forking, so they're started by the process that serves
+        self._connections = queue.Queue()
+        for _ in range(self.threads):
+            thread = threading.Thread(target=self._process_connections)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        HTTPServer.serve_forever(self, poll_interval)
+
+
+    def process_request(self, request, client_address):
+        self._connections.put((request, client_address))
+
+
+    def _process_connections(self):
+        while True:
+            connection = self._connections.get()
+            if connection is None:
+                return
+            request, client_address = connection
+            try:
+                self.finish_request(request, client_address)
+            except Exception: # pylint: disable=broad-except
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+    def finish_request(self, request, client_address):
+        if self.ssl_context is None:
+            return HTTPServer.finish_request(self, request, client_address)
+        request.settimeout(IDLE_TIMEOUT)
+        tls_request = self.ssl_context.wrap_socket(request, server_side=True)
+        try:
+            HTTPServer.finish_request(self, tls_request, client_address)
+        finally:
+            tls_request.close()
+
+
+    def handle_error(self, request, client_address):
+        _logger.debug('Request from %s failed', client_address[0], exc_info=True)
+
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        for _ in self._threads:
+            self._connections.put(None)
+        self._threads = []
+
+
+class Server(object):
+    """ Serves the domains of a :class:`PWM <pwm.core.PWM>` database.
+
+    :param pwm: The :class:`PWM <pwm.core.PWM>` instance to serve. Give it a `pool_size` matching
+        `threads`, so every thread can get a connection.
+    :param address: A `(host, port)` tuple to listen on. Port 0 picks a free port.
+    :param threads: The number of requests to handle concurrently, per process.
+    :param cache_ttl: Seconds to cache responses for. Changes made through `pwm`, or by other
+        processes to SQLite databases, invalidate the cache right away. Changes made by other
+        processes to other databases show up within this time.
+    :param cache_size: The maximum number of domains to cache, per process.
+    :param ssl_context: A server-side :class:`ssl.SSLContext` to serve HTTPS with, see
+        :func:`create_ssl_context`.
+    """
+
+    def __init__(self, pwm, address=('127.0.0.1', 8080), threads=DEFAULT_THREADS,
+            cache_ttl=DEFAULT_CACHE_TTL, cache_size=DEFAULT_CACHE_SIZE, ssl_context=None):
+        self.pwm = pwm
+        self.address = address
+        self.threads = threads
+        self.ssl_context = ssl_context
+        self.cache = DomainCache(cache_ttl, cache_size)
+        self.pwm.add_change_listener(self.cache.invalidate)
+        self._server = None
+        self._data_version_connection = None
+        self._data_version = None
+        self._data_version_lock = threading.Lock()
+
+
+    def bind(self):
+        """ Start listening, returning the address bound to. """
+        self._server = _ThreadPoolHTTPServer(self.address, self, self.threads, self.ssl_context)
+        return self._server.server_address
+
+
+    def serve_forever(self):
+        if self._server is None:
+            self.bind()
+        self._server.serve_forever()
+
+
+    def shutdown(self):
+        """ Stop :func:`serve_forever <Server.serve_forever>`, from another thread. """
+        self._server.shutdown()
+
+
+    def close(self):
+        if self._server is not None:
+            self._server.server_close()
+            self._server = None
+        self.pwm.remove_change_listener(self.cache.invalidate)
+        self._close_data_version_connection()
+
+
+    def _check_data_version(self):
+        """ Clear the cache if another connection has changed a SQLite database since the last
+        check. Takes a few microseconds, through a connection of its own that is never used for
+        anything else, since the data version only reflects the changes of other connections.
+        """
+        engine = self.pwm._get_engine()
+        database = engine.url.database
+        if engine.dialect.name != 'sqlite' or not database or database == ':memory:':
+            return
+        with self._data_version_lock:
+            if self._data_version_connection is None:
+                self._data_version_connection = sqlite3.connect(database,
+                    check_same_thread=False)
+            data_version = self._data_version_connection.execute(
+                'PRAGMA data_version').fetchone()[0]
+            changed = self._data_version is not None and data_version != self._data_version
+            self._data_version = data_version
+        if changed:
+            _logger.debug('Database changed by another process, clearing the cache')
+            self.cache.clear()
+
+
+    def _close_data_version_connection(self):
+        with self._data_version_lock:
+            if self._data_version_connection is not None:
+                self._data_version_connection.close()
+                self._data_version_connection = None
+                self._data_version = None
+
+
+    def search(self, query, limit=None, rank=False):
+        """ Search for domains, like :func:`PWM.search <pwm.core.PWM.search>`, returning at most
+        :data:`MAX_BATCH_SIZE` of them.
+
+        :returns: A list of the responses for the matching domains, with their `name` added.
+        """
+        limit = max(1, min(limit, MAX_BATCH_SIZE)) if limit is not None else MAX_BATCH_SIZE
+        # Through a connection of its own, the session of the PWM instance isn't thread-safe
+        statement = _search_statement(query, limit, rank, self.pwm._uses_fts_index())
+        with self.pwm._get_engine().connect() as connection:
+            names = list(connection.execute(statement.with_only_columns(
+                Domain.__table__.c.name)).scalars())
+        found = self.get_domains(names)
+        return [dict(found[name], name=name) for name in names if name in found]
+
+
+    def get_domains(self, domain_names):
+        """ Look up domains through the cache.
+
+        :returns: A dict from domain name to the response for the domain, for the domains that
+            exist.
+        """
+        self._check_data_version()
+        found = {}
+        missing = []
+        for name in domain_names:
+            data = self.cache.get(name)
+            if data is None:
+                missing.append(name)
+            else:
+                found[name] = data
+        if found:
+            metrics.increment('pwm_server_cache_total', len(found), result='hit')
+        if not missing:
+            return found
+
+        metrics.increment('pwm_server_cache_total', len(missing), result='miss')
+        generation = self.cache.generation
+        names = Domain.__table__.c.name
+        with self.pwm._get_engine().connect() as connection:
+            for chunk in _chunks(missing):
+                query = _exported_domains_query().where(names.in_(chunk))
+                for row in connection.execute(query):
+                    data = dict((key, value) for key, value in _exported_domain(row).items()
+                        if value is not None and key != 'name')
+                    found[row.name] = data
+                    self.cache.put(row.name, data, generation)
+        return found
+
+
+def create_ssl_context(certificate, key=None, client_ca=None):
+    """ Create a context for serving HTTPS.
+
+    :param certificate: Path to the server certificate, optionally with the key in the same file.
+    :param key: Path to the key of the server certificate.
+    :param client_ca: If given, path to the certificate(s) that client certificates must be
+        signed by. Clients without a valid certificate are rejected.
+    """
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certificate, key)
+    if client_ca:
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_verify_locations(client_ca)
+    return context
+
+
+def run(server, workers=1):
+    """ Serve until interrupted or terminated, in `workers` processes forked after binding.
+    Workers that die are replaced.
+    """
+    host, port = server.bind()[:2]
+    _logger.info('Serving on %s://%s:%d with %d worker(s) of %d threads',
+        'https' if server.ssl_context else 'http', host, port, workers, server.threads)
+    if workers <= 1 or not hasattr(os, 'fork'):
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame: server.cache.clear())
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+        return
+
+    children = set()
+    stopping = []
+    def forward(signum, frame): # pylint: disable=unused-argument
+        if signum != signal.SIGHUP:
+            stopping.append(signum)
+        for pid in children:
+            os.kill(pid, signum)
+    signal.signal(signal.SIGHUP, forward)
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    try:
+        while True:
+            while len(children) < workers and not stopping:
+                children.add(_fork_worker(server))
+            if not children:
+                break
+            try:
+                pid, _ = os.wait()
+            except OSError: # pragma: no cover
+                # Interrupted by a signal on python 2
+                continue
+            children.discard(pid)
+            if not stopping:
+                _logger.warning('Worker %d exited, starting a new one', pid)
+    finally:
+        server.close()
+
+
+def _fork_worker(server):
+    pid = os.fork()
+    if pid:
+        return pid
+    exit_code = 0
+    try:
+        # Connections can't be shared with the parent, start over with fresh pools
+        for engine in list(_engines.values()):
+            engine.dispose(close=False)
+        server._data_version_connection = None
+        server._data_version = None
+        signal.signal(signal.SIGHUP, lambda signum, frame: server.cache.clear())
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        signal.signal(signal.SIGINT, lambda signum, frame: sys.exit(0))
+        server.serve_forever()
+    except SystemExit:
+        pass
+    except BaseException: # pylint: disable=broad-except
+        _logger.exception('Worker %d failed', os.getpid())
+        exit_code = 1
+    finally:
+        os._exit(exit_code)
@@ -23,6 +23,8 @@ if sys.version_info < (2, 7, 0):
     install_requires.append('argparse')
 
 extras = {}
+extras['numpy'] = ['numpy']
+extras['async'] = ['sqlalchemy[asyncio]', 'aiosqlite', 'aiohttp']
 extras['test'] = ['nose', 'coverage']
 extras['dev'] = extras['test'] + ['tox', 'nosy', 'sphinx']
 
@@ -0,0 +1,111 @@
+from pwm import PWM, AgentDatabaseException, AgentLockedException, NoSuchDomainException
+from pwm.agent import Agent, AgentClient
+from pwm.core import SCHEME_MASTER_KEY
+from pwm.metrics import registry
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+
+class AgentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pwm = PWM()
+        self.pwm.bootstrap(os.path.join(self.tmp_dir, 'db.sqlite'))
+        self.pwm.create_domain('example.com', username='me@example.com')
+        self.socket_path = os.path.join(self.tmp_dir, 'agent.sock')
+        self.agent = Agent(self.pwm, socket_path=self.socket_path, ttl=60)
+        self.agent.bind()
+        self.server_thread = threading.Thread(target=self.agent._server.serve_forever)
+        self.server_thread.start()
+        self.client = AgentClient(self.socket_path)
+
+
+    def tearDown(self):
+        self.agent.shutdown()
+        self.server_thread.join()
+        self.agent.close()
+        self.pwm.dispose()
+        shutil.rmtree(self.tmp_dir)
+
+
+    def test_get(self):
+        self.agent.unlock('secret')
+        expected = self.pwm.get_domain('example.com').derive_key('secret')
+        self.assertEqual(self.client.get('example.com'), (expected, 'me@example.com'))
+        # second lookup is served from the cache
+        self.assertEqual(self.client.get('example.com'), (expected, 'me@example.com'))
+
+
+    def test_master_key_scheme(self):
+        names = ['first.com', 'second.com']
+        for name in names:
+            self.pwm.create_domain(name, scheme=SCHEME_MASTER_KEY)
+        expected = [self.pwm.get_domain(name).derive_key('secret') for name in names]
+        self.agent.unlock('secret')
+        registry.reset()
+        self.assertEqual([self.client.get(name)[0] for name in names], expected)
+        # The master password is only stretched once
+        self.assertEqual(registry.get_histogram('pwm_scrypt_seconds')[0], 1)
+
+
+    def test_locked(self):
+        self.assertRaises(AgentLockedException, self.client.get, 'example.com')
+        expected = self.pwm.get_domain('example.com').derive_key('secret')
+        key, _ = self.client.get('example.com', master_password='secret')
+        self.assertEqual(key, expected)
+
+        self.client.lock()
+        self.assertRaises(AgentLockedException, self.client.get, 'example.com')
+
+
+    def test_expiry(self):
+        self.agent.ttl = 0.01
+        self.agent.unlock('secret')
+        time.sleep(0.02)
+        self.assertRaises(AgentLockedException, self.client.get, 'example.com')
+
+
+    def test_nonexistent_domain(self):
+        self.agent.unlock('secret')
+        self.assertRaises(NoSuchDomainException, self.client.get, 'neverheardofthis')
+
+
+    def test_forget(self):
+        self.agent.unlock('secret')
+        old_key, _ = self.client.get('example.com')
+        self.pwm.modify_domain('example.com', new_salt=True)
+        self.assertEqual(self.client.get('example.com')[0], old_key)
+        self.client.forget('example.com')
+        self.assertNotEqual(self.client.get('example.com')[0], old_key)
+
+
+    def test_other_database(self):
+        self.agent.unlock('secret')
+        expected = self.pwm.get_domain('example.com').derive_key('secret')
+        db_path = os.path.join(self.tmp_dir, 'db.sqlite')
+        for database in (db_path, os.path.relpath(db_path), 'sqlite:///' + db_path):
+            self.assertEqual(self.client.get('example.com', database=database)[0], expected)
+        # Like PWM_DATABASE pointing at another database than the agent serves
+        self.assertRaises(AgentDatabaseException, self.client.get, 'example.com',
+            database=os.path.join(self.tmp_dir, 'other.sqlite'))
+        self.assertRaises(AgentDatabaseException, self.client.get, 'example.com',
+            database='https://pwm.example.com')
+
+
+    def test_socket_permissions(self):
+        self.assertEqual(os.stat(self.socket_path).st_mode & 0o777, 0o600)
+
+
+class AgentClientTest(unittest.TestCase):
+
+    def test_no_agent(self):
+        client = AgentClient(os.path.join(tempfile.gettempdir(), 'nonexistent-pwm-agent.sock'))
+        self.assertFalse(client.is_running())
+        self.assertRaises(socket.error, client.get, 'example.com')
@@ -0,0 +1,169 @@
+from pwm import PWM, DuplicateDomainException, NoSuchDomainException
+from pwm.core import Domain
+
+from test_rest import StandInServer
+
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+
+try:
+    import aiohttp
+    import aiosqlite
+    from pwm.aio import AsyncPWM, _async_db_uri
+except ImportError: # pragma: no cover
+    AsyncPWM = None
+
+
+@unittest.skipIf(AsyncPWM is None, 'async extras not installed')
+class AsyncPWMTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_db = tempfile.NamedTemporaryFile(delete=False)
+        self.tmp_db.close()
+        pwm = PWM()
+        pwm.bootstrap(self.tmp_db.name)
+        pwm.import_domains([
+            {'name': 'example.com', 'salt': 'TmFDbA=='},
+            {'name': 'otherexample.com'},
+            {'name': 'facebook.com'},
+        ])
+        pwm.dispose()
+        self.pwm = AsyncPWM(self.tmp_db.name, max_workers=2)
+
+
+    def tearDown(self):
+        self.run_async(self.pwm.close())
+        os.remove(self.tmp_db.name)
+
+
+    def run_async(self, coroutine):
+        return asyncio.new_event_loop().run_until_complete(coroutine)
+
+
+    def test_get_domain(self):
+        async def test():
+            domain = await self.pwm.get_domain('example.com')
+            self.assertEqual(domain.salt, b'NaCl')
+            with self.assertRaises(NoSuchDomainException):
+                await self.pwm.get_domain('neverheardofthis')
+            domains = await self.pwm.get_domains(['facebook.com', 'example.com'])
+            self.assertEqual([d.name for d in domains], ['facebook.com', 'example.com'])
+            await self.pwm.close()
+        self.run_async(test())
+
+
+    def test_search(self):
+        async def test():
+            results = await self.pwm.search('example', rank=True)
+            self.assertEqual([d.name for d in results], ['example.com', 'otherexample.com'])
+            self.assertEqual(len(await self.pwm.search('fa')), 1)
+            await self.pwm.close()
+        self.run_async(test())
+
+
+    def test_create_and_modify(self):
+        async def test():
+            domain = await self.pwm.create_domain('new.com', username='me')
+            with self.assertRaises(DuplicateDomainException):
+                await self.pwm.create_domain('new.com')
+            modified = await self.pwm.modify_domain('new.com', new_salt=True, username='you')
+            self.assertNotEqual(modified.salt, domain.salt)
+            fetched = await self.pwm.get_domain('new.com')
+            self.assertEqual((fetched.salt, fetched.username), (modified.salt, 'you'))
+            with self.assertRaises(NoSuchDomainException):
+                await self.pwm.modify_domain('neverheardofthis')
+            await self.pwm.close()
+        self.run_async(test())
+
+
+    def test_sync_after_changes(self):
+        source = PWM(self.tmp_db.name)
+        tmp_db = tempfile.NamedTemporaryFile(delete=False)
+        tmp_db.close()
+        other_pwm = PWM()
+        try:
+            other_pwm.bootstrap(tmp_db.name)
+            self.assertEqual(other_pwm.sync_from(source), (3, 0, 0))
+
+            async def test():
+                await self.pwm.create_domain('new.com')
+                await self.pwm.modify_domain('facebook.com', new_salt=True)
+                await self.pwm.close()
+            self.run_async(test())
+            self.assertEqual(other_pwm.sync_from(source), (1, 1, 0))
+            for name in ('new.com', 'facebook.com'):
+                self.assertEqual(other_pwm.get_domain(name).salt, source.get_domain(name).salt)
+        finally:
+            other_pwm.dispose()
+            source.dispose()
+            os.remove(tmp_db.name)
+
+
+    def test_create_with_scrypt_params(self):
+        async def test():
+            self.assertEqual(await self.pwm.get_scrypt_params(), (1<<14, 8, 1))
+            domain = await self.pwm.create_domain('cheap.com', scrypt_n=1<<10)
+            fetched = await self.pwm.get_domain('cheap.com')
+            self.assertEqual(fetched.scrypt_params, (1<<10, 8, 1))
+            self.assertEqual(await self.pwm.derive_key(fetched, 'secret'),
+                domain.derive_key('secret'))
+            await self.pwm.close()
+        self.run_async(test())
+
+
+    def test_derive_key(self):
+        expected = Domain(name='example.com', salt=b'NaCl').derive_key('secret')
+        async def test():
+            keys = await asyncio.gather(*[self.pwm.derive_key('example.com', 'secret')
+                for _ in range(4)])
+            self.assertEqual(keys, [expected] * 4)
+            await self.pwm.close()
+        self.run_async(test())
+
+
+    def test_async_db_uri(self):
+        self.assertEqual(_async_db_uri('sqlite:///foo.db'), 'sqlite+aiosqlite:///foo.db')
+        self.assertEqual(_async_db_uri('postgresql://u@h/db'), 'postgresql+asyncpg://u@h/db')
+        self.assertEqual(_async_db_uri('sqlite+pysqlite:///foo'), 'sqlite+pysqlite:///foo')
+
+
+@unittest.skipIf(AsyncPWM is None, 'async extras not installed')
+class AsyncPWMRestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.pwm = AsyncPWM('http://127.0.0.1:%d' % self.server.server_port,
+            config={'cache_path': None})
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+
+
+    def test_get_domain(self):
+        async def test():
+            domain = await self.pwm.get_domain('example.com')
+            self.assertEqual((domain.salt, domain.username), (b'NaCl', 'me'))
+            with self.assertRaises(NoSuchDomainException):
+                await self.pwm.get_domain('neverheardofthis')
+            domains = await self.pwm.get_domains(['facebook.com', 'example.com'])
+            self.assertEqual([d.key_length for d in domains], [8, Domain.DEFAULT_KEY_LENGTH])
+            await self.pwm.close()
+        asyncio.new_event_loop().run_until_complete(test())
+
+
+    def test_search(self):
+        async def test():
+            domains = await self.pwm.search('.com')
+            self.assertEqual([d.name for d in domains], ['example.com', 'facebook.com'])
+            self.assertEqual(domains[0].salt, b'NaCl')
+            self.assertEqual(await self.pwm.search('nothing'), [])
+            await self.pwm.close()
+        asyncio.new_event_loop().run_until_complete(test())
@@ -0,0 +1,29 @@
+from benchmarks.suite import compare, measure
+
+import unittest
+
+
+class BenchmarkSuiteTest(unittest.TestCase):
+
+    def test_measure(self):
+        stats = measure(lambda: None, number=10, repeat=3)
+        self.assertEqual(stats['calls'], 30)
+        self.assertTrue(stats['min'] <= stats['median'])
+
+
+    def test_compare(self):
+        baseline = {'results': {
+            'fast': {'median': 1.0},
+            'slow': {'median': 1.0},
+            'removed': {'median': 1.0},
+        }}
+        current = {'results': {
+            'fast': {'median': 0.5},
+            'slow': {'median': 1.5},
+            'added': {'median': 1.0},
+        }}
+        self.assertEqual(compare(baseline, current, threshold=0.2), [
+            ('fast', 1.0, 0.5, 0.5, False),
+            ('slow', 1.0, 1.5, 1.5, True),
+        ])
+        self.assertFalse(compare(baseline, current, threshold=0.6)[1][4])
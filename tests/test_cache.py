@@ -0,0 +1,45 @@
+from pwm.cache import DomainCache
+
+import time
+import unittest
+
+
+class DomainCacheTest(unittest.TestCase):
+
+    def test_lru(self):
+        cache = DomainCache(ttl=60, max_size=2)
+        cache.put('a', 1, cache.generation)
+        cache.put('b', 2, cache.generation)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3, cache.generation)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+
+    def test_ttl(self):
+        cache = DomainCache(ttl=0.01)
+        cache.put('a', 1, cache.generation)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+
+
+    def test_invalidate(self):
+        cache = DomainCache()
+        generation = cache.generation
+        cache.put('a', 1, generation)
+        cache.invalidate('a')
+        self.assertIsNone(cache.get('a'))
+
+        # A response fetched before the invalidation is not cached
+        cache.put('a', 1, generation)
+        self.assertIsNone(cache.get('a'))
+
+
+    def test_stats(self):
+        cache = DomainCache(max_size=1)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', 1, cache.generation)
+        cache.get('a')
+        cache.put('b', 2, cache.generation)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
@@ -1,8 +1,17 @@
-from pwm import Domain, PWM, DuplicateDomainException, NotReadyException, NoSuchDomainException
-from pwm.core import Base, _urify_db
-
+from pwm import (Domain, PWM, Policy, DuplicateDomainException, NotReadyException,
+    NoSuchDomainException, OutdatedDatabaseException)
+from pwm.core import (Base, DerivationScheduler, DomainSnapshot, SCHEME_MASTER_KEY, _urify_db,
+    calibrate_scrypt, get_engine, scheduler, scrypt_memory_cost, stretch_master_password,
+    validate_scrypt_params)
+from pwm.derive import _derive_key, key_args
+from pwm.index import index_path, open_index
+from pwm.metrics import registry
+
+import math
 import os
 import tempfile
+import threading
+import time
 import unittest
 import sqlalchemy as sa
 from sqlalchemy.orm import sessionmaker
@@ -16,6 +25,30 @@ class DomainTest(unittest.TestCase):
         self.assertEqual(domain.derive_key('secret'), expected)
 
 
+    def test_scrypt_params(self):
+        domain = Domain(name='example.com', salt=b'NaCl')
+        self.assertEqual(domain.scrypt_params, (1<<14, 8, 1))
+        explicit_defaults = Domain(name='example.com', salt=b'NaCl', scrypt_n=1<<14, scrypt_r=8,
+            scrypt_p=1)
+        self.assertEqual(explicit_defaults.derive_key('secret'), domain.derive_key('secret'))
+        cheaper = Domain(name='example.com', salt=b'NaCl', scrypt_n=1<<10)
+        self.assertEqual(cheaper.scrypt_params, (1<<10, 8, 1))
+        self.assertNotEqual(cheaper.derive_key('secret'), domain.derive_key('secret'))
+
+
+    def test_master_key_scheme(self):
+        domain = Domain(name='example.com', salt=b'NaCl', scheme=SCHEME_MASTER_KEY,
+            master_salt=b'pepper')
+        expected = 'Jg;9;K0gL.8uk1GY'
+        self.assertEqual(domain.derive_key('secret'), expected)
+        master_key = stretch_master_password('secret', b'pepper')
+        self.assertEqual(domain.derive_key('secret', master_key=master_key), expected)
+
+        other_domain = Domain(name='other.com', salt=b'NaCl', scheme=SCHEME_MASTER_KEY,
+            master_salt=b'pepper')
+        self.assertNotEqual(other_domain.derive_key('secret', master_key=master_key), expected)
+
+
     def test_entropy_measure(self):
         domain = Domain(charset='01', key_length=1)
         self.assertEqual(domain.entropy, 1)
@@ -25,6 +58,52 @@ class DomainTest(unittest.TestCase):
         self.assertEqual(domain.entropy, 4)
         domain = Domain(charset='aabb', key_length=2)
         self.assertEqual(domain.entropy, 2)
+        # Repeated characters are more likely, and lower the entropy
+        domain = Domain(charset='aab', key_length=1)
+        self.assertAlmostEqual(domain.entropy, 0.918, places=3)
+        # Keys can't be more random than the digest they are encoded from
+        domain = Domain(charset='01', key_length=1000)
+        self.assertEqual(domain.entropy, 512)
+
+        # Keys of two characters from 'abc1' with a digit: a1, 1a, b1, 1b, c1, 1c and 11
+        domain = Domain(charset='abc1', key_length=2, policy=Policy({'digit': 1}))
+        self.assertAlmostEqual(domain.entropy, math.log(7, 2))
+        domain = Domain(charset='abc1', key_length=2, policy=Policy({'digit': 1}, exclude='c'))
+        self.assertAlmostEqual(domain.entropy, math.log(5, 2))
+
+
+    def test_long_keys(self):
+        # Domains from before keys could be streamed are cut off where the digest runs out
+        domain = Domain(name='example.com', salt=b'NaCl', key_length=200)
+        legacy_key = domain.derive_key('secret')
+        self.assertEqual(len(legacy_key), 78)
+
+        domain.key_stream = True
+        key = domain.derive_key('secret')
+        self.assertEqual(len(key), 200)
+        self.assertTrue(key.startswith(legacy_key))
+        self.assertEqual(''.join(domain.stream_key('secret')), key)
+
+        # Keys the digest is long enough for are the same either way
+        domain.key_length = 16
+        self.assertEqual(domain.derive_key('secret'), '|efhesDIl)/RvB&Q')
+
+        domain.key_length = 100000
+        self.assertEqual(sum(len(chars) for chars in domain.stream_key('secret')), 100000)
+
+
+    def test_policy(self):
+        policy = Policy({'digit': 2, 'symbol': 1, 'upper': 1}, exclude='Il0O')
+        domain = Domain(name='example.com', salt=b'NaCl', policy=policy)
+        self.assertEqual(domain.key_policy, policy)
+        key = domain.derive_key('secret')
+        self.assertEqual(len(key), 16)
+        self.assertTrue(sum(char.isdigit() for char in key) >= 2)
+        self.assertTrue(any(char.isupper() for char in key))
+        self.assertTrue(any(not char.isalnum() for char in key))
+        self.assertFalse(set(key) & set('Il0O'))
+        self.assertEqual(domain.derive_key('secret'), key)
+        self.assertNotEqual(Domain(name='example.com', salt=b'NaCl').derive_key('secret'), key)
 
 
 class PWMCoreTest(unittest.TestCase):
@@ -45,6 +124,8 @@ class PWMCoreTest(unittest.TestCase):
 
 
     def tearDown(self):
+        self.session.close()
+        self.pwm.dispose()
         os.remove(self.tmp_db.name)
 
 
@@ -74,12 +155,260 @@ class PWMCoreTest(unittest.TestCase):
         self.assertEqual(len(results), 0)
 
 
+    def test_search_uses_index(self):
+        self.assertTrue(self.pwm._uses_fts_index())
+
+
+    def test_search_finds_new_domains(self):
+        self.pwm.create_domain('examplebank.com')
+        results = self.pwm.search('BANK')
+        self.assertEqual([domain.name for domain in results], ['examplebank.com'])
+
+
+    def test_search_short_query(self):
+        results = self.pwm.search('fa')
+        self.assertEqual([domain.name for domain in results], ['facebook.com'])
+
+
+    def test_search_limit_and_rank(self):
+        self.pwm.create_domain('example')
+        results = self.pwm.search('example')
+        self.assertEqual([domain.name for domain in results],
+            ['example', 'example.com', 'otherexample.com'])
+        results = self.pwm.search('example', limit=1)
+        self.assertEqual(len(results), 1)
+        results = self.pwm.search('example.com', rank=True)
+        self.assertEqual([domain.name for domain in results], ['example.com', 'otherexample.com'])
+        results = self.pwm.search('exam', rank=True, limit=2)
+        self.assertEqual([domain.name for domain in results], ['example', 'example.com'])
+
+
+    def test_search_without_index(self):
+        # Databases created before the search index existed should still be searchable
+        engine = sa.create_engine('sqlite:///%s' % self.tmp_db.name)
+        with engine.begin() as connection:
+            connection.execute(sa.text('DROP TABLE domain_search'))
+            for trigger in ('insert', 'update', 'delete'):
+                connection.execute(sa.text('DROP TRIGGER domain_search_%s' % trigger))
+        engine.dispose()
+        pwm = PWM(self.tmp_db.name)
+        self.assertFalse(pwm._uses_fts_index())
+        self.assertEqual(len(pwm.search('example')), 2)
+
+
+    def test_create_domain_scrypt_params(self):
+        domain = self.pwm.create_domain('cheap.com', scrypt_n=1<<10)
+        self.assertEqual(self.pwm.get_domain('cheap.com').scrypt_params, (1<<10, 8, 1))
+        self.assertEqual(self.pwm.get_domain('cheap.com').derive_key('secret'),
+            domain.derive_key('secret'))
+        self.assertRaises(ValueError, self.pwm.create_domain, 'invalid.com', scrypt_n=1000)
+
+
+    def test_default_scrypt_params(self):
+        self.assertEqual(self.pwm.get_scrypt_params(), (1<<14, 8, 1))
+        self.pwm.set_scrypt_params((1<<12, 8, 2))
+        self.assertEqual(self.pwm.get_scrypt_params(), (1<<12, 8, 2))
+        self.pwm.create_domain('new.com', scrypt_r=4)
+        self.assertEqual(self.pwm.get_domain('new.com').scrypt_params, (1<<12, 4, 2))
+        # existing domains keep their parameters
+        self.assertEqual(self.pwm.get_domain('example.com').scrypt_params, (1<<14, 8, 1))
+
+
+    def _make_baseline_schema(self):
+        # Like a database created before the scrypt parameters were stored
+        self.pwm.dispose()
+        engine = sa.create_engine('sqlite:///%s' % self.tmp_db.name)
+        with engine.begin() as connection:
+            connection.execute(sa.text('DROP INDEX ix_domain_version'))
+            for column in ('scrypt_n', 'scrypt_r', 'scrypt_p', 'policy', 'key_stream', 'version',
+                    'updated_at'):
+                connection.execute(sa.text('ALTER TABLE domain DROP COLUMN %s' % column))
+            connection.execute(sa.text('DROP TABLE setting'))
+        engine.dispose()
+
+
+    def test_upgrade_schema(self):
+        self._make_baseline_schema()
+        pwm = PWM(self.tmp_db.name)
+        self.assertRaises(OutdatedDatabaseException, pwm.get_domain, 'example.com')
+        self.assertTrue(pwm.upgrade())
+        self.assertFalse(pwm.upgrade())
+        self.assertEqual(pwm.get_domain('example.com').derive_key('secret'),
+            Domain(name='example.com', salt=b'NaCl').derive_key('secret'))
+        self.assertEqual(pwm.get_scrypt_params(), (1<<14, 8, 1))
+        self.assertEqual(pwm.get_domain('example.com').version, 0)
+        self.assertIn('ix_domain_version', [index['name'] for index in
+            sa.inspect(pwm._get_engine()).get_indexes('domain')])
+        # The change counter is created with the columns
+        self.assertEqual(pwm.create_domain('new.com').version, 1)
+        pwm.dispose()
+
+
+    def test_read_only(self):
+        read_only_uri = 'sqlite:///file:%s?mode=ro&uri=true' % self.tmp_db.name
+        self._make_baseline_schema()
+        # Opening the database doesn't try to upgrade it
+        pwm = PWM(read_only_uri)
+        self.assertRaises(OutdatedDatabaseException, pwm.get_domain, 'example.com')
+        self.assertTrue(self.pwm.upgrade())
+        self.assertEqual(pwm.get_domain('example.com').salt, b'NaCl')
+        pwm.dispose()
+
+
+    def test_create_domain_scheme(self):
+        first = self.pwm.create_domain('first.com', scheme=SCHEME_MASTER_KEY)
+        second = self.pwm.create_domain('second.com', scheme=SCHEME_MASTER_KEY)
+        self.assertEqual(first.scheme, SCHEME_MASTER_KEY)
+        self.assertEqual(len(first.master_salt), 32)
+        self.assertEqual(first.master_salt, second.master_salt)
+        fetched = self.pwm.get_domain('first.com')
+        self.assertEqual(fetched.derive_key('secret'), first.derive_key('secret'))
+        self.assertEqual(self.pwm.get_domain('example.com').derivation_scheme, 1)
+        self.assertRaises(ValueError, self.pwm.create_domain, 'invalid.com', scheme=3)
+
+
+    def test_create_domain_long_key(self):
+        domain = self.pwm.create_domain('long.com', length=1000)
+        fetched = self.pwm.get_domain('long.com')
+        self.assertTrue(fetched.key_stream)
+        self.assertEqual(len(fetched.derive_key('secret')), 1000)
+        self.assertEqual(fetched.derive_key('secret'), domain.derive_key('secret'))
+        self.assertEqual(self.pwm.get_domain('example.com').key_stream, None)
+        self.pwm.create_domains([{'name': 'bulk.com', 'length': 1000}])
+        self.assertEqual(len(self.pwm.get_domain('bulk.com').derive_key('secret')), 1000)
+
+
+    def test_create_domain_policy(self):
+        policy = Policy({'digit': 3})
+        domain = self.pwm.create_domain('policy.com', length=8, policy=policy)
+        fetched = self.pwm.get_domain('policy.com')
+        self.assertEqual(fetched.key_policy, policy)
+        self.assertEqual(fetched.derive_key('secret'), domain.derive_key('secret'))
+        self.assertTrue(sum(char.isdigit() for char in fetched.derive_key('secret')) >= 3)
+        self.assertEqual(self.pwm.get_domain('example.com').key_policy, None)
+
+        self.assertRaises(ValueError, self.pwm.create_domain, 'short.com', length=2,
+            policy=policy)
+        self.assertRaises(ValueError, self.pwm.create_domain, 'alpha.com', alphabet='alpha',
+            policy=policy)
+        results = self.pwm.create_domains([
+            {'name': 'bulk.com', 'policy': policy.dump()},
+            {'name': 'invalid.com', 'alphabet': 'alpha', 'policy': policy},
+        ])
+        self.assertEqual([result for _, result, _ in results], ['created', 'error'])
+        self.assertEqual(self.pwm.get_domain('bulk.com').key_policy, policy)
+
+
+    def test_derive_keys_stretches_once(self):
+        names = ['new%d.com' % i for i in range(4)]
+        for name in names:
+            self.pwm.create_domain(name, scheme=SCHEME_MASTER_KEY)
+        names.append('example.com')
+        expected = [(name, self.pwm.get_domain(name).derive_key('secret')) for name in names]
+        registry.reset()
+        self.assertEqual(list(self.pwm.derive_keys(names, 'secret', workers=1)), expected)
+        # One stretch shared by the new domains, and one for example.com
+        self.assertEqual(registry.get_histogram('pwm_scrypt_seconds')[0], 2)
+        self.assertEqual(list(self.pwm.derive_keys(names, 'secret', workers=2)), expected)
+
+
     def test_no_duplicates(self):
         # PY26: If we drop support for python 2.6, this can be rewritten to use assertRaises as a
         # context manager, which is better for readability
         self.assertRaises(DuplicateDomainException, self.pwm.create_domain, 'example.com')
 
 
+    def test_create_domains(self):
+        registry.reset()
+        self.pwm.set_scrypt_params((1<<10, 8, 1))
+        results = self.pwm.create_domains([
+            {'name': 'new.com', 'username': 'me', 'length': 8},
+            {'name': 'example.com'},
+            {'name': 'master.com', 'scheme': SCHEME_MASTER_KEY, 'alphabet': 'alpha'},
+            {'name': 'new.com'},
+            {'name': 'bad.com', 'scrypt_n': 1000},
+            {'username': 'nameless'},
+        ])
+        self.assertEqual([result[:2] for result in results], [
+            ('new.com', 'created'),
+            ('example.com', 'duplicate'),
+            ('master.com', 'created'),
+            ('new.com', 'duplicate'),
+            ('bad.com', 'error'),
+            (None, 'error'),
+        ])
+        self.assertIn('power of two', results[4][2])
+        self.assertEqual(registry.get_histogram('pwm_db_seconds', operation='create_domains',
+            phase='commit')[0], 1)
+
+        domain = self.pwm.get_domain('new.com')
+        self.assertEqual(domain.username, 'me')
+        self.assertEqual(domain.key_length, 8)
+        self.assertEqual(domain.scrypt_params, (1<<10, 8, 1))
+        self.assertEqual(len(domain.salt), 32)
+        master = self.pwm.get_domain('master.com')
+        self.assertNotEqual(master.salt, domain.salt)
+        self.pwm.create_domain('master2.com', scheme=SCHEME_MASTER_KEY)
+        self.assertEqual(self.pwm.get_domain('master2.com').master_salt, master.master_salt)
+        self.assertEqual(master.derive_key('secret'),
+            Domain(name='master.com', salt=master.salt, alphabet='alpha', scrypt_n=1<<10,
+                scheme=SCHEME_MASTER_KEY, master_salt=master.master_salt).derive_key('secret'))
+        self.assertRaises(NoSuchDomainException, self.pwm.get_domain, 'bad.com')
+
+
+    def test_rotate_salts(self):
+        old_salts = dict((domain.name, domain.salt) for domain in self.pwm.search(''))
+        changes = []
+        self.pwm.add_change_listener(changes.append)
+        progress = []
+        rotated = self.pwm.rotate_salts('example', chunk_size=1,
+            progress=lambda *args: progress.append(args))
+        self.assertEqual(rotated, 2)
+        self.assertEqual(progress, [(1, 2), (2, 2)])
+        self.assertEqual(sorted(changes), ['example.com', 'otherexample.com'])
+        self.assertNotEqual(self.pwm.get_domain('example.com').salt, old_salts['example.com'])
+        self.assertEqual(self.pwm.get_domain('facebook.com').salt, old_salts['facebook.com'])
+
+        self.assertEqual(self.pwm.rotate_salts(), 3)
+        self.assertNotEqual(self.pwm.get_domain('facebook.com').salt, old_salts['facebook.com'])
+
+        self.assertRaises(ValueError, PWM('https://pwm.example.com').rotate_salts)
+
+
+    def test_count(self):
+        self.assertEqual(self.pwm.count(), 3)
+        self.assertEqual(self.pwm.count('example'), 2)
+        self.assertEqual(self.pwm.count('fa'), 1)
+        self.assertEqual(self.pwm.count('nothing'), 0)
+        self.assertRaises(ValueError, PWM('https://pwm.example.com').count)
+
+
+    def test_rotate_salts_resumes(self):
+        self.pwm.create_domains({'name': 'new%d.com' % i} for i in range(5))
+        old_salts = dict((domain.name, domain.salt) for domain in self.pwm.search(''))
+
+        def interrupt(rotated, total):
+            if rotated == 4:
+                raise KeyboardInterrupt()
+        self.assertRaises(KeyboardInterrupt, self.pwm.rotate_salts, chunk_size=2,
+            progress=interrupt)
+        first_salts = dict((domain.name, domain.salt) for domain in self.pwm.search(''))
+        self.assertEqual(sum(first_salts[name] != old_salts[name] for name in old_salts), 4)
+
+        progress = []
+        self.assertEqual(self.pwm.rotate_salts(chunk_size=2,
+            progress=lambda *args: progress.append(args)), 4)
+        self.assertEqual(progress, [(6, 8), (8, 8)])
+        for domain in self.pwm.search(''):
+            self.assertNotEqual(domain.salt, old_salts[domain.name])
+            # Domains rotated before the interruption aren't rotated again
+            if first_salts[domain.name] != old_salts[domain.name]:
+                self.assertEqual(domain.salt, first_salts[domain.name])
+
+        # A finished rotation starts over
+        self.assertEqual(self.pwm.rotate_salts(), 8)
+
+
     def test_modify_domain(self):
         domain = self.pwm.get_domain('example.com')
         old_key = domain.derive_key('secret')
@@ -93,6 +422,326 @@ class PWMCoreTest(unittest.TestCase):
         self.assertRaises(NoSuchDomainException, self.pwm.modify_domain, 'neverheardofthis')
 
 
+    def test_transaction(self):
+        registry.reset()
+        changes = []
+        self.pwm.add_change_listener(changes.append)
+        with self.pwm.transaction():
+            self.pwm.create_domain('new.com')
+            with self.pwm.transaction():
+                self.pwm.modify_domain('new.com', username='me')
+            for name in ('example.com', 'facebook.com'):
+                self.pwm.modify_domain(name, new_salt=True)
+            self.assertEqual(self.pwm.get_domain('new.com').username, 'me')
+            self.assertEqual(len(self.pwm.search('new.com')), 1)
+            self.assertEqual(changes, [])
+
+        self.assertEqual(changes, ['new.com', 'example.com', 'facebook.com'])
+        self.assertEqual(registry.get_histogram('pwm_db_seconds', operation='transaction',
+            phase='commit')[0], 1)
+        self.assertEqual(registry.get_histogram('pwm_db_seconds', operation='modify_domain',
+            phase='commit')[0], 0)
+        self.assertNotEqual(self.pwm.get_domain('example.com').salt, b'NaCl')
+        self.assertEqual(self.pwm.get_domain('new.com').username, 'me')
+
+
+    def test_transaction_rollback(self):
+        changes = []
+        self.pwm.add_change_listener(changes.append)
+        try:
+            with self.pwm.transaction():
+                self.pwm.create_domain('new.com')
+                self.pwm.modify_domain('example.com', new_salt=True)
+                self.assertNotEqual(self.pwm.get_domain('example.com').salt, b'NaCl')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(changes, [])
+        self.assertEqual(self.pwm.get_domain('example.com').salt, b'NaCl')
+        self.assertRaises(NoSuchDomainException, self.pwm.get_domain, 'new.com')
+
+
+    def test_transaction_errors(self):
+        with self.pwm.transaction():
+            self.assertRaises(NoSuchDomainException, self.pwm.modify_domain, 'neverheardofthis')
+            self.pwm.create_domain('new.com')
+        self.assertEqual(self.pwm.get_domain('new.com').name, 'new.com')
+
+        def create_duplicate():
+            with self.pwm.transaction():
+                self.pwm.create_domain('other.com')
+                self.pwm.create_domain('example.com')
+        self.assertRaises(DuplicateDomainException, create_duplicate)
+        self.assertRaises(NoSuchDomainException, self.pwm.get_domain, 'other.com')
+
+
+    def test_derive_keys(self):
+        names = ['example.com', 'facebook.com', 'otherexample.com']
+        expected = [(name, self.pwm.get_domain(name).derive_key('secret')) for name in names]
+        self.assertEqual(list(self.pwm.derive_keys(names, 'secret', workers=1)), expected)
+        self.assertEqual(list(self.pwm.derive_keys(names, 'secret', workers=2)), expected)
+        unordered = self.pwm.derive_keys(names, 'secret', workers=2, ordered=False)
+        self.assertEqual(sorted(unordered), expected)
+
+
+    def test_derive_keys_nonexistent_domain(self):
+        results = self.pwm.derive_keys(['example.com', 'neverheardofthis'], 'secret')
+        self.assertRaises(NoSuchDomainException, list, results)
+
+
+    def test_versions(self):
+        self.assertEqual(self.pwm.get_domain('example.com').version, 0)
+        self.assertEqual(self.pwm.create_domain('new.com').version, 1)
+        self.pwm.create_domains([{'name': 'new1.com'}, {'name': 'new2.com'}])
+        self.assertEqual([domain.version for domain in self.pwm.get_domains(['new1.com',
+            'new2.com'])], [2, 2])
+        modified = self.pwm.modify_domain('example.com', username='me')
+        self.assertEqual(modified.version, 3)
+        self.assertTrue(modified.updated_at > self.pwm.get_domain('new.com').updated_at)
+        self.pwm.import_domains([{'name': 'imported.com'}])
+        self.assertEqual(self.pwm.get_domain('imported.com').version, 4)
+        self.pwm.rotate_salts('new')
+        self.assertEqual(self.pwm.get_domain('new.com').version, 5)
+
+
+    def test_sync_from(self):
+        tmp_db = tempfile.NamedTemporaryFile(delete=False)
+        tmp_db.close()
+        other_pwm = PWM()
+        try:
+            other_pwm.bootstrap(tmp_db.name)
+            progress = []
+            result = other_pwm.sync_from(self.pwm, batch_size=2,
+                progress=lambda *args: progress.append(args))
+            self.assertEqual(result, (3, 0, 0))
+            self.assertEqual(progress, [(2, 3), (3, 3)])
+            self.assertEqual(other_pwm.get_domain('example.com').salt, b'NaCl')
+            self.assertEqual(other_pwm.sync_from(self.pwm), (0, 0, 0))
+
+            # Only what changed since the last sync is copied
+            self.pwm.create_domain('new.com', policy=Policy({'digit': 2}))
+            self.pwm.modify_domain('facebook.com', new_salt=True)
+            progress = []
+            self.assertEqual(other_pwm.sync_from(self.pwm,
+                progress=lambda *args: progress.append(args)), (1, 1, 0))
+            self.assertEqual(progress, [(2, 2)])
+            for name in ('new.com', 'facebook.com'):
+                self.assertEqual(other_pwm.get_domain(name).derive_key('secret'),
+                    self.pwm.get_domain(name).derive_key('secret'))
+
+            # Syncing back finds everything already there
+            self.assertEqual(self.pwm.sync_from(other_pwm), (0, 0, 0))
+            self.assertRaises(ValueError, self.pwm.sync_from, PWM(self.tmp_db.name))
+        finally:
+            other_pwm.dispose()
+            os.remove(tmp_db.name)
+
+
+    def test_sync_from_conflicts(self):
+        tmp_db = tempfile.NamedTemporaryFile(delete=False)
+        tmp_db.close()
+        other_pwm = PWM()
+        try:
+            other_pwm.bootstrap(tmp_db.name)
+            other_pwm.sync_from(self.pwm)
+            self.pwm.modify_domain('example.com', username='older')
+            self.pwm.modify_domain('facebook.com', username='newer')
+            time.sleep(0.01)
+            other_pwm.modify_domain('example.com', username='newer')
+            other_pwm.modify_domain('facebook.com', username='older')
+            self.pwm.modify_domain('facebook.com', username='newer')
+
+            self.assertEqual(other_pwm.sync_from(self.pwm), (0, 1, 1))
+            self.assertEqual(self.pwm.sync_from(other_pwm), (0, 1, 0))
+            for pwm in (self.pwm, other_pwm):
+                self.assertEqual(pwm.get_domain('example.com').username, 'newer')
+                self.assertEqual(pwm.get_domain('facebook.com').username, 'newer')
+        finally:
+            other_pwm.dispose()
+            os.remove(tmp_db.name)
+
+
+    def test_export_import(self):
+        exported = list(self.pwm.export_domains())
+        self.assertEqual([domain['name'] for domain in exported],
+            ['example.com', 'otherexample.com', 'facebook.com'])
+
+        tmp_db = tempfile.NamedTemporaryFile(delete=False)
+        tmp_db.close()
+        try:
+            other_pwm = PWM()
+            other_pwm.bootstrap(tmp_db.name)
+            other_pwm.create_domain('facebook.com')
+            new_domains = [{'name': 'new%d.com' % i} for i in range(5)]
+            result = other_pwm.import_domains(exported + new_domains + [{'name': 'new1.com'}],
+                batch_size=2)
+            self.assertEqual(result, (7, 2))
+            for name in ('example.com', 'otherexample.com'):
+                self.assertEqual(other_pwm.get_domain(name).derive_key('secret'),
+                    self.pwm.get_domain(name).derive_key('secret'))
+            self.assertEqual(len(other_pwm.search('new')), 5)
+            self.assertEqual(other_pwm.get_domain('new1.com').key_length,
+                Domain.DEFAULT_KEY_LENGTH)
+
+            self.pwm.create_domain('cheap.com', scrypt_n=1<<10)
+            self.pwm.create_domain('master.com', scheme=SCHEME_MASTER_KEY)
+            other_pwm.import_domains(self.pwm.export_domains())
+            self.assertEqual(other_pwm.get_domain('cheap.com').scrypt_params, (1<<10, 8, 1))
+            self.assertEqual(other_pwm.get_domain('master.com').derive_key('secret'),
+                self.pwm.get_domain('master.com').derive_key('secret'))
+
+            for record in ({'username': 'me'}, {'name': 'bad.com', 'scrypt_n': 1000},
+                    {'name': 'bad.com', 'scheme': 3},
+                    {'name': 'bad.com', 'scheme': SCHEME_MASTER_KEY},
+                    {'name': 'bad.com', 'key_length': 1, 'policy': Policy({'digit': 2}).dump()}):
+                self.assertRaises(ValueError, other_pwm.import_domains,
+                    [{'name': 'good.com'}, record])
+            self.assertRaises(NoSuchDomainException, other_pwm.get_domain, 'good.com')
+        finally:
+            other_pwm.dispose()
+            os.remove(tmp_db.name)
+
+
+    def test_shares_engine(self):
+        other_pwm = PWM(self.tmp_db.name)
+        self.assertTrue(self.pwm._get_engine() is other_pwm._get_engine())
+        self.assertTrue(get_engine(self.pwm.database_uri) is self.pwm._get_engine())
+
+
+    def test_in_memory_database(self):
+        # In-memory SQLite databases don't use a queue pool, and take no pool limits
+        pwm = PWM(pool_size=2, max_overflow=0)
+        try:
+            pwm.bootstrap('sqlite://')
+            pwm.create_domain('example.com')
+            self.assertEqual(pwm.get_domain('example.com').name, 'example.com')
+        finally:
+            pwm.dispose()
+
+
+    def test_close(self):
+        self.pwm.get_domain('example.com')
+        engine = self.pwm._get_engine()
+        self.pwm.close()
+        self.assertEqual(self.pwm.session, None)
+
+        # should reconnect transparently through the same engine
+        self.assertEqual(self.pwm.get_domain('example.com').salt, b'NaCl')
+        self.assertTrue(self.pwm._get_engine() is engine)
+
+
+    def test_dispose(self):
+        engine = self.pwm._get_engine()
+        self.pwm.dispose()
+        self.assertFalse(self.pwm._get_engine() is engine)
+        self.assertEqual(self.pwm.get_domain('example.com').salt, b'NaCl')
+
+
+class PWMCachedCoreTest(PWMCoreTest):
+
+    def setUp(self):
+        super(PWMCachedCoreTest, self).setUp()
+        self.pwm = PWM(self.tmp_db.name, cache_size=2)
+
+
+    def test_cache_hits(self):
+        registry.reset()
+        domain = self.pwm.get_domain('example.com')
+        cached = self.pwm.get_domain('example.com')
+        self.assertEqual(self.pwm.cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+        self.assertEqual(registry.get_counter('pwm_domain_cache_total', result='hit'), 1)
+        self.assertEqual(registry.get_counter('pwm_domain_cache_total', result='miss'), 1)
+        self.assertEqual(cached.derive_key('secret'), domain.derive_key('secret'))
+
+        # Lookups share an immutable snapshot
+        self.assertTrue(isinstance(cached, DomainSnapshot))
+        self.assertTrue(cached is domain)
+        self.assertRaises(AttributeError, setattr, cached, 'username', 'changed')
+        self.assertEqual(cached.scrypt_params, (1<<14, 8, 1))
+        self.assertEqual(cached.entropy, Domain(name='example.com', salt=b'NaCl').entropy)
+
+        domains = self.pwm.get_domains(['facebook.com', 'example.com'])
+        self.assertEqual([domain.salt for domain in domains], [b'notsomuch', b'NaCl'])
+        self.assertEqual(self.pwm.cache.stats(), {'hits': 2, 'misses': 2, 'size': 2})
+
+
+    def test_cache_invalidation(self):
+        old_salt = self.pwm.get_domain('example.com').salt
+        self.pwm.modify_domain('example.com', new_salt=True, username='me')
+        domain = self.pwm.get_domain('example.com')
+        self.assertNotEqual(domain.salt, old_salt)
+        self.assertEqual(domain.username, 'me')
+
+        self.assertRaises(NoSuchDomainException, self.pwm.get_domain, 'new.com')
+        self.pwm.create_domain('new.com')
+        self.assertEqual(self.pwm.get_domain('new.com').name, 'new.com')
+
+
+    def test_cache_ttl(self):
+        self.pwm = PWM(self.tmp_db.name, cache_size=2, cache_ttl=0.01)
+        self.pwm.get_domain('example.com')
+        time.sleep(0.02)
+        self.pwm.get_domain('example.com')
+        self.assertEqual(self.pwm.cache.stats()['hits'], 0)
+
+
+class PWMIndexedCoreTest(PWMCoreTest):
+
+    def setUp(self):
+        super(PWMIndexedCoreTest, self).setUp()
+        self.pwm = PWM(self.tmp_db.name, index=True)
+        self.pwm.bootstrap(self.tmp_db.name)
+
+
+    def tearDown(self):
+        super(PWMIndexedCoreTest, self).tearDown()
+        if os.path.exists(index_path(self.tmp_db.name)):
+            os.remove(index_path(self.tmp_db.name))
+
+
+    def assert_index_matches(self):
+        # Writes leave the index out of date, and the next lookup rewrites it
+        self.assertIsNone(open_index(self.tmp_db.name))
+        self.pwm.get_domain('example.com')
+        index = open_index(self.tmp_db.name)
+        self.assertIsNotNone(index)
+        names = [exported['name'] for exported in self.pwm.export_domains()]
+        with index:
+            self.assertEqual(sorted(index.names()), sorted(names))
+            for domain in self.pwm.get_domains(names):
+                self.assertEqual(_derive_key('secret', *key_args(index.get(domain.name))),
+                    domain.derive_key('secret'))
+                self.assertEqual(index.get(domain.name)['username'], domain.username)
+
+
+    def test_index_is_kept_up_to_date(self):
+        self.assert_index_matches()
+        self.pwm.create_domain('new.com', username='me', length=12, policy=Policy({'digit': 2}))
+        self.pwm.create_domain('long.com', length=500)
+        self.assert_index_matches()
+        self.pwm.modify_domain('example.com', new_salt=True, username='you')
+        self.assert_index_matches()
+        self.pwm.create_domains([{'name': 'bulk%d.com' % i} for i in range(3)])
+        self.assert_index_matches()
+        with self.pwm.transaction():
+            self.pwm.modify_domain('facebook.com', new_salt=True)
+            self.pwm.create_domain('transaction.com')
+        self.assert_index_matches()
+        self.pwm.rotate_salts(chunk_size=2)
+        self.assert_index_matches()
+
+
+    def test_stale_index(self):
+        self.assert_index_matches()
+        # Changes made without maintaining the index make it unusable, until the next lookup
+        PWM(self.tmp_db.name).create_domain('new.com')
+        self.assert_index_matches()
+        # Lookups don't rewrite an index that is up to date
+        mtime = os.stat(index_path(self.tmp_db.name)).st_mtime_ns
+        self.pwm.get_domains(['example.com', 'new.com'])
+        self.assertEqual(os.stat(index_path(self.tmp_db.name)).st_mtime_ns, mtime)
+
+
 class PWMNotReadyTest(unittest.TestCase):
 
     def test_not_ready(self):
@@ -100,6 +749,97 @@ class PWMNotReadyTest(unittest.TestCase):
         self.assertRaises(NotReadyException, pwm.get_domain, 'example.com')
 
 
+class DerivationSchedulerTest(unittest.TestCase):
+
+    def run_jobs(self, scheduler, costs):
+        """ Run jobs of the given costs in threads, returning the highest number of jobs and memory
+        in use at once, and the order jobs started in.
+        """
+        lock = threading.Lock()
+        state = {'running': 0, 'memory': 0, 'max_running': 0, 'max_memory': 0}
+        started = []
+        def job(index, cost):
+            with scheduler.slot(cost):
+                with lock:
+                    started.append(index)
+                    state['running'] += 1
+                    state['memory'] += cost
+                    state['max_running'] = max(state['max_running'], state['running'])
+                    state['max_memory'] = max(state['max_memory'], state['memory'])
+                time.sleep(0.01)
+                with lock:
+                    state['running'] -= 1
+                    state['memory'] -= cost
+        threads = []
+        for index, cost in enumerate(costs):
+            thread = threading.Thread(target=job, args=(index, cost))
+            thread.start()
+            threads.append(thread)
+            # Make arrival order deterministic
+            time.sleep(0.001)
+        for thread in threads:
+            thread.join()
+        return state['max_running'], state['max_memory'], started
+
+
+    def test_memory_budget(self):
+        scheduler = DerivationScheduler(memory_budget=3, max_concurrency=10)
+        max_running, max_memory, _ = self.run_jobs(scheduler, [1]*8)
+        self.assertEqual(max_running, 3)
+        self.assertEqual(max_memory, 3)
+        stats = scheduler.stats()
+        self.assertEqual(stats['jobs'], 8)
+        self.assertEqual((stats['queued'], stats['running'], stats['memory_in_use']), (0, 0, 0))
+        self.assertTrue(stats['peak_queued'] > 0)
+        self.assertTrue(stats['max_wait'] >= stats['mean_wait'] > 0)
+
+
+    def test_max_concurrency(self):
+        scheduler = DerivationScheduler(memory_budget=100, max_concurrency=2)
+        max_running, _, _ = self.run_jobs(scheduler, [1]*6)
+        self.assertEqual(max_running, 2)
+
+
+    def test_oversized_job_runs_alone(self):
+        scheduler = DerivationScheduler(memory_budget=2, max_concurrency=10)
+        max_running, _, started = self.run_jobs(scheduler, [1, 5, 1])
+        self.assertEqual(max_running, 1)
+        # Jobs are admitted in order, the last job doesn't overtake the large one
+        self.assertEqual(started, [0, 1, 2])
+
+
+    def test_interrupted_wait(self):
+        class InterruptedCondition(threading.Condition):
+            def wait(self, timeout=None):
+                raise KeyboardInterrupt()
+
+        scheduler = DerivationScheduler(memory_budget=1, max_concurrency=1)
+        scheduler._condition = InterruptedCondition()
+        def run_job():
+            with scheduler.slot(1):
+                pass
+        with scheduler.slot(1):
+            self.assertRaises(KeyboardInterrupt, run_job)
+            self.assertEqual(scheduler.stats()['queued'], 0)
+        # Later jobs are still admitted
+        run_job()
+        self.assertEqual(scheduler.stats()['jobs'], 2)
+
+
+    def test_max_parallel(self):
+        scheduler = DerivationScheduler(memory_budget=64*1024*1024, max_concurrency=8)
+        self.assertEqual(scrypt_memory_cost((1<<14, 8, 1)), 16*1024*1024)
+        self.assertEqual(scheduler.max_parallel(scrypt_memory_cost((1<<14, 8, 1))), 4)
+        self.assertEqual(scheduler.max_parallel(scrypt_memory_cost((1<<10, 8, 1))), 8)
+        self.assertEqual(scheduler.max_parallel(scrypt_memory_cost((1<<20, 8, 1))), 1)
+
+
+    def test_derivations_use_scheduler(self):
+        jobs = scheduler.stats()['jobs']
+        Domain(name='example.com', salt=b'NaCl').derive_key('secret')
+        self.assertEqual(scheduler.stats()['jobs'], jobs + 1)
+
+
 class CoreUtilsTest(unittest.TestCase):
 
     def test_urify_db(self):
@@ -108,3 +848,18 @@ class CoreUtilsTest(unittest.TestCase):
 
         uri = _urify_db('mysql://user:pw@localhost/mydb')
         self.assertEqual('mysql://user:pw@localhost/mydb', uri)
+
+
+    def test_validate_scrypt_params(self):
+        validate_scrypt_params((1<<14, 8, 1))
+        for invalid in ((1000, 8, 1), (1, 8, 1), (1024, 0, 1), (1024, 8, 0)):
+            self.assertRaises(ValueError, validate_scrypt_params, invalid)
+
+
+    def test_calibrate_scrypt(self):
+        scrypt_params, timings = calibrate_scrypt(10000, min_n=2, max_n=16)
+        self.assertEqual(scrypt_params, (16, 8, 1))
+        self.assertEqual([n for n, _ in timings], [2, 4, 8, 16])
+        scrypt_params, timings = calibrate_scrypt(0, min_n=1<<10)
+        self.assertEqual(scrypt_params, (1<<10, 8, 1))
+        self.assertEqual(len(timings), 1)
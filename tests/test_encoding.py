@@ -1,8 +1,24 @@
 import pwm.encoding as uut
 
+import os
 import string
 import unittest
 
+
+def reference_encode(alphabet, digest, total_len):
+    ''' The original, unoptimized encoder, used to verify the output hasn't changed. '''
+    binlen, enclen = uut.calc_chunklen(len(alphabet))
+    nchunks = uut.ceildiv(len(digest), binlen)
+    binstr = bytearray(digest.ljust(nchunks * binlen, b'\0'))
+    out = []
+    for index in range(nchunks):
+        chunk = binstr[index*binlen:(index+1)*binlen]
+        val = sum([256**(binlen-1-i) * chunk[i] for i in range(binlen)])
+        out.extend([alphabet[(val//len(alphabet)**i) % len(alphabet)]
+            for i in reversed(range(enclen))])
+    return ''.join(out)[:total_len]
+
+
 class EncodingTest(unittest.TestCase):
 
     def testCeilDiv(self):
@@ -48,3 +64,70 @@ class EncodingTest(unittest.TestCase):
         self.assertNotEqual(f('full'), 'full')
         self.assertEqual(f(string.ascii_letters), string.ascii_letters)
         self.assertEqual(f('numeric'), '0123456789')
+
+    def testGetEncoder(self):
+        enc = uut.get_encoder(string.ascii_letters)
+        self.assertTrue(uut.get_encoder(string.ascii_letters) is enc)
+        self.assertEqual(enc.alphabet, string.ascii_letters)
+
+
+class EncodeTest(unittest.TestCase):
+
+    alphabets = list(uut.PRESETS.values()) + ['01', 'abc', string.hexdigits[:16]]
+    lengths = [0, 1, 16, 33, 100]
+
+    def setUp(self):
+        self.digests = [b'', b'\0', b'\xff' * 64] + [os.urandom(64) for _ in range(20)]
+
+
+    def testEncodeMatchesReference(self):
+        for alphabet in self.alphabets:
+            enc = uut.get_encoder(alphabet)
+            for digest in self.digests:
+                for length in self.lengths:
+                    self.assertEqual(enc.encode(digest, length),
+                        reference_encode(alphabet, digest, length))
+
+
+    def testEncodeManyPython(self):
+        for alphabet in self.alphabets:
+            enc = uut.get_encoder(alphabet)
+            for length in self.lengths:
+                self.assertEqual(enc._encode_many_python(self.digests, length),
+                    [reference_encode(alphabet, d, length) for d in self.digests])
+
+
+    def testEncodeManyNumpy(self):
+        numpy = uut._get_numpy()
+        if numpy is None:
+            return
+        digests = self.digests[2:]
+        for alphabet in self.alphabets:
+            enc = uut.get_encoder(alphabet)
+            for length in self.lengths[1:]:
+                self.assertEqual(enc._encode_many_numpy(numpy, digests, length),
+                    [reference_encode(alphabet, d, length) for d in digests])
+
+
+    def testEncodeManyMixedLengths(self):
+        enc = uut.get_encoder(uut.PRESETS['full'])
+        self.assertEqual(enc.encode_many(self.digests, 16),
+            [enc.encode(d, 16) for d in self.digests])
+
+
+    def testEncodeStream(self):
+        for alphabet in self.alphabets:
+            enc = uut.get_encoder(alphabet)
+            binlen = enc.chunklen[0]
+            for digest in self.digests[2:]:
+                padded = digest.ljust(uut.ceildiv(len(digest), binlen)*binlen, b'\0')
+                for length in self.lengths:
+                    expected = enc.encode(digest, length)
+                    # Blocks not aligned to chunks are joined up
+                    blocks = [padded[:7], padded[7:]]
+                    self.assertEqual(''.join(enc.encode_stream(blocks, len(expected))), expected)
+
+
+    def testEncodeStreamRunsOut(self):
+        enc = uut.get_encoder(uut.PRESETS['full'])
+        self.assertRaises(ValueError, list, enc.encode_stream([b'\0'*64], 1000))
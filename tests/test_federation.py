@@ -0,0 +1,134 @@
+from pwm import FederatedPWM, PWM, NoSuchDomainException
+from pwm.server import Server
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from sqlalchemy.exc import DatabaseError
+
+
+class FederatedPWMTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.personal_path = os.path.join(self.tmp_dir, 'personal.sqlite')
+        self.team_path = os.path.join(self.tmp_dir, 'team.sqlite')
+        personal = PWM()
+        personal.bootstrap(self.personal_path)
+        self.personal_domain = personal.create_domain('example.com', username='me')
+        personal.create_domain('personal.com')
+        team = PWM()
+        team.bootstrap(self.team_path)
+        team.create_domain('example.com', username='team')
+        self.team_domain = team.create_domain('team.example.com')
+        team.create_domain('example.org')
+        personal.dispose()
+        team.dispose()
+        self.pwm = FederatedPWM([self.personal_path, self.team_path])
+
+
+    def tearDown(self):
+        self.pwm.dispose()
+        shutil.rmtree(self.tmp_dir)
+
+
+    def test_get_domain(self):
+        self.assertEqual(self.pwm.get_domain('example.com').username, 'me')
+        self.assertEqual(self.pwm.get_domain('team.example.com').derive_key('secret'),
+            self.team_domain.derive_key('secret'))
+        self.assertRaises(NoSuchDomainException, self.pwm.get_domain, 'nope.com')
+
+        domains = self.pwm.get_domains(['team.example.com', 'example.com', 'personal.com'])
+        self.assertEqual([domain.name for domain in domains],
+            ['team.example.com', 'example.com', 'personal.com'])
+        self.assertEqual(domains[1].username, 'me')
+        self.assertRaises(NoSuchDomainException, self.pwm.get_domains, ['example.com', 'nope'])
+
+
+    def test_search(self):
+        self.assertEqual([domain.name for domain in self.pwm.search('example')],
+            ['example.com', 'example.org', 'team.example.com'])
+        self.assertEqual(self.pwm.search('example')[0].username, 'me')
+        self.assertEqual([domain.name for domain in self.pwm.search('example.org', rank=True)],
+            ['example.org'])
+        self.assertEqual([domain.name for domain in self.pwm.search('com', limit=2, rank=True)],
+            ['example.com', 'personal.com'])
+
+
+    def test_failing_database(self):
+        broken_path = os.path.join(self.tmp_dir, 'broken.sqlite')
+        with open(broken_path, 'wb') as broken_file:
+            broken_file.write(b'not a database'*100)
+        pwm = FederatedPWM([broken_path, self.personal_path, self.team_path])
+        try:
+            # The databases after the broken one still answer
+            self.assertEqual(pwm.get_domain('example.com').username, 'me')
+            self.assertEqual([uri for uri, _ in pwm.errors], ['sqlite:///' + broken_path])
+            self.assertEqual([domain.name for domain in pwm.get_domains(['example.org',
+                'personal.com'])], ['example.org', 'personal.com'])
+            self.assertEqual(len(pwm.search('example')), 3)
+            self.assertRaises(NoSuchDomainException, pwm.get_domain, 'nope.com')
+        finally:
+            pwm.dispose()
+
+        pwm = FederatedPWM([broken_path])
+        try:
+            self.assertRaises(DatabaseError, pwm.get_domain, 'example.com')
+        finally:
+            pwm.dispose()
+
+
+    def test_writes(self):
+        self.pwm.create_domain('new.com')
+        self.assertEqual(PWM(self.personal_path).get_domain('new.com').name, 'new.com')
+        self.assertRaises(NoSuchDomainException, PWM(self.team_path).get_domain, 'new.com')
+        self.assertRaises(NoSuchDomainException, self.pwm.modify_domain, 'example.org',
+            new_salt=True)
+
+        pwm = FederatedPWM([self.personal_path, self.team_path], write_to=self.team_path)
+        try:
+            pwm.create_domains([{'name': 'team.com'}])
+            self.assertEqual(PWM(self.team_path).get_domain('team.com').name, 'team.com')
+        finally:
+            pwm.close()
+        self.assertRaises(ValueError, FederatedPWM, [self.personal_path], write_to='other.sqlite')
+        self.assertRaises(ValueError, FederatedPWM, ['http://127.0.0.1:1'])
+
+
+    def test_lookups_are_concurrent(self):
+        def slow(method):
+            def wrapper(*args, **kwargs):
+                time.sleep(0.2)
+                return method(*args, **kwargs)
+            return wrapper
+        for backend in self.pwm.backends:
+            backend.search = slow(backend.search)
+            backend._find_domains = slow(backend._find_domains)
+
+        start_time = time.time()
+        self.pwm.search('example')
+        self.pwm.get_domains(['example.com', 'example.org'])
+        self.assertTrue(time.time() - start_time < 0.7)
+
+
+    def test_rest_database(self):
+        server = Server(PWM(self.team_path), ('127.0.0.1', 0), threads=2)
+        port = server.bind()[1]
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        pwm = FederatedPWM([self.personal_path, 'http://127.0.0.1:%d' % port],
+            config={'cache_path': None})
+        try:
+            self.assertEqual([domain.name for domain in pwm.search('example')],
+                ['example.com', 'example.org', 'team.example.com'])
+            self.assertEqual(pwm.get_domain('team.example.com').derive_key('secret'),
+                self.team_domain.derive_key('secret'))
+        finally:
+            pwm.close()
+            server.shutdown()
+            server.close()
+            thread.join()
+            server.pwm.dispose()
@@ -0,0 +1,111 @@
+from pwm.index import DomainIndex, database_fingerprint, open_index, write_index
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+
+class DomainIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'test.sqlite')
+        self.index_path = self.db_path + '.index'
+        connection = sqlite3.connect(self.db_path)
+        connection.execute('CREATE TABLE test (id INTEGER)')
+        connection.commit()
+        connection.close()
+        self.domains = [
+            {
+                'name': 'example.com',
+                'salt': b'NaCl',
+                'charset': 'abc',
+                'key_length': 16,
+                'username': 'me',
+                'scrypt_n': 1024,
+                'scrypt_r': 8,
+                'scrypt_p': 1,
+                'scheme': 2,
+                'master_salt': b'pepper',
+                'policy': '{"min":{"digit":1}}',
+                'key_stream': True,
+            },
+            {'name': u'b\xe5t.no', 'salt': b'\0\xff', 'charset': 'abc', 'key_length': 8},
+            {'name': 'a.com', 'salt': b'salt', 'charset': 'xyz', 'username': ''},
+        ]
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def test_get(self):
+        write_index(self.index_path, self.domains, database_fingerprint(self.db_path))
+        with DomainIndex(self.index_path) as index:
+            self.assertEqual(len(index), 3)
+            self.assertEqual(index.get('example.com'), self.domains[0])
+            self.assertEqual(index.get(u'b\xe5t.no'), {
+                'name': u'b\xe5t.no',
+                'salt': b'\0\xff',
+                'charset': 'abc',
+                'key_length': 8,
+                'username': None,
+                'scrypt_n': None,
+                'scrypt_r': None,
+                'scrypt_p': None,
+                'scheme': None,
+                'master_salt': None,
+                'policy': None,
+                'key_stream': None,
+            })
+            self.assertEqual(index.get('a.com')['username'], '')
+            self.assertIsNone(index.get('example'))
+            self.assertIsNone(index.get('zzz.com'))
+            self.assertIsNone(index.get(''))
+
+
+    def test_names(self):
+        write_index(self.index_path, self.domains, database_fingerprint(self.db_path))
+        with DomainIndex(self.index_path) as index:
+            self.assertEqual(list(index.names()), ['a.com', u'b\xe5t.no', 'example.com'])
+            self.assertEqual(list(index.names('e')), ['example.com'])
+            self.assertEqual(list(index.names('f')), [])
+
+
+    def test_empty(self):
+        write_index(self.index_path, [], database_fingerprint(self.db_path))
+        with DomainIndex(self.index_path) as index:
+            self.assertEqual(len(index), 0)
+            self.assertIsNone(index.get('example.com'))
+
+
+    def test_stale(self):
+        write_index(self.index_path, self.domains, database_fingerprint(self.db_path))
+        index = open_index(self.db_path)
+        self.assertIsNotNone(index)
+        index.close()
+
+        connection = sqlite3.connect(self.db_path)
+        connection.execute('INSERT INTO test VALUES (1)')
+        connection.commit()
+        connection.close()
+        self.assertIsNone(open_index(self.db_path))
+
+
+    def test_not_an_index(self):
+        self.assertIsNone(open_index(self.db_path))
+        with open(self.index_path, 'wb') as index_file:
+            index_file.write(b'garbage')
+        self.assertIsNone(open_index(self.db_path))
+        self.assertRaises(ValueError, DomainIndex, self.index_path)
+
+
+    def test_wal_databases_are_not_indexed(self):
+        connection = sqlite3.connect(self.db_path)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('INSERT INTO test VALUES (1)')
+        connection.commit()
+        self.assertIsNone(database_fingerprint(self.db_path))
+        connection.close()
@@ -0,0 +1,24 @@
+from pwm.kdf import hkdf_sha256
+
+import binascii
+import unittest
+
+
+class HKDFTest(unittest.TestCase):
+
+    def test_rfc5869_basic(self):
+        output = hkdf_sha256(b'\x0b'*22, binascii.unhexlify('000102030405060708090a0b0c'),
+            binascii.unhexlify('f0f1f2f3f4f5f6f7f8f9'), 42)
+        self.assertEqual(binascii.hexlify(output), b'3cb25f25faacd57a90434f64d0362f2a'
+            b'2d2d0a90cf1a5a4c5db02d56ecc4c5bf34007208d5b887185865')
+
+
+    def test_rfc5869_empty_salt_and_info(self):
+        output = hkdf_sha256(b'\x0b'*22, b'', b'', 42)
+        self.assertEqual(binascii.hexlify(output), b'8da4e775a563c18f715f802a063c5a31'
+            b'b8a11f5c5ee1879ec3454e5f3c738d2d9d201395faa4b61a96c8')
+
+
+    def test_max_length(self):
+        self.assertEqual(len(hkdf_sha256(b'key', b'salt', b'info', 255*32)), 255*32)
+        self.assertRaises(ValueError, hkdf_sha256, b'key', b'salt', b'info', 255*32 + 1)
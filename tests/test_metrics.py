@@ -0,0 +1,106 @@
+from pwm import PWM, NoSuchDomainException
+from pwm import metrics as metrics_module
+from pwm.metrics import Metrics, registry
+
+import os
+import tempfile
+import unittest
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics(buckets=(0.1, 1.0))
+
+
+    def test_counter(self):
+        self.metrics.increment('requests_total', method='GET')
+        self.metrics.increment('requests_total', 2, method='GET')
+        self.assertEqual(self.metrics.get_counter('requests_total', method='GET'), 3)
+        self.assertEqual(self.metrics.get_counter('requests_total', method='POST'), 0)
+
+
+    def test_prometheus_format(self):
+        self.metrics.increment('requests_total', method='GET')
+        self.metrics.observe('latency_seconds', 0.05, phase='a"b')
+        self.metrics.observe('latency_seconds', 0.5, phase='a"b')
+        self.metrics.observe('latency_seconds', 5, phase='a"b')
+        self.assertEqual(self.metrics.to_prometheus(), '\n'.join([
+            '# TYPE requests_total counter',
+            'requests_total{method="GET"} 1',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{phase="a\\"b",le="0.1"} 1',
+            'latency_seconds_bucket{phase="a\\"b",le="1.0"} 2',
+            'latency_seconds_bucket{phase="a\\"b",le="+Inf"} 3',
+            'latency_seconds_sum{phase="a\\"b"} 5.55',
+            'latency_seconds_count{phase="a\\"b"} 3',
+        ]) + '\n')
+
+
+    def test_listener(self):
+        observed = []
+        def listener(name, value, labels):
+            observed.append((name, value, labels))
+        def broken_listener(name, value, labels):
+            raise ValueError()
+        self.metrics.add_listener(broken_listener)
+        self.metrics.add_listener(listener)
+        self.metrics.observe('latency_seconds', 0.5, phase='execute')
+        self.assertEqual(observed, [('latency_seconds', 0.5, {'phase': 'execute'})])
+        self.metrics.remove_listener(listener)
+        self.metrics.increment('requests_total')
+        self.assertEqual(len(observed), 1)
+
+
+    def test_timer_records_failures(self):
+        with self.assertRaises(ValueError):
+            with self.metrics.timer('latency_seconds'):
+                raise ValueError()
+        self.assertEqual(self.metrics.get_histogram('latency_seconds')[0], 1)
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def setUp(self):
+        registry.reset()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pwm = PWM()
+        self.pwm.bootstrap(os.path.join(self.tmp_dir, 'db.sqlite'))
+        self.pwm.create_domain('example.com')
+
+
+    def tearDown(self):
+        self.pwm.dispose()
+        os.remove(os.path.join(self.tmp_dir, 'db.sqlite'))
+        os.rmdir(self.tmp_dir)
+        registry.reset()
+
+
+    def test_derive_key(self):
+        self.pwm.get_domain('example.com').derive_key('secret')
+        self.assertEqual(registry.get_histogram('pwm_scrypt_seconds')[0], 1)
+        self.assertEqual(registry.get_histogram('pwm_encode_seconds')[0], 1)
+
+
+    def test_db_operations(self):
+        self.pwm.get_domain('example.com')
+        for phase in ('execute', 'commit'):
+            count, _ = registry.get_histogram('pwm_db_seconds',
+                operation='get_existing_domain_from_db', phase=phase)
+            self.assertEqual(count, 1)
+        self.assertTrue(registry.get_histogram('pwm_sql_seconds')[0] > 0)
+
+        with self.assertRaises(NoSuchDomainException):
+            self.pwm.get_domain('nonexistent.com')
+        self.assertEqual(registry.get_counter('pwm_db_errors_total',
+            operation='get_existing_domain_from_db'), 1)
+
+
+    def test_slow_queries(self):
+        original_threshold = metrics_module.SLOW_QUERY_THRESHOLD
+        metrics_module.SLOW_QUERY_THRESHOLD = 0
+        try:
+            self.pwm.search('example')
+        finally:
+            metrics_module.SLOW_QUERY_THRESHOLD = original_threshold
+        self.assertTrue(registry.get_counter('pwm_slow_queries_total') > 0)
@@ -0,0 +1,56 @@
+from pwm.encoding import PRESETS
+from pwm.policy import Policy, get_policy
+
+import itertools
+import os
+import unittest
+
+
+class PolicyTest(unittest.TestCase):
+
+    def test_dump_and_parse(self):
+        policy = Policy({'symbol': 1, 'digit': 2, 'upper': 0}, exclude='0OlI0')
+        self.assertEqual(policy.dump(), '{"exclude":"0IOl","min":{"digit":2,"symbol":1}}')
+        self.assertEqual(Policy.parse(policy.dump()), policy)
+        self.assertEqual(get_policy(policy.dump()), policy)
+        self.assertEqual(Policy().dump(), '{}')
+
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, Policy, {'emoji': 1})
+        self.assertRaises(ValueError, Policy, {'digit': -1})
+        self.assertRaises(ValueError, Policy.parse, 'digit:1')
+        self.assertRaises(ValueError, Policy.parse, '[]')
+
+        policy = Policy({'digit': 2, 'symbol': 1})
+        self.assertRaises(ValueError, policy.validate, PRESETS['full'], 2)
+        self.assertRaises(ValueError, policy.validate, PRESETS['alphanumeric'], 16)
+        self.assertRaises(ValueError, Policy(exclude='ab').validate, 'ab', 4)
+        policy.validate(PRESETS['full'], 3)
+        # Longer keys than HKDF can pick uniformly
+        self.assertRaises(ValueError, policy.validate, PRESETS['full'], 20000)
+
+
+    def test_encode_covers_every_compliant_key(self):
+        policy = Policy({'digit': 1, 'upper': 1}, exclude='b')
+        alphabet = 'abcAB12'
+        def compliant(key):
+            return (any(char.isdigit() for char in key) and any(char.isupper() for char in key)
+                and 'b' not in key)
+        expected = set(''.join(chars) for chars in itertools.product('acAB12', repeat=3)
+            if compliant(''.join(chars)))
+        self.assertAlmostEqual(2**policy.entropy(alphabet, 3), len(expected))
+
+        keys = set(policy.encode(os.urandom(64), alphabet, 3) for _ in range(3000))
+        self.assertEqual(keys, expected)
+
+
+    def test_encode_is_deterministic(self):
+        policy = Policy({'digit': 2, 'symbol': 2, 'lower': 1, 'upper': 1})
+        digest = b'\x01'*64
+        key = policy.encode(digest, PRESETS['full'], 16)
+        self.assertEqual(key, policy.encode(digest, PRESETS['full'], 16))
+        self.assertNotEqual(key, policy.encode(b'\x02'*64, PRESETS['full'], 16))
+        self.assertEqual(len(key), 16)
+        self.assertTrue(sum(char.isdigit() for char in key) >= 2)
+        self.assertTrue(sum(not char.isalnum() for char in key) >= 2)
@@ -0,0 +1,213 @@
+from pwm import PWM, NoSuchDomainException
+from pwm.core import Domain
+from pwm.metrics import registry
+
+import base64
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import parse_qs, urlparse
+except ImportError: # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import parse_qs, urlparse
+
+
+DOMAINS = {
+    'example.com': {'salt': base64.b64encode(b'NaCl').decode('ascii'), 'username': 'me'},
+    'facebook.com': {'salt': base64.b64encode(b'notsomuch').decode('ascii'), 'key_length': 8},
+}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ Minimal stand-in for a pwm server. """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests += 1
+        url = urlparse(self.path)
+        if url.path == '/search':
+            query = parse_qs(url.query)['q'][0]
+            self._respond(200, {'domains': [dict(DOMAINS[name], name=name)
+                for name in sorted(DOMAINS) if query in name]})
+            return
+        domain = parse_qs(url.query)['domain'][0]
+        if domain in DOMAINS:
+            etag = '"%s"' % hashlib.sha1(json.dumps(DOMAINS[domain]).encode('utf8')).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                self.server.not_modified += 1
+                self._respond(304, None)
+            else:
+                self._respond(200, DOMAINS[domain], {'ETag': etag})
+        else:
+            self._respond(404, {})
+
+
+    def do_POST(self):
+        self.server.requests += 1
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        names = json.loads(body.decode('utf8'))['domains']
+        self._respond(200, {'domains': dict((name, DOMAINS[name]) for name in names
+            if name in DOMAINS)})
+
+
+    def _respond(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf8') if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+
+class StandInServer(HTTPServer):
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.requests = 0
+        self.connections = 0
+        self.not_modified = 0
+
+
+    def get_request(self):
+        self.connections += 1
+        return HTTPServer.get_request(self)
+
+
+class PWMRestTest(unittest.TestCase):
+
+    config = {'cache_path': None}
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.pwm = PWM('http://127.0.0.1:%d' % self.server.server_port, config=self.config)
+
+
+    def tearDown(self):
+        self.pwm.close()
+        self.stop_server()
+
+
+    def stop_server(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server_thread.join()
+            self.server = None
+
+
+    def test_get_domain(self):
+        domain = self.pwm.get_domain('example.com')
+        self.assertEqual(domain.salt, b'NaCl')
+        self.assertEqual(domain.username, 'me')
+        expected = Domain(name='example.com', salt=b'NaCl').derive_key('secret')
+        self.assertEqual(domain.derive_key('secret'), expected)
+
+        self.assertRaises(NoSuchDomainException, self.pwm.get_domain, 'neverheardofthis')
+
+
+    def test_keep_alive(self):
+        for _ in range(5):
+            self.pwm.get_domain('example.com')
+        self.assertEqual(self.server.requests, 5)
+        self.assertEqual(self.server.connections, 1)
+
+
+    def test_get_domains(self):
+        domains = self.pwm.get_domains(['facebook.com', 'example.com'])
+        self.assertEqual([domain.name for domain in domains], ['facebook.com', 'example.com'])
+        self.assertEqual(domains[0].key_length, 8)
+        self.assertEqual(self.server.requests, 1)
+
+        self.assertRaises(NoSuchDomainException, self.pwm.get_domains,
+            ['example.com', 'neverheardofthis'])
+
+
+class PWMRestCacheTest(PWMRestTest):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = {
+            'cache_path': os.path.join(self.tmp_dir, 'cache.sqlite'),
+            'retries': 0,
+        }
+        super(PWMRestCacheTest, self).setUp()
+
+
+    def tearDown(self):
+        super(PWMRestCacheTest, self).tearDown()
+        shutil.rmtree(self.tmp_dir)
+
+
+    def test_keep_alive(self):
+        # Only the first lookup reaches the server with the cache enabled
+        for _ in range(5):
+            self.pwm.get_domain('example.com')
+        self.assertEqual(self.server.requests, 1)
+
+
+    def test_cache_hit(self):
+        self.pwm.get_domain('example.com')
+        other_pwm = PWM(self.pwm.database_uri, config=self.config)
+        try:
+            domain = other_pwm.get_domain('example.com')
+        finally:
+            other_pwm.close()
+        self.assertEqual(domain.salt, b'NaCl')
+        self.assertEqual(self.server.requests, 1)
+
+
+    def test_revalidation(self):
+        self.pwm.config['cache_ttl'] = 0
+        self.pwm.get_domain('example.com')
+        domain = self.pwm.get_domain('example.com')
+        self.assertEqual(domain.salt, b'NaCl')
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(self.server.not_modified, 1)
+
+
+    def test_metrics(self):
+        registry.reset()
+        self.pwm.config['cache_ttl'] = 0
+        self.pwm.get_domain('example.com')
+        self.pwm.get_domain('example.com')
+        self.assertEqual(registry.get_counter('pwm_rest_cache_total', result='miss'), 1)
+        self.assertEqual(registry.get_counter('pwm_rest_cache_total', result='revalidated'), 1)
+        self.assertEqual(registry.get_histogram('pwm_rest_request_seconds', method='GET',
+            status=200)[0], 1)
+        self.assertEqual(registry.get_histogram('pwm_rest_request_seconds', method='GET',
+            status=304)[0], 1)
+
+
+    def test_offline(self):
+        self.pwm.config['cache_ttl'] = 0
+        self.pwm.get_domains(['example.com', 'facebook.com'])
+        self.pwm.close()
+        self.stop_server()
+        self.assertEqual(self.pwm.get_domain('example.com').salt, b'NaCl')
+        domains = self.pwm.get_domains(['facebook.com', 'example.com'])
+        self.assertEqual([domain.salt for domain in domains], [b'notsomuch', b'NaCl'])
+
+
+    def test_get_domains_uses_cache(self):
+        self.pwm.get_domain('example.com')
+        domains = self.pwm.get_domains(['facebook.com', 'example.com'])
+        self.assertEqual([domain.name for domain in domains], ['facebook.com', 'example.com'])
+        self.assertEqual(self.server.requests, 2)
+        self.pwm.get_domains(['facebook.com', 'example.com'])
+        self.assertEqual(self.server.requests, 2)
@@ -0,0 +1,205 @@
+from pwm import PWM, NoSuchDomainException, Policy
+from pwm.metrics import registry
+from pwm.server import Server, create_ssl_context
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+
+import requests
+
+
+class ServerTest(unittest.TestCase):
+
+    ssl_context = None
+    scheme = 'http'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'test.sqlite')
+        pwm = PWM()
+        pwm.bootstrap(self.db_path)
+        self.domain = pwm.create_domain('example.com', username='me')
+        self.policy_domain = pwm.create_domain('facebook.com', length=8,
+            policy=Policy({'digit': 2}))
+        pwm.dispose()
+
+        self.server = Server(PWM(self.db_path), ('127.0.0.1', 0), threads=4,
+            ssl_context=self.ssl_context)
+        self.port = self.server.bind()[1]
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.url = '%s://127.0.0.1:%d' % (self.scheme, self.port)
+        self.pwm = PWM(self.url, config=self.client_config())
+
+
+    def client_config(self):
+        return {'cache_path': None}
+
+
+    def tearDown(self):
+        self.pwm.close()
+        self.server.shutdown()
+        self.server.close()
+        self.server_thread.join()
+        self.server.pwm.dispose()
+        shutil.rmtree(self.tmp_dir)
+
+
+    def test_get_domain(self):
+        domain = self.pwm.get_domain('example.com')
+        self.assertEqual(domain.salt, self.domain.salt)
+        self.assertEqual(domain.username, 'me')
+        self.assertEqual(domain.derive_key('secret'), self.domain.derive_key('secret'))
+
+        self.assertRaises(NoSuchDomainException, self.pwm.get_domain, 'neverheardofthis')
+
+
+    def test_get_domains(self):
+        domains = self.pwm.get_domains(['facebook.com', 'example.com'])
+        self.assertEqual([domain.name for domain in domains], ['facebook.com', 'example.com'])
+        self.assertEqual(domains[0].key_length, 8)
+        self.assertEqual(domains[0].key_policy, Policy({'digit': 2}))
+        self.assertEqual(domains[0].derive_key('secret'), self.policy_domain.derive_key('secret'))
+
+        self.assertRaises(NoSuchDomainException, self.pwm.get_domains,
+            ['example.com', 'neverheardofthis'])
+
+
+    def test_search(self):
+        domains = self.pwm.search('.com')
+        self.assertEqual([domain.name for domain in domains], ['example.com', 'facebook.com'])
+        self.assertEqual(domains[0].derive_key('secret'), self.domain.derive_key('secret'))
+        self.assertEqual([domain.name for domain in self.pwm.search('face', rank=True, limit=1)],
+            ['facebook.com'])
+        self.assertEqual(self.pwm.search('nothing'), [])
+
+
+    def test_modify_invalidates_cache(self):
+        old_salt = self.pwm.get_domain('example.com').salt
+        self.server.pwm.modify_domain('example.com', new_salt=True)
+        self.assertNotEqual(self.pwm.get_domain('example.com').salt, old_salt)
+
+
+    def test_external_modify_invalidates_cache(self):
+        # Like `pwm modify` in another process, which the server isn't told about
+        old_salt = self.pwm.get_domain('example.com').salt
+        other_pwm = PWM(self.db_path)
+        try:
+            other_pwm.modify_domain('example.com', new_salt=True)
+        finally:
+            other_pwm.close()
+        self.assertNotEqual(self.pwm.get_domain('example.com').salt, old_salt)
+
+
+class HTTPServerTest(ServerTest):
+
+    def test_etag(self):
+        response = requests.get(self.url + '/get', params={'domain': 'example.com'})
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+
+        response = requests.get(self.url + '/get', params={'domain': 'example.com'},
+            headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.server.pwm.modify_domain('example.com', new_salt=True)
+        response = requests.get(self.url + '/get', params={'domain': 'example.com'},
+            headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+
+    def test_bad_requests(self):
+        self.assertEqual(requests.get(self.url + '/get').status_code, 400)
+        self.assertEqual(requests.post(self.url + '/get', data='nope').status_code, 400)
+        self.assertEqual(requests.post(self.url + '/get',
+            data=json.dumps({'domains': 'example.com'})).status_code, 400)
+        self.assertEqual(requests.get(self.url + '/nope').status_code, 404)
+        self.assertEqual(requests.get(self.url + '/search').status_code, 400)
+        self.assertEqual(requests.get(self.url + '/search',
+            params={'q': 'example', 'limit': 'many'}).status_code, 400)
+        for limit in (-1, 0):
+            self.assertEqual(requests.get(self.url + '/search',
+                params={'q': 'example', 'limit': limit}).status_code, 400)
+        self.assertEqual(len(self.server.search('.com', limit=-1)), 1)
+
+
+    def test_cache_metrics(self):
+        registry.reset()
+        self.pwm.get_domain('example.com')
+        self.pwm.get_domain('example.com')
+        self.assertEqual(registry.get_counter('pwm_server_cache_total', result='miss'), 1)
+        self.assertEqual(registry.get_counter('pwm_server_cache_total', result='hit'), 1)
+
+        response = requests.get(self.url + '/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('pwm_server_request_seconds_count{endpoint="get",status="200"} 2',
+            response.text)
+
+
+def _openssl(*args):
+    subprocess.check_call(('openssl',) + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def _has_openssl():
+    try:
+        _openssl('version')
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+
+@unittest.skipUnless(_has_openssl(), 'needs the openssl command to create certificates')
+class HTTPSServerTest(ServerTest):
+
+    scheme = 'https'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.cert_dir = tempfile.mkdtemp()
+        path = lambda name: os.path.join(cls.cert_dir, name)
+        _openssl('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1',
+            '-keyout', path('server.key'), '-out', path('server.crt'))
+        _openssl('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-subj', '/CN=pwm test CA', '-keyout', path('ca.key'), '-out', path('ca.crt'))
+        _openssl('req', '-newkey', 'rsa:2048', '-nodes', '-subj', '/CN=client',
+            '-keyout', path('client.key'), '-out', path('client.csr'))
+        _openssl('x509', '-req', '-days', '1', '-in', path('client.csr'), '-CA', path('ca.crt'),
+            '-CAkey', path('ca.key'), '-CAcreateserial', '-out', path('client.crt'))
+        cls.ssl_context = create_ssl_context(path('server.crt'), path('server.key'),
+            client_ca=path('ca.crt'))
+        # requests prefers these over the pinned certificate of the session
+        cls.ca_bundles = dict((name, os.environ.pop(name)) for name in
+            ('REQUESTS_CA_BUNDLE', 'CURL_CA_BUNDLE') if name in os.environ)
+
+
+    @classmethod
+    def tearDownClass(cls):
+        os.environ.update(cls.ca_bundles)
+        shutil.rmtree(cls.cert_dir)
+
+
+    def client_config(self):
+        return {
+            'cache_path': None,
+            'server_certificate': os.path.join(self.cert_dir, 'server.crt'),
+            'auth': (os.path.join(self.cert_dir, 'client.crt'),
+                os.path.join(self.cert_dir, 'client.key')),
+            'retries': 0,
+        }
+
+
+    def test_requires_client_certificate(self):
+        config = self.client_config()
+        del config['auth']
+        pwm = PWM(self.url, config=config)
+        try:
+            self.assertRaises(Exception, pwm.get_domain, 'example.com')
+        finally:
+            pwm.close()
@@ -0,0 +1,62 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+# Heavy dependencies that should only be imported when they're actually needed
+HEAVY_MODULES = ['sqlalchemy', 'requests', 'scrypt', 'numpy', 'pwm.core', 'http.client']
+
+# Importing the database stack eagerly takes several hundred milliseconds. Wall-clock time depends
+# on the machine and its load, so the budget is only checked when PWM_TIMING_TESTS is set. The
+# checks that HEAVY_MODULES stay unimported catch the regressions that matter either way.
+STARTUP_BUDGET_IN_MS = 150
+
+
+def _run_python(code):
+    output = subprocess.check_output([sys.executable, '-c', code])
+    return json.loads(output.decode('utf8'))
+
+
+def _loaded_heavy_modules(code):
+    return _run_python(code + '\nimport json, sys\n' +
+        'print(json.dumps([m for m in %r if m in sys.modules]))' % HEAVY_MODULES)
+
+
+def _import_time_in_ms(module):
+    """ Best of three, with the interpreter startup subtracted. """
+    code = 'import json, timeit\n' + \
+        't = timeit.default_timer()\n' + \
+        'import %s\n' % module + \
+        'print(json.dumps((timeit.default_timer() - t)*1000))'
+    return min(_run_python(code) for _ in range(3))
+
+
+class StartupTest(unittest.TestCase):
+
+    def test_package_import_is_lazy(self):
+        self.assertEqual(_loaded_heavy_modules('import pwm'), [])
+        self.assertEqual(_loaded_heavy_modules('from pwm import Encoder, PRESETS'), [])
+
+
+    def test_cli_import_is_lazy(self):
+        self.assertEqual(_loaded_heavy_modules('import pwm.cli'), [])
+
+
+    def test_index_lookup_is_lazy(self):
+        loaded = _loaded_heavy_modules('from pwm.index import open_index\n' +
+            'from pwm.derive import _derive_key, key_args')
+        self.assertEqual(loaded, [])
+
+
+    def test_lazy_attributes(self):
+        loaded = _loaded_heavy_modules('from pwm import PWM')
+        self.assertTrue('sqlalchemy' in loaded)
+        self.assertFalse('requests' in loaded)
+
+
+    @unittest.skipUnless(os.environ.get('PWM_TIMING_TESTS'), 'set PWM_TIMING_TESTS to check timings')
+    def test_cli_startup_budget(self):
+        import_time = _import_time_in_ms('pwm.cli')
+        self.assertTrue(import_time < STARTUP_BUDGET_IN_MS,
+            'Importing pwm.cli took %.1fms, budget is %dms' % (import_time, STARTUP_BUDGET_IN_MS))